@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+''' bfc
+Steps and size of the arithmetic statements (mul, divmod, less, equal) and of
+printnum, against what a program had to do without them:
+
+    multiply     code/multiply.bfcg, which multiplies with nested copy and add
+                 loops, against the same program using mul
+    printnum     printing a number that could be anything against the digit loop
+                 printnum used to emit, and printing numbers with range
+                 specialization (see BFCodeGenerator.ranges) off and on
+    compare      less and equal against while loops counting both numbers down
+
+Every pair is run on the same inputs and must print the same output, steps are
+brainfsck commands executed (bfvm.countSteps), summed over the inputs. For
+printnum the size and steps are those of the printnum alone.
+
+    python3 benchmarks/arithmetic.py [--output results.json]
+'''
+
+import argparse
+import json
+import os
+import sys
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bfc
+import bfcparse
+import bfvm
+from bfcg import BFCodeGenerator
+
+# the multiplication in code/multiply.bfcg, and the same with mul, both leave
+# the product in result and num2 and zero in num1. mul doesn't need the temps,
+# they aren't declared (mul's scratch cells take their place)
+HAND_MULTIPLY = '''copy num1 numtemp1 numtemp2;
+copy numtemp2 num1;
+
+// num1 is now in num1 and numtemp1 //
+
+var num2 -= 1; // we want to subtract num2 because n*1 = n //
+while num2:
+	copy numtemp1 numtemp2 numtemp3;
+	add numtemp2 num1;
+	add numtemp3 numtemp1;
+	var num2 -= 1;
+
+end;
+
+copy num1 result num2;
+'''
+MUL_MULTIPLY = '''mul num1 num2 num1;
+var num2;
+copy num1 result num2;
+'''
+TEMPS = 'var numtemp1;\nvar numtemp2;\nvar numtemp3;\n'
+
+# the digit loop printnum used to emit, it needs the 9 cells to the right of
+# the value to be zero
+OLD_PRINTNUM = ('[>>+>+<<<-]>>>[<<<+>>>-]<<+>[<->[>++++++++++<[->-[>+>>]>[+[-<+>]>+>>]<<<<<]'
+                '>[-]++++++++[<++++++>-]>[<<+>>-]>[<<+>>-]<<]>]<[->>++++++++[<++++++>-]]<[.[-]<]<')
+
+# programs that leave a value in x, with what is known about it
+PRINTNUM = {
+    'constant': 'var x = 123;',
+    'digit': 'var y; var ten = 10; read y; divmod y ten q x;',
+    'two digits': 'var y; var c = 100; read y; divmod y c q x;',
+    'boolean': 'var y; var z; read y; read z; less y z x;',
+}
+
+# x < y and x == y counting both down, then the same with less and equal
+HAND_COMPARE = '''var x; var y; var lt; var eq = 1; var t; var u;
+read x; read y;
+copy x t u; copy u x;
+while t:
+	copy y u lt; copy lt y;
+	if u:
+		var y -= 1;
+	else
+		var t = 1;
+		var eq = 0;
+	endif;
+	var u;
+	var t -= 1;
+end;
+var lt;
+if y:
+	var lt = 1;
+	var eq = 0;
+endif;
+print lt; print eq;
+'''
+OP_COMPARE = '''var x; var y;
+read x; read y;
+less x y lt; equal x y eq;
+print lt; print eq;
+'''
+
+def generate(source, specialize=True):
+    lexer, parser = bfc.buildToolchain()
+    code_generator = BFCodeGenerator()
+    code_generator.specialize = specialize
+    bfcparse.run(parser.parse(lexer.lex(source), state=code_generator), code_generator)
+    return code_generator.code
+
+def measure(code, inputs, setup=''):
+    ''' (size, total steps, outputs), leaving out what the setup code takes '''
+    program = bfvm.Program(code)
+    return (len(code) - len(setup),
+            sum(bfvm.countSteps(code, data) - bfvm.countSteps(setup, data) for data in inputs),
+            [program.run(data) for data in inputs])
+
+def compare(name, before, after, inputs, setup=('', '')):
+    size, steps, outputs = measure(before, inputs, setup[0])
+    new_size, new_steps, new_outputs = measure(after, inputs, setup[1])
+    if outputs != new_outputs:
+        raise AssertionError('%s prints different output' % name)
+    print('%-22s size %6d -> %6d   steps %9d -> %9d  (%.1fx)' % (
+          name, size, new_size, steps, new_steps, steps / max(new_steps, 1)))
+    return {'size': [size, new_size], 'steps': [steps, new_steps]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the arithmetic statements.')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    args = parser.parse_args(argv)
+    warnings.simplefilter('ignore')
+    results = {}
+
+    with open(os.path.join(ROOT, 'code', 'multiply.bfcg')) as file:
+        source = file.read()
+    if HAND_MULTIPLY not in source or TEMPS not in source:
+        raise AssertionError('code/multiply.bfcg has changed, update HAND_MULTIPLY')
+    digits = [bytes([48 + a, 48 + b]) for a in range(1, 10) for b in range(1, 10)]
+    results['multiply'] = compare('multiply', generate(source),
+                                  generate(source.replace(HAND_MULTIPLY, MUL_MULTIPLY).replace(TEMPS, '')),
+                                  digits)
+
+    numbers = [bytes([a, b]) for a in range(0, 256, 5) for b in range(0, 256, 51)]
+    results['printnum loop'] = compare('printnum loop', ',' + OLD_PRINTNUM,
+                                       generate('var x; read x; printnum x;'), numbers)
+    for name, source in PRINTNUM.items():
+        setup = (generate(source, False), generate(source))
+        results['printnum ' + name] = compare('printnum ' + name,
+                                              generate(source + ' printnum x;', False),
+                                              generate(source + ' printnum x;'), numbers, setup)
+
+    results['compare'] = compare('compare', generate(HAND_COMPARE), generate(OP_COMPARE), numbers)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
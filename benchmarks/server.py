@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+''' bfc
+Latency and throughput of the compile server (bfserver) against the one-shot
+path, compiling the example programs in code/:
+
+    one-shot     a python3 bfc.py process per file, what a build does today
+    client       a python3 bfclient.py process per file, talking to the server
+    request      one request at a time over an open connection, the latency of
+                 the server itself
+    pipelined    every file sent on one connection without waiting
+    concurrent   --clients connections at once, each sending every file
+
+The server is started on a temporary socket with -j workers and stopped at the
+end.
+
+    python3 benchmarks/server.py [--rounds 5] [-j 4] [--clients 4] [--output results.json]
+'''
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bfclient
+
+def sources():
+    found = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'code', '*.bfcg'))):
+        with open(path) as file:
+            found.append((path, file.read()))
+    return found
+
+def summary(latencies, elapsed, count):
+    ''' Milliseconds per compile and compiles per second. '''
+    ordered = sorted(latencies)
+    return {'mean': statistics.mean(ordered) * 1000,
+            'p50': ordered[len(ordered) // 2] * 1000,
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            'throughput': count / elapsed}
+
+def processes(command, files, rounds, output_dir):
+    ''' Run command + [file] for every file, one process after the other. '''
+    latencies = []
+    start = time.perf_counter()
+    for round in range(rounds):
+        for path, source in files:
+            began = time.perf_counter()
+            subprocess.run(command + [path, '-o', output_dir], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            latencies.append(time.perf_counter() - began)
+    return summary(latencies, time.perf_counter() - start, len(latencies))
+
+def requests(path, files, rounds):
+    latencies = []
+    start = time.perf_counter()
+    with bfclient.Client(path) as client:
+        for round in range(rounds):
+            for name, source in files:
+                began = time.perf_counter()
+                response = client.compile(source)
+                latencies.append(time.perf_counter() - began)
+                assert response['error'] is None, response['error']
+    return summary(latencies, time.perf_counter() - start, len(latencies))
+
+def pipelined(path, files, rounds, clients=1):
+    ''' clients connections, each sending every file rounds times without waiting
+    for the answers. The latency is from sending a request to its response. '''
+    latencies = []
+    lock = threading.Lock()
+    def run():
+        sent = []
+        def messages():
+            for round in range(rounds):
+                for name, source in files:
+                    sent.append(time.perf_counter())
+                    yield bfclient.request(source)
+        with bfclient.Client(path) as client:
+            for index, response in enumerate(client.compileMany(messages())):
+                elapsed = time.perf_counter() - sent[index]
+                assert response['error'] is None, response['error']
+                with lock:
+                    latencies.append(elapsed)
+    threads = [threading.Thread(target=run) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summary(latencies, time.perf_counter() - start, len(latencies))
+
+def startServer(path, jobs):
+    server = subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(ROOT, 'bfc.py'),
+                               '--serve', '--socket', path, '-j', str(jobs)],
+                              stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        client = bfclient.connect(path)
+        if client is not None:
+            client.close()
+            return server
+        if server.poll() is not None:
+            raise RuntimeError("The server exited with status %d" % server.returncode)
+        time.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("The server did not start")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the compile server against '
+                                                 'one process per file.')
+    parser.add_argument('--rounds', type=int, default=5, help='times every file is compiled')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='server workers (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='connections for the concurrent run (default: %(default)s)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+    files = sources()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bfc.sock')
+        python = [sys.executable, '-W', 'ignore']
+        results['one-shot'] = processes(python + [os.path.join(ROOT, 'bfc.py'), '--no-cache',
+                                                  '-j', '1'], files, args.rounds, directory)
+        server = startServer(path, args.jobs)
+        try:
+            results['client'] = processes(python + [os.path.join(ROOT, 'bfclient.py'),
+                                                    '--socket', path, '--no-fallback'],
+                                          files, args.rounds, directory)
+            results['request'] = requests(path, files, args.rounds)
+            results['pipelined'] = pipelined(path, files, args.rounds)
+            results['concurrent'] = pipelined(path, files, args.rounds, args.clients)
+        finally:
+            server.terminate()
+            server.wait()
+    print('%d files x %d rounds, %d server workers, %d concurrent clients' % (
+          len(files), args.rounds, args.jobs, args.clients))
+    print('%-12s %10s %10s %10s %14s' % ('', 'mean ms', 'p50 ms', 'p95 ms', 'compiles/s'))
+    for name, result in results.items():
+        print('%-12s %10.2f %10.2f %10.2f %14.1f' % (name, result['mean'], result['p50'],
+              result['p95'], result['throughput']))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'files': len(files), 'rounds': args.rounds, 'jobs': args.jobs,
+                       'clients': args.clients, 'results': results}, file, indent=1)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
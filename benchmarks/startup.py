@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+''' bfc
+Startup benchmark, measures how long a fresh interpreter takes to get a usable
+lexer and parser. Every run is a new process so nothing is shared between runs.
+
+    python3 benchmarks/startup.py [runs]
+'''
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('python', 'pass'),
+    ('numpy import (removed)', 'import numpy.core.fromnumeric'),
+    ('rebuild tables', 'import bfc; bfc.buildToolchain(cache_id=None)'),
+    ('cached tables', 'import bfc; bfc.buildToolchain()'),
+]
+
+def timeRun(statement):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', statement], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start, result.returncode
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    timeRun(CASES[-1][1]) # make sure the table cache exists
+    for name, statement in CASES:
+        times = []
+        for i in range(runs):
+            elapsed, returncode = timeRun(statement)
+            if returncode:
+                break
+            times.append(elapsed)
+        if not times:
+            print('%-24s unavailable' % name)
+            continue
+        times.sort()
+        print('%-24s median %7.1f ms   min %7.1f ms' % (name, times[len(times)//2]*1000, times[0]*1000))
+
+if __name__=='__main__':
+    main()
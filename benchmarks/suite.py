@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+''' bfc
+Benchmark suite, compiles and runs the example programs in code/ plus synthetic
+scaled up ones (deeply nested whiles, long strings, long straight line programs)
+and records for each:
+
+    compile      best compile time over the runs, in seconds
+    lex, parse, eval
+                 the same split into phases
+    peak_memory  peak memory allocated while compiling, in bytes (tracemalloc)
+    size         length of the generated brainfsck
+    steps        brainfsck commands executed on the canned input (bfvm.countSteps)
+
+Results are written as JSON and compared against a stored baseline, anything
+worse than the tolerance is reported as a regression.
+
+    python3 benchmarks/suite.py [--runs 5] [--output results.json]
+                                [--baseline benchmarks/baseline.json] [--save-baseline]
+                                [--check]
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bfc
+import bfcparse
+import bfvm
+from bfcg import BFCodeGenerator
+
+VERSION = 1
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+STEP_LIMIT = 100000000
+
+# canned input for the examples that read some
+INPUTS = {
+    'add': b'34',
+    'multiply': b'34',
+    'echo': b'hello\n',
+    'input_output': b'abcde',
+}
+
+# how much worse than the baseline a metric may get before it is a regression,
+# times are noisy so they get more room
+TOLERANCE = {
+    'compile': 0.25, 'lex': 0.25, 'parse': 0.25, 'eval': 0.25,
+    'peak_memory': 0.10,
+    'size': 0.0,
+    'steps': 0.0,
+}
+# and changes smaller than this are noise whatever the ratio
+NOISE = {'compile': 0.002, 'lex': 0.002, 'parse': 0.002, 'eval': 0.002, 'peak_memory': 4096}
+
+def nestedLoops(depth, count=2):
+    ''' depth whiles nested in each other, each running count times, printing a ! in
+    the innermost one. '''
+    lines = ["var exclam = '!';"]
+    for level in range(depth):
+        indent = '\t' * level
+        lines.append('%svar v%d = %d;' % (indent, level, count))
+        lines.append('%swhile v%d:' % (indent, level))
+    lines.append('%sprint exclam;' % ('\t' * depth))
+    for level in reversed(range(depth)):
+        indent = '\t' * level
+        lines.append('%s\tvar v%d -= 1;' % (indent, level))
+        lines.append('%send;' % indent)
+    return '\n'.join(lines) + '\n'
+
+def longStrings(count, length):
+    ''' count print statements of length characters each. '''
+    text = 'The quick brown fox jumps over the lazy dog. '
+    lines = []
+    for i in range(count):
+        start = i % len(text)
+        line = (text * (length // len(text) + 2))[start:start + length]
+        lines.append('print "%s";' % line)
+    return '\n'.join(lines) + '\n'
+
+def straightLine(count):
+    ''' count lines of arithmetic, small loops and ifs over a few variables. '''
+    lines = ['var a = 1;', 'var b;', 'var c = 7;']
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            lines.append('var a += %d;' % (i % 13 + 1))
+        elif kind == 1:
+            lines.append('var b -= 1 + 2;')
+        elif kind == 2:
+            lines.append('while b: var b -= 1; var c += 1; end;')
+        elif kind == 3:
+            lines.append('if a: var a -= 1; endif;')
+        else:
+            lines.append('// line %d //' % i)
+    lines.append('printnum c;')
+    return '\n'.join(lines) + '\n'
+
+def cases():
+    ''' (name, source, input) for every benchmark. '''
+    found = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'code', '*.bfcg'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as file:
+            found.append((name, file.read(), INPUTS.get(name, b'')))
+    for depth in (4, 8, 12):
+        found.append(('nested-%d' % depth, nestedLoops(depth), b''))
+    found.append(('strings-100x80', longStrings(100, 80), b''))
+    found.append(('strings-10x2000', longStrings(10, 2000), b''))
+    for count in (1000, 10000):
+        found.append(('straight-%d' % count, straightLine(count), b''))
+    return found
+
+def phases(source):
+    ''' Seconds spent lexing, parsing and evaluating source. '''
+    lexer, parser = bfc.buildToolchain()
+    start = time.perf_counter()
+    tokens = list(lexer.lex(source))
+    lexed = time.perf_counter()
+    parsed = parser.parse(iter(tokens), state=BFCodeGenerator())
+    done = time.perf_counter()
+    bfcparse.run(parsed)
+    evaluated = time.perf_counter()
+    return lexed - start, done - lexed, evaluated - done
+
+def measure(source, input, runs, options):
+    ''' The metrics of one case. '''
+    result = {}
+    best = None
+    for run in range(runs):
+        start = time.perf_counter()
+        code = bfc.compileSource(source, **options).code
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        split = phases(source)
+        if run == 0 or sum(split) < result['lex'] + result['parse'] + result['eval']:
+            result['lex'], result['parse'], result['eval'] = split
+    result['compile'] = best
+    tracemalloc.start()
+    bfc.compileSource(source, **options)
+    result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result['size'] = len(code)
+    result['steps'] = bfvm.countSteps(code, input, limit=STEP_LIMIT)
+    return result
+
+def runSuite(runs=5, options={}, only=None):
+    bfc.buildToolchain()
+    results = {}
+    for name, source, input in cases():
+        if only and name not in only:
+            continue
+        results[name] = measure(source, input, runs, options)
+        metrics = results[name]
+        print('%-20s compile %8.2f ms (lex %6.2f parse %6.2f eval %6.2f)  peak %8d KB  '
+              'size %8d  steps %s' % (name, metrics['compile'] * 1000, metrics['lex'] * 1000,
+              metrics['parse'] * 1000, metrics['eval'] * 1000, metrics['peak_memory'] // 1024,
+              metrics['size'], metrics['steps']))
+    return {'version': VERSION, 'python': platform.python_version(), 'runs': runs,
+            'options': options, 'cases': results}
+
+def compare(results, baseline):
+    ''' Print every metric that changed against the baseline, returns the list of
+    regressions as (case, metric, old, new). '''
+    regressions = []
+    if baseline.get('options') != results['options']:
+        print('baseline was recorded with options %s, comparing anyway' % baseline.get('options'))
+    for name, metrics in sorted(results['cases'].items()):
+        old_metrics = baseline['cases'].get(name)
+        if old_metrics is None:
+            print('%-20s new case' % name)
+            continue
+        for metric, tolerance in TOLERANCE.items():
+            old, new = old_metrics.get(metric), metrics.get(metric)
+            if old is None or new is None or old == new:
+                continue
+            change = (new - old) / old if old else float('inf')
+            regressed = change > tolerance and new - old > NOISE.get(metric, 0)
+            if regressed:
+                regressions.append((name, metric, old, new))
+            if regressed or metric not in NOISE or abs(change) > tolerance and \
+                    abs(new - old) > NOISE[metric]:
+                print('%-20s %-12s %12g -> %-12g %+7.1f%%%s' % (name, metric, old, new,
+                      change * 100, '  REGRESSION' if regressed else ''))
+    print('%d regressions against the baseline' % len(regressions))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the compiler on the examples '
+                                                 'and synthetic programs.')
+    parser.add_argument('--runs', type=int, default=5, help='compile runs per case, the best is kept')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='results to compare against (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if anything regressed')
+    parser.add_argument('--case', action='append', default=None,
+                        help='only run this case, can be given more than once')
+    parser.add_argument('-O', dest='optimize', action='store_true')
+    parser.add_argument('--layout', action='store_true')
+    parser.add_argument('--partial', action='store_true')
+    args = parser.parse_args(argv)
+    warnings.simplefilter('ignore')
+    options = {'optimize': args.optimize, 'layout': args.layout, 'partial': args.partial}
+    results = runSuite(args.runs, options, args.case)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+    return 1 if args.check and regressions else 0
+
+if __name__=='__main__':
+    sys.exit(main())
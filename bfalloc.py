@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the cell allocator for bfc. By default BFCodeGenerator gives each
+variable the next cell in declaration order. The allocator instead evaluates the
+parse tree once to record the order moveTo visits the variables in, then places
+variables that are used one after the other next to each other so that less
+pointer movement is emitted.
+
+Finding the best linear layout is NP-hard, so the placement is a heuristic: a
+greedy insertion over the co-access graph followed by local improvement.
+'''
+
+import bfcparse
+
+def coAccess(accesses):
+    ''' Count how often each pair of variables is visited one after the other. '''
+    weights = {}
+    previous = None
+    for var in accesses:
+        if previous is not None and var != previous:
+            pair = (previous, var) if previous < var else (var, previous)
+            weights[pair] = weights.get(pair, 0) + 1
+        previous = var
+    return weights
+
+def movementCost(accesses, layout):
+    ''' Number of cells the pointer travels visiting accesses in order from cell 0. '''
+    cost = 0
+    cell = 0
+    for var in accesses:
+        cost += abs(layout[var] - cell)
+        cell = layout[var]
+    return cost
+
+def _neighbours(names, weights):
+    ''' {name: {neighbour: weight}} of the co-access graph between names. '''
+    neighbours = {name: {} for name in names}
+    for (a, b), weight in weights.items():
+        if a in neighbours and b in neighbours:
+            neighbours[a][b] = weight
+            neighbours[b][a] = weight
+    return neighbours
+
+# The cost of an order is the sum of weight * distance over its edges. It is never
+# recomputed from scratch while searching: cut[i] holds the weight of the edges
+# that span the gap before index i (cut[0] and cut[-1] are 0), inserting a
+# variable at i makes exactly those edges one cell longer.
+# Moving or inserting one variable costs O(n + degree): a sweep over the cut for
+# the cost at every index and one to update it. A round of _improve tries every
+# variable, so it is O(n * n + E).
+
+def _span(cut, position, index, links, sign=1):
+    ''' Add (or with sign=-1 remove) the edges from the variable at index to its
+    links {variable: weight} to cut. '''
+    delta = [0] * (len(cut) + 1)
+    for name, weight in links.items():
+        other = position[name]
+        low, high = (other, index) if other < index else (index, other)
+        delta[low + 1] += weight
+        delta[high + 1] -= weight
+    running = 0
+    for gap in range(len(cut)):
+        running += delta[gap]
+        cut[gap] += sign * running
+
+def _insertionCosts(cut, placed):
+    ''' What inserting a variable adds to the cost at every index of an order.
+    placed: (position, weight) of its edges to variables of the order, the ones
+    at or after the index move one cell right. '''
+    size = len(cut) - 1
+    weights = [0] * size
+    right_weight = right_sum = 0
+    for position, weight in placed:
+        weights[position] += weight
+        right_weight += weight
+        right_sum += weight * position
+    left_weight = left_sum = 0
+    costs = []
+    for index in range(size + 1):
+        costs.append(cut[index] + left_weight * index - left_sum +
+                     right_sum + right_weight * (1 - index))
+        if index < size:
+            weight = weights[index]
+            left_weight += weight
+            left_sum += weight * index
+            right_weight -= weight
+            right_sum -= weight * index
+    return costs
+
+def _insert(order, cut, name, index, links):
+    ''' order and cut with name inserted at index, and the new positions. '''
+    order = order[:index] + [name] + order[index:]
+    position = {n: i for i, n in enumerate(order)}
+    # both gaps around name are spanned by what spanned the gap it went into
+    cut = cut[:index + 1] + cut[index:]
+    _span(cut, position, index, links)
+    return order, position, cut
+
+def _greedy(names, neighbours):
+    ''' Place the most connected variable first, then repeatedly insert the
+    variable with the most weight to the ones already placed wherever it adds the
+    least cost. '''
+    remaining = list(names)
+    first = max(remaining, key=lambda name: sum(neighbours[name].values()))
+    remaining.remove(first)
+    order, position, cut = [first], {first: 0}, [0, 0]
+    attached = dict.fromkeys(remaining, 0)
+    for other, weight in neighbours[first].items():
+        attached[other] += weight
+    while remaining:
+        name = max(remaining, key=attached.get)
+        remaining.remove(name)
+        links = {other: weight for other, weight in neighbours[name].items() if other in position}
+        costs = _insertionCosts(cut, [(position[other], weight) for other, weight in links.items()])
+        order, position, cut = _insert(order, cut, name, costs.index(min(costs)), links)
+        for other, weight in neighbours[name].items():
+            if other in attached:
+                attached[other] += weight
+    return order
+
+def _improve(order, neighbours, rounds=20):
+    ''' Move single variables to other positions while that lowers the cost. '''
+    position = {name: i for i, name in enumerate(order)}
+    cut = [0] * (len(order) + 1)
+    cost = 0
+    for name in order:
+        later = {other: weight for other, weight in neighbours[name].items()
+                 if position[other] > position[name]}
+        _span(cut, position, position[name], later)
+        cost += sum(weight * (position[other] - position[name]) for other, weight in later.items())
+    for r in range(rounds):
+        improved = False
+        for name in list(order):
+            index = position[name]
+            links = neighbours[name]
+            # the order without name: its edges go, the two gaps around it merge
+            # and the edges over its cell get one shorter
+            rest_cut = list(cut)
+            _span(rest_cut, position, index, links, -1)
+            del rest_cut[index]
+            rest_cost = cost - rest_cut[index] - sum(weight * abs(position[other] - index)
+                                                     for other, weight in links.items())
+            placed = [(position[other] - (position[other] > index), weight)
+                      for other, weight in links.items()]
+            costs = _insertionCosts(rest_cut, placed)
+            best = min(costs)
+            if rest_cost + best < cost:
+                rest = order[:index] + order[index + 1:]
+                order, position, cut = _insert(rest, rest_cut, name, costs.index(best), links)
+                cost = rest_cost + best
+                improved = True
+        if not improved:
+            break
+    return order
+
+def planLayout(accesses, pinned=()):
+    ''' Choose a cell for every variable in accesses.
+    pinned variables need free cells to their right (printnum uses 9 of them),
+    so they are placed after everything else, 10 cells apart. '''
+    names = list(dict.fromkeys(accesses))
+    free = [name for name in names if name not in pinned]
+    neighbours = _neighbours(free, coAccess(accesses))
+    order = _improve(_greedy(free, neighbours), neighbours) if free else []
+    # the order costs the same both ways round, but the pointer starts at cell 0
+    layout = {name: cell for cell, name in enumerate(order)}
+    reverse = {name: cell for cell, name in enumerate(reversed(order))}
+    visits = [var for var in accesses if var in layout]
+    if movementCost(visits, reverse) < movementCost(visits, layout):
+        layout = reverse
+    cell = len(order)
+    for name in names:
+        if name in pinned:
+            layout[name] = cell
+            cell += 10
+    return layout
+
+def _moves(code):
+    return code.count('<') + code.count('>')
+
+def allocate(parsed, code_generator):
+    ''' Evaluate parsed into code_generator with the layout that emits the least
+    pointer movement, and return a report of what each layout costs, which is
+    also kept in code_generator.layout_report.
+    The generator must not have been used yet. '''
+    code_generator.accesses = []
+    bfcparse.run(parsed, code_generator)
+    declaration = _moves(code_generator.code)
+    accesses = code_generator.accesses
+    layout = planLayout(accesses, code_generator.pinned)
+    code_generator.accesses = None
+    code_generator.reset(layout)
+    bfcparse.run(parsed, code_generator)
+    optimized = _moves(code_generator.code)
+    report = {'declaration': declaration, 'optimized': optimized, 'layout': layout}
+    if optimized > declaration:
+        # the heuristic lost, go back to declaration order
+        code_generator.reset()
+        bfcparse.run(parsed, code_generator)
+        report['layout'] = dict(code_generator.variables)
+        report['optimized'] = declaration
+    report['saved'] = declaration - report['optimized']
+    code_generator.layout_report = report
+    return report
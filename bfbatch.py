@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the batch runner for bfc. It runs one program over many inputs at once
+with NumPy, which is the only part of bfc that needs it.
+
+Every input gets a lane: a row of a 2-D uint8 tape array and its own data
+pointer. All lanes share one program counter over the bfvm IR, so each op is a
+single vectorized operation over the lanes that are active. At a [ the lanes
+whose cell is zero are masked off until the matching ] and the loop repeats
+while any lane is still in it, so every lane sees exactly what it would see
+running on its own.
+'''
+
+import numpy as np
+
+import bfir
+import bfvm
+
+class BatchRunner:
+    ''' Brainfsck code (text or bfir nodes) lowered once, ready to be run over
+    batches of inputs.
+    tape_size: cells per lane, the tape array takes len(inputs) * tape_size bytes.
+    eof: the value stored by , when a lane's input is exhausted, None leaves the
+         cell unchanged.
+    After a run tape is the 2-D array of final tapes and pointer the pointer of
+    every lane. '''
+    def __init__(self, code, tape_size=4096, eof=None):
+        self.ops = bfir.ops(code)
+        self.tape_size = tape_size
+        self.eof = eof
+
+    def run(self, inputs):
+        ''' Run the program on every input (bytes), returning a list of outputs. '''
+        lengths = np.array([len(i) for i in inputs], dtype=np.int64)
+        data = np.zeros((len(inputs), max(lengths.max(initial=0), 1)), dtype=np.uint8)
+        for lane, i in enumerate(inputs):
+            data[lane, :len(i)] = np.frombuffer(bytes(i), dtype=np.uint8)
+        output, output_lengths = self.runArrays(data, lengths)
+        return [output[lane, :output_lengths[lane]].tobytes() for lane in range(len(inputs))]
+
+    def runArrays(self, data, lengths):
+        ''' Run the program with lane i reading data[i, :lengths[i]].
+        Returns a 2-D uint8 array of outputs, padded with zeros, and their lengths. '''
+        lanes = data.shape[0]
+        tape = np.zeros((lanes, self.tape_size), dtype=np.uint8)
+        p = np.zeros(lanes, dtype=np.int64)
+        read = np.zeros(lanes, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        printed = []            # (lanes, values) for every .
+        active = np.arange(lanes)
+        masks = []              # active lanes outside each loop we are in
+        ops = self.ops
+        pc = 0
+        end = len(ops)
+        while pc < end:
+            op, arg = ops[pc]
+            if op == bfvm.ADD:
+                tape[active, p[active]] += np.uint8(arg)
+            elif op == bfvm.MOVE:
+                p[active] += arg
+                moved = p[active]
+                if moved.size and (moved.min() < 0 or moved.max() >= self.tape_size):
+                    raise IndexError("Pointer moved off the tape")
+            elif op == bfvm.OPEN:
+                inside = active[tape[active, p[active]] != 0]
+                if inside.size:
+                    masks.append(active)
+                    active = inside
+                else:
+                    pc = arg
+            elif op == bfvm.CLOSE:
+                inside = active[tape[active, p[active]] != 0]
+                if inside.size:
+                    active = inside
+                    pc = arg
+                else:
+                    active = masks.pop()
+            elif op == bfvm.SET:
+                tape[active, p[active]] = arg
+            elif op == bfvm.MULADD:
+                multiplier, others = arg
+                cells = p[active]
+                n = (tape[active, cells].astype(np.int64) * multiplier) & 255
+                if others[0][0] < 0 and cells.size and (cells + others[0][0]).min() < 0:
+                    raise IndexError("Pointer moved off the tape")
+                for offset, factor in others:
+                    tape[active, cells + offset] = (tape[active, cells + offset] + n * factor) & 255
+                tape[active, cells] = 0
+            elif op == bfvm.OUT:
+                printed.append((active, tape[active, p[active]]))
+            elif op == bfvm.IN:
+                has = active[read[active] < lengths[active]]
+                tape[has, p[has]] = data[has, read[has]]
+                read[has] += 1
+                if self.eof is not None:
+                    empty = active[read[active] >= lengths[active]]
+                    empty = np.setdiff1d(empty, has, assume_unique=True)
+                    tape[empty, p[empty]] = self.eof & 255
+            pc += 1
+        self.tape, self.pointer = tape, p
+        return self._collect(printed, lanes)
+
+    def _collect(self, printed, lanes):
+        ''' Turn the printed values, recorded in program order, into one padded row
+        of output per lane. '''
+        if not printed:
+            return np.zeros((lanes, 0), dtype=np.uint8), np.zeros(lanes, dtype=np.int64)
+        who = np.concatenate([lane for lane, values in printed])
+        what = np.concatenate([values for lane, values in printed])
+        order = np.argsort(who, kind='stable')
+        who = who[order]
+        what = what[order]
+        lengths = np.bincount(who, minlength=lanes)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        column = np.arange(len(who)) - starts[who]
+        output = np.zeros((lanes, lengths.max()), dtype=np.uint8)
+        output[who, column] = what
+        return output, lengths
+
+def run(code, inputs, tape_size=4096, eof=None):
+    ''' Run brainfsck code on every input, returning a list of outputs. '''
+    return BatchRunner(code, tape_size, eof).run(inputs)
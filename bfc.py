@@ -9,12 +9,484 @@ __author__ = "iivlx - iivlx@iivlx.com"
 __date__ = (7,10,2019) #d,m,y
 __version__ = (0,0,1) #0.0.1
 
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
 from bfclex import Lexer
 from bfcparse import Parser
+import bfclex
+import bfcparse
 from bfcg import BFCodeGenerator
+import bfcg
+import bfconst
+import bfvm
+import bfopt
+import bfalloc
+import bfpe
+import bfcache
+import bfir
+import bfprof
+import bfcost
+
+_toolchain = None
+_toolchain_metrics = None
+_stream_parser = None
+_grammar_hash = None
+_codegen_hash = None
+
+# modules whose changes change what compileSource outputs (see codegenHash)
+CODEGEN_MODULES = (bfclex, bfcparse, bfcg, bfconst, bfopt, bfir, bfvm, bfalloc, bfpe)
+
+# ways of running compiled code: the module whose run takes the code and its
+# input as bytes, imported when it is used
+ENGINES = {
+    'vm': 'bfvm',
+    'jit': 'bfjit',
+    'native': 'bfnative',
+}
+
+def buildToolchain(cache_id='bfc'):
+    ''' Build the lexer and parser, once per process.
+    The parse tables come from rply's on-disk cache (see Parser) when the grammar
+    has not changed, so this is cheap after the first run on a machine. How long
+    that took is kept for the metrics of every compile (see bfmetrics). '''
+    global _toolchain, _toolchain_metrics
+    if _toolchain is None:
+        start = time.perf_counter()
+        lexer = Lexer().buildStreamLexer()
+        built = time.perf_counter()
+        parser_generator = Parser(cache_id=cache_id)
+        parser_generator.parse()
+        parser = parser_generator.buildParser()
+        _toolchain = (lexer, parser)
+        # in the form of bfmetrics.Metrics.phases
+        _toolchain_metrics = {'lexer build': {'seconds': built - start, 'calls': 1},
+                              'parser build': {'seconds': time.perf_counter() - built,
+                                               'calls': 1}}
+    return _toolchain
+
+def streamParser():
+    ''' A parser that evaluates every top level line as soon as it is parsed. '''
+    global _stream_parser
+    if _stream_parser is None:
+        parser_generator = Parser(streaming=True)
+        parser_generator.parse()
+        _stream_parser = parser_generator.buildParser()
+    return _stream_parser
+
+def grammarHash():
+    ''' Hash of the grammar productions, part of the compile cache key. This does
+    not need the parse tables, so a cache hit never builds them. '''
+    global _grammar_hash
+    if _grammar_hash is None:
+        parser_generator = Parser(cache_id=None)
+        parser_generator.parse()
+        _grammar_hash = parser_generator.grammarHash()
+    return _grammar_hash
+
+def codegenHash():
+    ''' Hash of the source of every module that decides the generated code, part
+    of the compile cache key: __version__ and the grammar don't change when code
+    generation does. '''
+    global _codegen_hash
+    if _codegen_hash is None:
+        hasher = hashlib.sha256()
+        for module in CODEGEN_MODULES:
+            with open(module.__file__, 'rb') as file:
+                hasher.update(file.read())
+        _codegen_hash = hasher.hexdigest()
+    return _codegen_hash
+
+def compileSource(code, optimize=False, layout=False, partial=False, source_map=False,
+                  metrics=None):
+    ''' Compile source code and return the code generator holding the brainfsck.
+    optimize: run the peephole optimizer (bfopt)
+    layout: place variables to minimize pointer movement (bfalloc)
+    partial: run everything before the first input at compile time (bfpe)
+    source_map: record a bfprof.SourceMap in code_generator.source_map, it can't be
+                combined with optimize or partial as they rewrite the code
+    metrics: a bfmetrics.Metrics to record every phase of the compile in, call its
+             finish afterwards. The tokens are all read before parsing so the two
+             can be timed apart. '''
+    if source_map and (optimize or partial):
+        raise ValueError("A source map can't be kept through -O or --partial")
+    lexer, parser = buildToolchain()
+    code_generator = BFCodeGenerator()
+    if source_map:
+        code_generator.source_map = bfprof.SourceMap()
+    if metrics is None:
+        phase = contextlib.nullcontext
+        parsed = parser.parse(lexer.lex(code), state=code_generator)
+    else:
+        phase = metrics.phase
+        metrics.toolchain = _toolchain_metrics
+        metrics.watch(code_generator)
+        with metrics.phase('tokenize'):
+            tokens = list(lexer.lex(code))
+        with metrics.phase('parse'):
+            parsed = parser.parse(iter(tokens), state=code_generator)
+        metrics.countTokens(tokens)
+        metrics.countParsed(parsed)
+        del tokens
+    if layout:
+        with phase('layout'):
+            bfalloc.allocate(parsed, code_generator)
+    else:
+        with phase('eval'):
+            bfcparse.run(parsed, code_generator)
+    if partial:
+        with phase('partial'):
+            code_generator.code = bfpe.partialEvaluate(code_generator.code)[0]
+    if optimize:
+        code_generator.code = bfopt.optimize(code_generator.code, metrics=metrics)
+    return code_generator
+
+def compileStream(input, output, chunk_size=1 << 16):
+    ''' Compile source read from the file object input in chunks, writing the
+    brainfsck to output as it is generated. Only the unfinished tail of the source,
+    the current top level line and the variables are held in memory, so sources of
+    any length can be piped through. Returns the code generator. '''
+    lexer = buildToolchain()[0]
+    code_generator = BFCodeGenerator(sink=output)
+    streamParser().parse(lexer.lexFile(input, chunk_size), state=code_generator)
+    code_generator.flush()
+    return code_generator
+
+def stream(args):
+    ''' --stream: compile every source (- for stdin to stdout) without holding it
+    in memory. '''
+    warnings.simplefilter('ignore')
+    failed = 0
+    for source in args.sources:
+        try:
+            if source == '-':
+                compileStream(sys.stdin, sys.stdout)
+                sys.stdout.flush()
+                continue
+            path = outputPath(source, args.output_dir)
+            directory = os.path.dirname(os.path.abspath(path))
+            with open(source, 'r') as input, \
+                 tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as output:
+                try:
+                    compileStream(input, output)
+                except BaseException:
+                    output.close()
+                    os.remove(output.name)
+                    raise
+            os.chmod(output.name, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+            os.replace(output.name, path)
+            print('ok    %-40s -> %s' % (source, path), file=sys.stderr)
+        except Exception as e:
+            failed += 1
+            print('FAIL  %-40s %s: %s' % (source, type(e).__name__, e), file=sys.stderr)
+    return 1 if failed else 0
+
+def profileCommand(args):
+    ''' --profile: compile every source with a source map, run it on stdin and
+    report what each source line executed. '''
+    warnings.simplefilter('ignore')
+    if args.optimize or args.partial:
+        print('-O and --partial rewrite the code, profiling without them', file=sys.stderr)
+    input = sys.stdin.read().encode()
+    failed = 0
+    for source in findSources(args.sources):
+        try:
+            with open(source, 'r') as file:
+                code = file.read()
+            code_generator = compileSource(code, layout=args.layout, source_map=True)
+            profile = bfprof.profile(code_generator.code, code_generator.source_map, input)
+        except Exception as e:
+            failed += 1
+            print('FAIL  %-40s %s: %s' % (source, type(e).__name__, e))
+            continue
+        print('================ %s ================' % source)
+        sys.stdout.flush()
+        sys.stdout.buffer.write(profile.output)
+        print()
+        print(profile.report(code))
+    return 1 if failed else 0
+
+def costCommand(args):
+    ''' --cost: compile every source with a source map and estimate, without
+    running it, how many steps each statement takes. '''
+    warnings.simplefilter('ignore')
+    if args.optimize or args.partial:
+        print('-O and --partial rewrite the code, estimating without them', file=sys.stderr)
+    failed = 0
+    for source in findSources(args.sources):
+        try:
+            with open(source, 'r') as file:
+                code = file.read()
+            code_generator = compileSource(code, layout=args.layout, source_map=True)
+            analysis = bfcost.analyze(code_generator.code, code_generator.source_map,
+                                      code_generator.variables)
+        except Exception as e:
+            failed += 1
+            print('FAIL  %-40s %s: %s' % (source, type(e).__name__, e))
+            continue
+        print('================ %s ================' % source)
+        print(analysis.report(code))
+    return 1 if failed else 0
+
+def findSources(patterns):
+    ''' Expand files, directories (searched for .bfcg files) and glob patterns. '''
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '**', '*.bfcg'), recursive=True))
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                # keep it so it is reported as a failure
+                matches = [pattern]
+        for match in matches:
+            if match not in sources:
+                sources.append(match)
+    return sources
 
-def main():
-    ''' Enter the filename of the code to be compiled...''' # sponge
+def writeAtomic(path, data):
+    ''' Write data to path so that readers only ever see the old or the new file. '''
+    directory = os.path.dirname(os.path.abspath(path))
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+    binary = isinstance(data, bytes)
+    with tempfile.NamedTemporaryFile('wb' if binary else 'w', dir=directory, delete=False) as file:
+        file.write(data)
+    os.chmod(file.name, mode)
+    os.replace(file.name, path)
+
+# what compileFile writes: the output file extension and a function of the code
+# and its variables
+FORMATS = {
+    'bf': ('.bf', lambda code, variables: code),
+    'ir': ('.bfir', lambda code, variables: bfir.dumps(bfir.build(code))),
+    'pack': ('.bfpk', lambda code, variables: _pack(code, variables)),
+}
+
+def _pack(code, variables):
+    import bfpack
+    return bfpack.pack(code, variables)
+
+def outputPath(source, output_dir=None, extension='.bf'):
+    path = os.path.splitext(source)[0] + extension
+    if output_dir is not None:
+        path = os.path.join(output_dir, os.path.basename(path))
+    return path
+
+def compileFile(source, output_dir=None, options={}, cache_dir=None, emit='bf', metrics=None):
+    ''' Compile one source file and write the .bf file (or .bfir or .bfpk, see
+    FORMATS) next to it or to output_dir. With a cache_dir the compiled code is
+    looked up in and stored to that cache (see bfcache). Never raises, errors are
+    returned in the result, and so is the bfalloc report when compiling with
+    layout (None for a cache hit).
+    metrics: keyword arguments for a bfmetrics.Metrics, when given the result has
+             the metrics of the compile (None for a cache hit). '''
+    start = time.perf_counter()
+    extension, convert = FORMATS[emit]
+    result = {'source': source, 'output': outputPath(source, output_dir, extension),
+              'ok': False, 'size': 0, 'error': None, 'cached': False, 'layout': None}
+    try:
+        with open(source, 'r') as file:
+            code = file.read()
+        entry = None
+        if cache_dir is not None:
+            cache = bfcache.Cache(cache_dir)
+            key = bfcache.cacheKey(code, __version__, grammarHash(), options, codegenHash())
+            entry = cache.get(key)
+            result['cached'] = entry is not None
+        if entry is None:
+            recorder = None
+            if metrics is not None:
+                import bfmetrics
+                recorder = bfmetrics.Metrics(**metrics)
+            code_generator = compileSource(code, metrics=recorder, **options)
+            if recorder is not None:
+                result['metrics'] = recorder.finish()
+            result['layout'] = code_generator.layout_report
+            entry = {'code': code_generator.code, 'variables': code_generator.variables}
+            if cache_dir is not None:
+                cache.put(key, entry['code'], entry['variables'])
+        output = convert(entry['code'], entry['variables'])
+        writeAtomic(result['output'], output)
+        result['ok'] = True
+        result['size'] = len(output)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _initWorker():
+    ''' Every worker process builds the lexer and parser once, up front. '''
+    warnings.simplefilter('ignore')
+    buildToolchain()
+
+def compileFiles(sources, output_dir=None, options={}, jobs=None, cache_dir=None, emit='bf',
+                 metrics=None):
+    ''' Compile many files on a process pool, yielding each result as it is done.
+    jobs=1 compiles in this process. '''
+    if jobs == 1:
+        _initWorker()
+        for source in sources:
+            yield compileFile(source, output_dir, options, cache_dir, emit, metrics)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker) as pool:
+        futures = [pool.submit(compileFile, source, output_dir, options, cache_dir, emit, metrics)
+                   for source in sources]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def batch(args):
+    ''' Compile every source given on the command line and print a summary. '''
+    sources = findSources(args.sources)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    options = {'optimize': args.optimize, 'layout': args.layout, 'partial': args.partial}
+    cache_dir = None if args.no_cache else args.cache_dir
+    metrics = None if args.metrics is None else {'memory': args.metrics_memory}
+    start = time.perf_counter()
+    failed = 0
+    total = 0
+    hits = 0
+    recorded = {}
+    for result in compileFiles(sources, args.output_dir, options, args.jobs, cache_dir, args.emit,
+                               metrics):
+        if metrics is not None:
+            recorded[result['source']] = result.get('metrics')
+        if result['ok']:
+            total += result['size']
+            hits += result['cached']
+            print('%-5s %-40s %8d bytes %9.1f ms  -> %s' % ('hit' if result['cached'] else 'ok',
+                  result['source'], result['size'], result['seconds'] * 1000, result['output']))
+            if result['layout'] is not None:
+                print('      layout: %(declaration)d pointer moves in declaration order, '
+                      '%(optimized)d laid out, %(saved)d saved' % result['layout'])
+        else:
+            failed += 1
+            print('FAIL  %-40s %s' % (result['source'], result['error']))
+    print('%d compiled (%d from cache), %d failed, %d bytes in %.2f s' % (len(sources) - failed,
+          hits, failed, total, time.perf_counter() - start))
+    if cache_dir is not None:
+        cache = bfcache.Cache(cache_dir, args.cache_size * 1024 * 1024)
+        cache.record(hits, len(sources) - failed - hits)
+        cache.prune()
+    if metrics is not None:
+        writeAtomic(args.metrics, json.dumps({'options': options, 'sources': recorded}, indent=1))
+    return 1 if failed else 0
+
+def cacheCommand(args):
+    ''' --cache-stats and --cache-prune '''
+    cache = bfcache.Cache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.cache_prune:
+        max_age = None if args.max_age is None else args.max_age * 24 * 60 * 60
+        print('removed %d entries' % cache.prune(max_age=max_age))
+    if args.cache_stats:
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        print('%s: %d entries, %d bytes, %d hits, %d misses (%.0f%% hit rate)' % (args.cache_dir,
+              stats['entries'], stats['bytes'], stats['hits'], stats['misses'],
+              100.0 * stats['hits'] / lookups if lookups else 0))
+    return 0
+
+def argumentParser():
+    parser = argparse.ArgumentParser(description='Compile bfc sources into brainfsck.')
+    parser.add_argument('sources', nargs='*',
+                        help='files, directories or glob patterns, without any the '
+                             'compiler asks for a file and prints its debug output')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='write the .bf files here instead of next to the sources')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='run the peephole optimizer on the output')
+    parser.add_argument('--layout', action='store_true',
+                        help='place variables to minimize pointer movement')
+    parser.add_argument('--partial', action='store_true',
+                        help='run everything before the first input at compile time')
+    parser.add_argument('--emit', choices=sorted(FORMATS), default='bf',
+                        help='write brainfsck (.bf), the structured IR as JSON (.bfir) '
+                             'or packed bytecode (.bfpk, see bfpack) (default: %(default)s)')
+    parser.add_argument('--cache-dir', default=bfcache.DEFAULT_DIRECTORY,
+                        help='compile cache location (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always compile, without reading or writing the cache')
+    parser.add_argument('--cache-size', type=int, default=bfcache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='size limit of the cache in MB, least recently used entries '
+                             'are removed after every batch (default: %(default)s)')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print cache hit/miss totals and size')
+    parser.add_argument('--cache-prune', action='store_true',
+                        help='remove cache entries over the size limit or older than --max-age')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='with --cache-prune, remove entries unused for this many days')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='write the time of every compile phase and optimizer pass, '
+                             'token and node counts and the commands and pointer moves '
+                             'of every code generator method as JSON (see bfmetrics)')
+    parser.add_argument('--metrics-memory', action='store_true',
+                        help='with --metrics, also measure the memory of every phase '
+                             '(slower)')
+    parser.add_argument('--stream', action='store_true',
+                        help='compile each source (- for stdin, written to stdout) a chunk '
+                             'at a time, writing the output as it is generated')
+    parser.add_argument('--profile', action='store_true',
+                        help='run every source on stdin and report the commands, pointer '
+                             'moves and loop iterations of each source line')
+    parser.add_argument('--cost', action='store_true',
+                        help='estimate the steps of every statement without running the '
+                             'program, as polynomials in the variables loops run on')
+    parser.add_argument('--serve', action='store_true',
+                        help='run the compile server, bfclient.py sends it sources '
+                             '(uses -j workers)')
+    parser.add_argument('--socket', default=None,
+                        help='the Unix socket --serve listens on (default: bfc.sock in '
+                             '$XDG_RUNTIME_DIR, or in a bfc-<uid> directory in the temp '
+                             'directory)')
+    parser.add_argument('--run', action='store_true',
+                        help='execute the compiled program (interactive mode only), '
+                             'it reads its input from stdin (as it arrives with the vm engine)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='vm',
+                        help='what --run executes the program with (default: %(default)s)')
+    return parser
+
+def main(argv=None):
+    ''' With sources on the command line compile them all, see batch. Without any,
+    enter the filename of the code to be compiled...''' # sponge
+    parser = argumentParser()
+    args = parser.parse_args(argv)
+    if args.serve:
+        import bfclient
+        import bfserver
+        return bfserver.serve(args.socket or bfclient.DEFAULT_SOCKET, args.jobs)
+    if args.stream:
+        if not args.sources:
+            parser.error('--stream needs sources, use - for stdin')
+        if args.optimize or args.layout or args.partial or args.emit != 'bf':
+            parser.error('-O, --layout, --partial and --emit need the whole program, '
+                         'they can\'t be used with --stream')
+        return stream(args)
+    if args.profile and args.sources:
+        return profileCommand(args)
+    if args.cost and args.sources:
+        return costCommand(args)
+    if args.sources:
+        status = batch(args)
+        if args.cache_stats or args.cache_prune:
+            cacheCommand(args)
+        return status
+    if args.cache_stats or args.cache_prune:
+        return cacheCommand(args)
+    
     code = ''''''
     
     filename = input("bfc>")
@@ -22,29 +494,59 @@ def main():
     with open(filename, 'r') as file:
         code = file.read()
     
-    lexer = Lexer().buildLexer()
-    parser_generator = Parser()
-    parser_generator.parse()
-    parser = parser_generator.buildParser()
+    lexer, parser = buildToolchain()
     
     code_generator = BFCodeGenerator()
     
     print("================ TOKENS ================")
-    for token in lexer.lex(code):
+    tokens = list(lexer.lex(code))
+    for token in tokens:
         print(token)
     
     print("================ PARSED ================")
-    tokens = lexer.lex(code)
-    parsed = parser.parse(tokens, state=code_generator)
+    parsed = parser.parse(iter(tokens), state=code_generator)
     print(parsed)
     
     print("================ EVAL ================")
     
-    for e in parsed:
-        e.eval()
+    if args.layout:
+        report = bfalloc.allocate(parsed, code_generator)
+        print("pointer moves: declaration order %d, optimized layout %d, saved %d" % (
+              report['declaration'], report['optimized'], report['saved']))
+    else:
+        for e in parsed:
+            e.eval()
     
     print(code_generator.variables)
     print(code_generator.code)
     
+    if args.partial:
+        print("================ PARTIAL EVAL ================")
+        code_generator.code, report = bfpe.partialEvaluate(code_generator.code)
+        print("prefix size %d -> %d, steps %d -> %d, %d bytes of output folded" % (
+              report['size'] + report['steps'] + (report['output'],)))
+        print(code_generator.code)
+    
+    if args.optimize:
+        print("================ OPTIMIZE ================")
+        optimizer = bfopt.Optimizer()
+        code_generator.code = optimizer.optimize(code_generator.code)
+        print(optimizer.summary())
+        print(code_generator.code)
+    
+    if args.run:
+        print("================ RUN ================")
+        if args.engine == 'vm':
+            # stream, so programs that answer their input line by line can be talked to
+            import bfio
+            sys.stdout.flush()
+            bfio.run(bfio.Program(code_generator.code), bfio.LineInput(sys.stdin),
+                     bfio.BufferedOutput(sys.stdout.buffer, 'line'))
+        else:
+            engine = importlib.import_module(ENGINES[args.engine])
+            output = engine.run(code_generator.code, sys.stdin.read().encode())
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+    
 if __name__=='__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the compilation cache for bfc. Compiled brainfsck is stored on disk under
+a key made from everything that decides the output: the source, the compiler
+version, the grammar, the source of the code generation modules and the compile
+options. A hit skips lexing, parsing and evaluation entirely.
+
+Entries live in <directory>/objects/<first 2 hex digits>/<key>.json. Every hit
+touches the entry's modification time, so pruning to a size limit drops the
+least recently used entries first.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from appdirs import AppDirs
+
+DEFAULT_DIRECTORY = os.path.join(AppDirs('bfc').user_cache_dir, 'compile')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# writes go through temp files named like this, prune removes ones older than
+# STALE_TEMP seconds that a crashed process left behind
+TEMP_PREFIX = 'tmp'
+STALE_TEMP = 3600
+
+def cacheKey(source, version, grammar_hash, options, codegen_hash=None):
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([list(version), grammar_hash, sorted(options.items()),
+                              codegen_hash]).encode())
+    hasher.update(b'\0')
+    hasher.update(source.encode())
+    return hasher.hexdigest()
+
+def _writeJson(path, data):
+    ''' Write data to path atomically, the temp file is removed if it fails. '''
+    f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), prefix=TEMP_PREFIX,
+                                    delete=False)
+    try:
+        with f:
+            json.dump(data, f)
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+class Cache:
+    ''' An on disk store of compiled programs.
+    hits and misses count the lookups made through this object, the totals over
+    every run are kept in stats.json (see record and stats). '''
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'objects', key[:2], key + '.json')
+
+    def get(self, key):
+        ''' The stored entry for key, or None. '''
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, code, variables):
+        ''' Store compiled code and its metadata. Writes are atomic so that
+        several processes can share one cache. '''
+        path = self._path(key)
+        entry = {'code': code, 'variables': variables, 'size': len(code),
+                 'created': time.time()}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _writeJson(path, entry)
+        except OSError:
+            pass # a cache that can't be written is just a slower compile
+        return entry
+
+    def entries(self):
+        ''' (path, size, last used) for every entry, least recently used first. '''
+        found = []
+        objects = os.path.join(self.directory, 'objects')
+        if not os.path.isdir(objects):
+            return found
+        for prefix in os.scandir(objects):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    found.append((entry.path, stat.st_size, stat.st_mtime))
+        found.sort(key=lambda e: e[2])
+        return found
+
+    def _temps(self):
+        ''' Paths of the temp files left in the cache directories. '''
+        directories = [self.directory]
+        objects = os.path.join(self.directory, 'objects')
+        if os.path.isdir(objects):
+            directories += [prefix.path for prefix in os.scandir(objects) if prefix.is_dir()]
+        found = []
+        for directory in directories:
+            try:
+                found += [entry.path for entry in os.scandir(directory)
+                          if entry.name.startswith(TEMP_PREFIX) and entry.is_file()]
+            except OSError:
+                pass
+        return found
+
+    def prune(self, max_bytes=None, max_age=None):
+        ''' Remove entries not used for max_age seconds, then the least recently
+        used ones until the cache fits in max_bytes (default: the cache's limit).
+        Temp files older than STALE_TEMP are removed too. Returns the number of
+        entries removed. '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(size for path, size, used in entries)
+        now = time.time()
+        removed = 0
+        for path, size, used in entries:
+            if not (max_age is not None and now - used > max_age or total > max_bytes):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        for path in self._temps():
+            try:
+                if now - os.stat(path).st_mtime > STALE_TEMP:
+                    os.remove(path)
+            except OSError:
+                pass
+        return removed
+
+    def _statsPath(self):
+        return os.path.join(self.directory, 'stats.json')
+
+    def record(self, hits, misses):
+        ''' Add hits and misses to the totals in stats.json. '''
+        totals = self.stats()
+        totals['hits'] += hits
+        totals['misses'] += misses
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            _writeJson(self._statsPath(), {'hits': totals['hits'], 'misses': totals['misses']})
+        except OSError:
+            pass
+
+    def stats(self):
+        ''' Hit and miss totals over every run, plus the current entries and bytes. '''
+        totals = {'hits': 0, 'misses': 0}
+        try:
+            with open(self._statsPath()) as f:
+                totals.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        entries = self.entries()
+        totals['entries'] = len(entries)
+        totals['bytes'] = sum(size for path, size, used in entries)
+        return totals
@@ -4,6 +4,25 @@
 This is code generator for bfc. 
 '''
 
+import bfconst
+
+# divmod with the pointer on n and the cells n, d, 0, 0, 0, 0: one pass takes 1
+# from n and d and counts it in the third cell, when d reaches 0 it is given
+# back the count and the fourth cell counts a whole d. Leaves 0, d - n % d, n % d,
+# n / d, 0, 0 with the pointer back on the first cell, d = 0 works as 256.
+DIVMOD = '[->->+<[>>>]>[[-<+>]>+>>]<<<<<]'
+
+# the same for d >= 2 (the one on the esolangs wiki), 3 commands shorter a pass
+DIVMOD_CONSTANT = '[->-[>+>>]>[+[-<+>]>+>>]<<<<<]'
+
+# with the pointer on x and the cells x, y, 0, 0: takes 1 from x and from y
+# while y isn't zero, until x is zero. Leaves 0, y - x (0 if x >= y), 0, 0.
+LESS = '[->>+<[->-]>[->]<<<]'
+
+class Cell(int):
+    ''' A memory cell given by its position rather than a variable name, used
+    for scratch cells. '''
+
 class BFCodeGenerator:
     ''' This is the core of bfc that will actually compile the command into brainfsck.
     It holds the state (and positions in memory) of variables and cell positions.
@@ -11,134 +30,708 @@ class BFCodeGenerator:
     Most of the brainfsck algorithms are really simple, for a list of more complex
     brainfsck algorithms see https://esolangs.org/wiki/Brainfuck_algorithms
     '''
-    def __init__(self):
+    def __init__(self, sink=None, flush_size=1 << 16, layout=None):
         ''' Initial state of the program
         code: holds brainfsck commands
         cell_index: the current memory cell index needed by the compiler to ensure 
                     variables are pointing to the correct place in memory.
         variables: a list of the variables from the source files and their memory 
                    cell positions.
+        sink: an optional file-like object (anything with a write method), pending
+              code is written to it every flush_size commands and on flush().
+        layout: optional preset cell positions for variables (see bfalloc), any
+                variable not in it is given the next free cell.
+        accesses: set to a list to record the name of every variable moveTo visits.
+        layout_report: set by bfalloc.allocate, the pointer moves the declaration
+                       order and the chosen layout emit and how many were saved.
+        pinned: variables printnum was called on, it uses the 9 cells to the right
+                of the variable as scratch space.
+        emitted: the number of commands emitted so far, flushed or not.
+        source_map: set to a bfprof.SourceMap to record which statement emitted
+                    each range of code (see bfcparse.run) and the trace points.
+        
+        Scratch cells for ifs and prints are allocated by the generator (see acquire)
+        and are Cell numbers rather than variable names, every method that takes a
+        variable also accepts a Cell.
+        scratch: every cell that has been used as scratch space.
+        free: scratch cells that are not in use, they can be given out again.
+        clean: scratch cells that are known to hold zero.
+        reserved: cells that printnum uses, nothing else may be put there.
+        work_cell: the first of 10 reserved cells, zero between statements, that
+                   divmod, less and printnum use when they need cells next to each
+                   other (see _workArea).
+        
+        ranges: {variable: (low, high)} for variables whose value is known to be
+                in a smaller range than 0-255 at this point of the program, so
+                printnum and mul can pick cheaper code. Only straight line code
+                is followed, every loop forgets everything (see loopOpen).
+        specialize: set to False to ignore ranges.
         '''
-        self.code = ""
+        self.chunks = []
+        self.pending = 0
+        self.sink = sink
+        self.flush_size = flush_size
         self.cell_index = 0;
         self.variables = {}
+        self.layout = layout or {}
+        self.accesses = None
+        self.layout_report = None
+        self.pinned = set()
+        self.emitted = 0
+        self.source_map = None
+        self.specialize = True
+        self._resetCells()
+    
+    def _resetCells(self):
+        self.taken = set(self.layout.values())
+        self.next_cell = 0
+        self.scratch = set()
+        self.free = set()
+        self.clean = set()
+        self.reserved = set()
+        self.loops = []
+        self.blocks = []
+        self.work_cell = None
+        self.ranges = {}
+    
+    def reset(self, layout=None):
+        ''' Clear the generated code and variables so the same parse tree can be
+        evaluated again, optionally with a new layout. '''
+        self.code = ''
+        self.emitted = 0
+        self.cell_index = 0
+        self.variables = {}
+        self.layout = layout or {}
+        self.pinned = set()
+        self._resetCells()
+        if self.accesses is not None:
+            self.accesses = []
+        if self.source_map is not None:
+            self.source_map.clear()
+    
+    @property
+    def code(self):
+        ''' The brainfsck commands that have not been flushed to the sink yet.
+        Without a sink this is the whole program. '''
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+    
+    @code.setter
+    def code(self, value):
+        self.chunks = [value] if value else []
+        self.pending = len(value)
+        
+    def emit(self, commands):
+        ''' Append brainfsck commands to the output buffer. '''
+        self.chunks.append(commands)
+        self.pending += len(commands)
+        self.emitted += len(commands)
+        if self.sink is not None and self.pending >= self.flush_size:
+            self.flush()
+    
+    def flush(self):
+        ''' Write any pending code to the sink. '''
+        if self.sink is None or not self.chunks:
+            return
+        self.sink.write(''.join(self.chunks))
+        self.chunks = []
+        self.pending = 0
         
     def assign(self, var, value):
         if var in self.variables:
             self.zero(var) # zero the variable before we assign a new number
         else:
             # create a new variable
-            self.variables[var] = len(self.variables)
+            self.variables[var] = self._newCell(var)
+            # a new cell is zero, but the next time around a loop it holds whatever
+            # was left in it
+            if not self.loops:
+                self._setRange(var, 0, 0)
         self.increment(var, amount=value)        
 
+    def _result(self, var):
+        ''' Create var if it is new and set it to zero, for statements that assign
+        their results. '''
+        if var not in self.variables:
+            self.variables[var] = self._newCell(var)
+            if not self.loops:
+                self._setRange(var, 0, 0)
+                return
+        self.zero(var)
+
+    def _range(self, var):
+        ''' The smallest and largest value var can hold here. '''
+        if not self.specialize:
+            return (0, 255)
+        return self.ranges.get(var, (0, 255))
+
+    def _setRange(self, var, low, high):
+        if isinstance(var, Cell):
+            return
+        if 0 <= low and high <= 255 and (low, high) != (0, 255):
+            self.ranges[var] = (low, high)
+        else:
+            self.ranges.pop(var, None)
+
+    def _shiftRange(self, var, amount):
+        low, high = self.ranges.get(var, (0, 255))
+        if low == high:
+            self._setRange(var, (low + amount) % 256, (low + amount) % 256)
+        else:
+            # a range that wraps around is all of 0-255
+            amount = bfconst.signed(amount % 256)
+            self._setRange(var, low + amount, high + amount)
+
+    def _newCell(self, var=None):
+        ''' The lowest cell nobody has used yet, or the cell the layout gives var. '''
+        if var in self.layout:
+            return self.layout[var]
+        while self.next_cell in self.taken:
+            self.next_cell += 1
+        cell = self.next_cell
+        self.taken.add(cell)
+        self.next_cell += 1
+        return cell
+
+    def _cell(self, var):
+        if isinstance(var, Cell):
+            return var
+        return self.variables[var]
+
+    def _nearestScratch(self, target):
+        ''' The cost (distance, plus the [-] if it may not be zero) and cell of the
+        best scratch cell for target, the cell is None if a new one would be used. '''
+        best = None
+        for cell in self.free:
+            cost = abs(cell - target) + (0 if cell in self.clean else 3)
+            if best is None or cost < best[0]:
+                best = (cost, cell)
+        while self.next_cell in self.taken:
+            self.next_cell += 1
+        if best is None or abs(self.next_cell - target) < best[0]:
+            return (abs(self.next_cell - target), None)
+        return best
+
+    def acquire(self, near=None):
+        ''' Get a scratch cell that holds zero, as close to the variable near as
+        possible. A free scratch cell is reused if one is closer than a new cell
+        (counting the [-] needed if it is not known to be zero). '''
+        target = self.cell_index if near is None else self._cell(near)
+        cost, cell = self._nearestScratch(target)
+        if cell is None:
+            cell = Cell(self._newCell())
+            self.scratch.add(cell)
+            self.clean.add(cell)
+            return cell
+        self.free.discard(cell)
+        if cell not in self.clean:
+            self.zero(cell)
+        return cell
+
+    def _acquirePair(self, near):
+        ''' Two scratch cells next to each other that hold zero, as close to near
+        as possible, for loops that go back and forth between them. '''
+        target = self._cell(near)
+        while self.next_cell in self.taken:
+            self.next_cell += 1
+        best = None
+        if self.next_cell + 1 not in self.taken:
+            best = (abs(self.next_cell - target), None)
+        for cell in self.free:
+            if cell + 1 in self.free:
+                cost = abs(cell - target) + sum(0 if c in self.clean else 3 for c in (cell, cell + 1))
+                if best is None or cost < best[0]:
+                    best = (cost, cell)
+        if best is None:
+            first = self.acquire(near)
+            return first, self.acquire(first)
+        if best[1] is None:
+            pair = (Cell(self._newCell()), Cell(self._newCell()))
+            self.scratch.update(pair)
+            self.clean.update(pair)
+            return pair
+        pair = (Cell(best[1]), Cell(best[1] + 1))
+        for cell in pair:
+            self.free.discard(cell)
+            if cell not in self.clean:
+                self.zero(cell)
+        return pair
+
+    def release(self, cell):
+        ''' Give a scratch cell back as soon as it is dead. '''
+        self.free.add(cell)
+
     def increment(self, var, amount=1):
-        self.moveTo(var)
-        for i in range(0,amount):
-            self.code += '+'
+        self.addConstant(var, amount)
 
     def decrement(self, var, amount=1):
+        self.addConstant(var, -amount)
+        
+    def addConstant(self, var, amount):
+        ''' Add amount to a cell (mod 256) with the shortest code bfconst knows,
+        which may be a multiplication loop over a scratch cell. '''
+        cost, a, b, c = bfconst.table()[amount % 256]
+        if a:
+            distance, cell = self._nearestScratch(self._cell(var))
+            # the table assumes the scratch cell is next to var
+            if cost + 4 * (distance - 1) < abs(bfconst.signed(amount)):
+                temp = self.acquire(var)
+                self._addLoop(var, amount, temp)
+                self.release(temp)
+                return
+        self._addDirect(var, amount)
+
+    def _addVia(self, var, amount, temp):
+        ''' addConstant with a given zero cell for the loop, used if it is
+        shorter. '''
+        cost, a, b, c = bfconst.table()[amount % 256]
+        distance = abs(self._cell(temp) - self._cell(var))
+        if a and cost + 4 * (distance - 1) < abs(bfconst.signed(amount)):
+            self._addLoop(var, amount, temp)
+        else:
+            self._addDirect(var, amount)
+
+    def _addLoop(self, var, amount, temp):
+        cost, a, b, c = bfconst.table()[amount % 256]
+        ranges = self.ranges
+        self._addDirect(temp, a)
+        self.loopOpen(temp)
+        self._addDirect(var, b)
+        self._addDirect(temp, -1)
+        self.loopEnd(temp)
+        self._addDirect(var, c)
+        # the loop only changed var
+        self.ranges = ranges
+        self._shiftRange(var, amount)
+
+    def _addDirect(self, var, amount):
+        ''' Add amount with a plain run of + or -, whichever is shorter. '''
         self.moveTo(var)
-        for i in range(0,amount):
-            self.code += '-'
+        self.clean.discard(self.cell_index)
+        self.emit(bfconst.direct(bfconst.signed(amount)))
+        self._shiftRange(var, amount)
         
     def moveTo(self, var):
         ''' "moves to" the memory cell of a variable '''
-        cell = self.variables[var]
+        if self.accesses is not None and not isinstance(var, Cell):
+            self.accesses.append(var)
+        cell = self._cell(var)
         index = self.cell_index
         if cell > index:
-            for i in range(cell-index):
-                self.code += '>'
-                self.cell_index += 1
+            self.emit('>' * (cell-index))
         elif cell < index:
-            for i in range(index-cell):
-                self.code += '<'
-                self.cell_index -= 1
+            self.emit('<' * (index-cell))
+        self.cell_index = cell
                 
     def zero(self, var):
         self.moveTo(var)
-        self.code += '[-]'
+        self.emit('[-]')
+        self._setRange(var, 0, 0)
+        if self.cell_index in self.scratch:
+            self.clean.add(self.cell_index)
         
     def printascii(self, var):
         self.moveTo(var)
-        self.code += '.'
+        self.emit('.')
     
-    def printchar(self, char,  temp):
-        temp = 'temp1'
-        self.zero(temp)
+    def printchar(self, char):
+        temp = self.acquire()
         self.increment(temp, amount=char)
-        self.code += '.'
+        self.emit('.')
+        self.release(temp)
         
-    def printstr(self, string, temp):
+    def printstr(self, string):
         ''' print a string
-        will change the values of the cell temp'''
-        # first we zero the cell
-        self.zero(temp)
-        current = 0
-        for c in string:
-            new = ord(c) - current
-            if new > 0:
-                self.increment(temp, new)
-            elif new < 0:
-                self.decrement(temp, abs(new))
-            current = current + new
-            
-            self.printascii(temp)
+        The whole string is planned by bfconst.planString, which sets up several
+        cells with one multiplication loop and prints each character from the
+        cell that is cheapest to get to it. '''
+        cost, counter, factors, steps = bfconst.planString(string)
+        ranges = self.ranges
+        count = self.acquire()
+        cells = []
+        for f in factors:
+            cells.append(self.acquire(cells[-1] if cells else count))
+        if counter:
+            self._addDirect(count, counter)
+            self.loopOpen(count)
+            for cell, f in zip(cells, factors):
+                self._addDirect(cell, f)
+            self._addDirect(count, -1)
+            self.loopEnd(count)
+        # the counter is zero again and can be used by addConstant
+        self.release(count)
+        for i, delta in steps:
+            self.addConstant(cells[i], delta)
+            self.printascii(cells[i])
+        for cell in cells:
+            self.release(cell)
+        # only scratch cells were used
+        self.ranges = ranges
         
-    def printnum(self, var, temp):
-        ''' This algorithmm will take the cell value and print the ascii values of the digits '''
-        self.moveTo(var)
-        self.code += '''[>>+>+<<<-]>>>[<<<+>>>-]<<+>[<->[>++++++++++<[->-[>+>>]>[+[-<+>]>+>>]<<<<<]>[-]++++++++[<++++++>-]>[<<+>>-]>[<<+>>-]<<]>]<[->>++++++++[<++++++>-]]<[.[-]<]<'''
-        #self.code += '''>>++++++++++<<[->+>-[>+>>]>[+[-<+>]>+>>]<<<<<<]>>[-]>>>++++++++++<[->-[>+>>]>[+[-<+>]>+>>]<<<<<]>[-]>>[>++++++[-<++++++++>]<.<<+>+>[-]]<[<[->-<]++++++[->++++++++<]>.[-]]<<++++++[-<++++++++>]<.[-]<<[-<+>]<'''    
-                
+    def printnum(self, var):
+        ''' This algorithmm will take the cell value and print the ascii values of the digits 
+        When the range of the value is known (see ranges) cheaper code is used: a
+        known value is printed as a string, a single digit by adding '0' to it and
+        two digits with a single division by 10 instead of two.
+        Otherwise it needs the 9 cells to the right of the value to be zero and
+        leaves them zero, if something else lives there the value is moved to the
+        work area first (see _printDigits). '''
+        low, high = self._range(var)
+        if low == high:
+            self.printstr(str(low))
+            return
+        if high < 10:
+            self.addConstant(var, ord('0'))
+            self.printascii(var)
+            self.addConstant(var, -ord('0'))
+            return
+        ranges = self.ranges
+        self._printNumber(var, 2 if high < 100 else 3)
+        self.ranges = ranges
+
+    def _printDigits(self, var, first, digits):
+        ''' Print var with up to 2 or 3 digits, dividing by 10 with DIVMOD in the
+        cells from first on (6 for 2 digits, 9 for 3), which must be zero apart
+        from first when it is var's own cell. The ones end up in the third cell
+        and the quotient in the fourth, dividing that again puts the tens in the
+        sixth and the hundreds in the seventh. var is put back together from the
+        digits as they are printed, which leaves the cells zero. The cells that
+        are zero by then serve the loops adding '0' and the places. '''
+        cells = [Cell(first + i) for i in range(9 if digits == 3 else 6)]
+        # with var in place the cell after it is next to it and zero
+        spare = None
+        if first != self._cell(var):
+            self.copy(var, [cells[0]])
+        else:
+            spare = cells[1]
+        self.addConstant(cells[1], 10)
+        self.moveTo(cells[0])
+        self.emit(DIVMOD_CONSTANT)
+        self.zero(cells[1])
+        ones, tens = cells[2], cells[3]
+        if digits == 3:
+            self.addConstant(cells[4], 10)
+            self.moveTo(cells[3])
+            self.emit(DIVMOD_CONSTANT)
+            self.zero(cells[4])
+            tens, hundreds, shown, digit = cells[5], cells[6], cells[7], cells[8]
+            self.loopOpen(hundreds)
+            self._showDigit(hundreds, shown)
+            self._restoreDigit(hundreds, var, 100, spare)
+            self.increment(shown)
+            self.loopEnd(hundreds)
+            # the tens are shown when they or the hundreds aren't zero
+            self.loopOpen(tens)
+            self.increment(shown)
+            self.copy(tens, [digit])
+            self.loopEnd(tens)
+            self.loopOpen(shown)
+            self.zero(shown)
+            self._showDigit(digit, shown)
+            self.loopEnd(shown)
+            self._restoreDigit(digit, var, 10, spare)
+        else:
+            self.loopOpen(tens)
+            self._showDigit(tens, cells[4])
+            self._restoreDigit(tens, var, 10, spare)
+            self.loopEnd(tens)
+        self._showDigit(ones, cells[1])
+        self._restoreDigit(ones, var, 1)
+
+    def _showDigit(self, cell, temp):
+        ''' Print the digit in cell, temp is a zero cell for adding '0'. '''
+        self._addVia(cell, ord('0'), temp)
+        self.printascii(cell)
+        self._addVia(cell, -ord('0'), temp)
+
+    def _restoreDigit(self, cell, var, place, temp=None):
+        ''' Add the digit in cell times place to var, leaving cell zero. '''
+        self.loopOpen(cell)
+        self.decrement(cell)
+        if temp is None:
+            self.increment(var, place)
+        else:
+            self._addVia(var, place, temp)
+        self.loopEnd(cell)
+
+    def _printNumber(self, var, digits):
+        self.pinned.add(var)
+        cell = self._cell(var)
+        window = range(cell + 1, cell + 10)
+        def usable(c):
+            if c not in self.free:
+                return False
+            # inside a loop (or if) a scratch cell zeroed here is still dirty on
+            # the paths that skip the body, it must have been zero all along
+            return not self.loops or c in self.clean and all(
+                c in clean or c >= next_cell for free_clean, clean, next_cell in self.loops)
+        if all(c not in self.taken or c in self.reserved or usable(c) for c in window):
+            # free scratch cells in the way are zeroed and handed over to printnum
+            for c in window:
+                if c in self.free:
+                    if c not in self.clean:
+                        self.zero(Cell(c))
+                    self.free.discard(c)
+                    self.scratch.discard(c)
+            self.reserved.update(window)
+            self.taken.update(window)
+            self._printDigits(var, cell, digits)
+            return
+        self._printDigits(var, self._workArea(), digits)
+
+    def _workArea(self):
+        ''' The first of 10 cells after every cell in use, reserved the first time
+        it is needed. Whatever uses them leaves them zero again. '''
+        if self.work_cell is None:
+            base = max(self.taken | {self.next_cell}) + 1
+            self.work_cell = Cell(base)
+            self.reserved.update(range(base, base + 10))
+            self.taken.update(range(base, base + 10))
+        return self.work_cell
+
+    def trace(self, value, variable=False):
+        ''' The trace statement. With a source map this records a trace point at the
+        current position, the profiler samples the variable's cell every time the
+        program passes it. Without one the value is printed while compiling. '''
+        if self.source_map is None:
+            print(value)
+            return
+        cell = self._cell(value) if variable and value in self.variables else None
+        self.source_map.trace(self.emitted, cell, str(value))
+
     def readascii(self, var):
         self.moveTo(var)
-        self.code += ','
+        self.emit(',')
+        self._setRange(var, 0, 255)
         
     def add(self, var, var2):
-        self.loopOpen(var)
-        self.decrement(var)
-        self.increment(var2)
-        self.loopEnd(var)        
+        self.copy(var, [var2])
 
     def copy(self, var, others):
+        ranges = dict(self.ranges)
+        low, high = self.ranges.get(var, (0, 255))
         self.loopOpen(var)
         self.decrement(var)
         for c in others:
             self.increment(c)
         self.loopEnd(var)
+        self.ranges = ranges
+        for c in others:
+            other_low, other_high = self.ranges.get(c, (0, 255))
+            self._setRange(c, other_low + low, other_high + high)
+        self._setRange(var, 0, 0)
+
+    def mul(self, var, var2, result):
+        ''' result = var * var2 (mod 256), var and var2 are kept.
+        The outer loop counts down the operand known to be smaller and restores it
+        afterwards, the inner one adds a copy of the other operand to result and
+        puts it back. A constant operand is added straight from the outer loop. '''
+        (low, high), (low2, high2) = self._range(var), self._range(var2)
+        # a result in var2 is cheaper than one in var (see below), that comes
+        # before counting down the smaller operand
+        if low2 != high2 and (low == high or result == var != var2 or
+                              result != var2 and high2 < high):
+            var, var2 = var2, var
+            (low, high), (low2, high2) = (low2, high2), (low, high)
+        ranges = dict(self.ranges)
+        if low == high and low2 == high2:
+            self._result(result)
+            self.increment(result, low * low2)
+        else:
+            # var is counted down, so a result in var is worked out in a scratch
+            # cell and var is not restored. var2 is only read before the loop, a
+            # result in var2 takes its place once it is copied.
+            alias = result == var2 and var2 != var
+            target = self.acquire(var) if result == var else result
+            if result != var and not alias:
+                self._result(result)
+            if low2 != high2:
+                # the inner loop runs for every unit of the product, so it works
+                # on a copy next to the result rather than on var2
+                factor, temp = self._acquirePair(target)
+                if alias:
+                    self.copy(var2, [factor])
+                else:
+                    self.copy(var2, [factor, temp])
+                    self.copy(temp, [var2])
+            elif alias:
+                self.zero(result)
+            keep = None if result == var else self.acquire(var)
+            self.loopOpen(var)
+            self.decrement(var)
+            if keep is not None:
+                self.increment(keep)
+            if low2 == high2:
+                self.increment(target, low2)
+            else:
+                self.copy(factor, [target, temp])
+                self.copy(temp, [factor])
+            self.loopEnd(var)
+            if keep is not None:
+                self.copy(keep, [var])
+                self.release(keep)
+            if low2 != high2:
+                self.zero(factor)
+                self.release(factor)
+                self.release(temp)
+            if result == var:
+                self.copy(target, [var])
+                self.release(target)
+        self.ranges = ranges
+        if low == high and low2 == high2:
+            self._setRange(result, low * low2 % 256, low * low2 % 256)
+        else:
+            self._setRange(result, low * low2, high * high2)
+
+    def divmod(self, var, var2, quotient, remainder):
+        ''' quotient = var / var2 and remainder = var % var2, var and var2 are kept.
+        Dividing by zero gives 0 and var. The division runs in the work area,
+        one pass of DIVMOD (DIVMOD_CONSTANT by a known divisor) for every unit of
+        var. '''
+        if quotient == remainder:
+            raise ValueError("divmod needs two different variables for its results")
+        (low, high), (low2, high2) = self._range(var), self._range(var2)
+        ranges = dict(self.ranges)
+        work = self._workArea()
+        divisor, rest, counted = (Cell(work + i) for i in (1, 2, 3))
+        # an operand that is also a result is moved rather than copied
+        results = (quotient, remainder)
+        if low2 == high2:
+            self.addConstant(divisor, low2)
+        elif var2 in results and var2 != var:
+            self.copy(var2, [divisor])
+        else:
+            self.copy(var2, [divisor, rest])
+            self.copy(rest, [var2])
+        if var in results:
+            self.copy(var, [work])
+        else:
+            self.copy(var, [work, rest])
+            self.copy(rest, [var])
+        self.moveTo(work)
+        self.emit(DIVMOD_CONSTANT if low2 == high2 >= 2 else DIVMOD)
+        self.zero(divisor)
+        self._result(quotient)
+        self._result(remainder)
+        self.copy(counted, [quotient])
+        self.copy(rest, [remainder])
+        self.ranges = ranges
+        if low2 > 0:
+            self._setRange(quotient, low // high2, high // low2)
+            self._setRange(remainder, 0, min(high, high2 - 1))
+        else:
+            self._setRange(quotient, 0, high)
+            self._setRange(remainder, 0, high)
+
+    def less(self, var, var2, result):
+        ''' result = 1 if var < var2 else 0, var and var2 are kept.
+        Copies of both count down together in the work area (see LESS), what is
+        left of var2 is not zero if it was bigger. '''
+        ranges = dict(self.ranges)
+        work = self._workArea()
+        left, flag = Cell(work + 1), Cell(work + 2)
+        self.copy(var, [work, flag])
+        self.copy(flag, [var])
+        self.copy(var2, [left, flag])
+        self.copy(flag, [var2])
+        self.moveTo(work)
+        self.emit(LESS)
+        self._result(result)
+        self.loopOpen(left)
+        self.zero(left)
+        self.increment(result)
+        self.loopEnd(left)
+        self.ranges = ranges
+        self._setRange(result, 0, 1)
+
+    def equal(self, var, var2, result):
+        ''' result = 1 if var == var2 else 0, var and var2 are kept. '''
+        ranges = dict(self.ranges)
+        difference = self.acquire(var)
+        temp = self.acquire(var)
+        # difference = var2 - var
+        self.loopOpen(var)
+        self.decrement(var)
+        self.increment(temp)
+        self.decrement(difference)
+        self.loopEnd(var)
+        self.copy(temp, [var])
+        self.copy(var2, [difference, temp])
+        self.copy(temp, [var2])
+        self._result(result)
+        self.increment(result)
+        self.loopOpen(difference)
+        self.zero(difference)
+        self.decrement(result)
+        self.loopEnd(difference)
+        self.release(difference)
+        self.release(temp)
+        self.ranges = ranges
+        self._setRange(result, 0, 1)
         
     def loopOpen(self, var):
+        ''' Scratch cells that are free and zero when the loop starts must be zero
+        again at the end of every iteration, remember which ones they are.
+        Nothing is known about the values of variables in the body, it may run
+        after itself. Methods that know what their own loops change put ranges
+        back afterwards. '''
+        self.ranges = {}
+        self.loops.append((self.free & self.clean, set(self.clean), self.next_cell))
         self.moveTo(var)
-        self.code += '['
+        self.emit('[')
         
     def loopEnd(self, var):
+        free_clean, clean, next_cell = self.loops.pop()
+        # cells created inside the loop were zero when it started as well
+        created = {c for c in self.scratch if c >= next_cell}
+        for cell in sorted(self.free - self.clean):
+            if cell in free_clean or cell in created:
+                self.zero(cell)
         self.moveTo(var)
-        self.code += ']'
+        self.emit(']')
+        # after the loop a cell is only known to be zero if it was before the loop
+        # and still is at the end of the body
+        self.clean = free_clean | (clean & self.clean) | (created & self.free)
+        if self.cell_index in self.scratch:
+            self.clean.add(self.cell_index)
+        # the body may not have run at all, all that is known is that var is zero
+        self.ranges = {}
+        self._setRange(var, 0, 0)
                 
-    def ifOpen(self, var, temp):
-        self.zero(temp)
+    def ifOpen(self, var):
+        ''' if var: ... endif;
+        The body runs inside a loop on var, which ends by moving var into a temp so
+        the loop exits on the same cell whether or not it was entered. '''
+        temp = self.acquire(var)
+        self.blocks.append(temp)
         self.loopOpen(var)
         
-    def ifEnd(self, var, temp):
-        self.loopEnd(temp)
-        self.moveTo(var)
+    def ifEnd(self, var):
+        temp = self.blocks.pop()
+        self.copy(var, [temp])
+        self.loopEnd(var)
+        self.copy(temp, [var])
+        self.release(temp)
         
-    def ifElseOpen(self, var, temp0, temp1):
-        self.zero(temp0)
-        self.increment(temp0)
-        self.zero(temp1)
+    def ifElseOpen(self, var):
+        flag = self.acquire(var)
+        spare = self.acquire(var)
+        self.blocks.append((flag, spare))
+        self.increment(flag)
         self.loopOpen(var)
     
-    def ifElse(self, var, temp0, temp1):
-        self.decrement(temp0)
-        self.copy(var, [temp1])
+    def ifElse(self, var):
+        flag, spare = self.blocks[-1]
+        self.decrement(flag)
+        self.copy(var, [spare])
         self.loopEnd(var)
-        self.copy(temp1, [var])
-        self.loopOpen(temp0)   
+        self.copy(spare, [var])
+        self.loopOpen(flag)   
     
-    def ifElseEnd(self, var, temp0, temp1):
-        self.decrement(temp0)
-        self.loopEnd(temp0)
-        
-        
-        
\ No newline at end of file
+    def ifElseEnd(self, var):
+        flag, spare = self.blocks.pop()
+        self.decrement(flag)
+        self.loopEnd(flag)
+        self.release(flag)
+        self.release(spare)
@@ -2,9 +2,120 @@
 
 ''' bfc
 This is the lexer for bfc. It is used to tokenize the source file.
+
+StreamLexer gives the same tokens as the rply lexer built from the same rules,
+but matches all of them with a single regular expression and can read its
+source in chunks.
 '''
 
+import re
+
 from rply import LexerGenerator
+from rply.errors import LexingError
+from rply.token import SourcePosition, Token
+
+# what the text after a token has to be for the token to be final, see _final
+_LINE_END = re.compile(r'[^\n]*\n')
+# the rest of the line, the next line with something on it and the start of the
+# one after that: as far as a comment can go (its .+ takes one line, and blank
+# lines can come before it and between it and the closing //)
+_COMMENT_END = re.compile(r'[^\n]*\n\s*\S[^\n]*\n\s*\S[\s\S]')
+_NOT_WORD = re.compile(r'\W')
+# a line break followed by as much as a comment needs: every token ending
+# before it is final, so only the last lines need _final
+_SETTLED = re.compile(r'\n\s*\S[^\n]*\n\s*\S[\s\S]')
+
+def _final(buffer, start, end):
+    ''' Whether the match from start to end in buffer (or no match, with end ==
+    start) stays the same however the source goes on. Strings and comments are
+    greedy and can end anywhere on their line (comments a few lines on), every
+    other rule is a word, a run of word characters or whitespace, or at most
+    three characters long, so it is decided by the first character after it
+    that is not a word character. '''
+    first = buffer[start]
+    if first == '"':
+        return _LINE_END.match(buffer, start) is not None
+    if buffer.startswith('//', start):
+        return _COMMENT_END.match(buffer, start) is not None
+    return _NOT_WORD.search(buffer, max(end, start + 2)) is not None
+
+def _settled(buffer):
+    ''' The index in buffer before which tokens are final. '''
+    end = len(buffer)
+    while True:
+        newline = buffer.rfind('\n', 0, end)
+        if newline < 0:
+            return 0
+        if _SETTLED.match(buffer, newline):
+            return newline
+        end = newline
+
+class StreamLexer:
+    ''' Tokenizes with the rules of an rply LexerGenerator, trying them in the same
+    order (ignored patterns first) so the tokens are identical. '''
+    def __init__(self, rules, ignore_rules):
+        self.names = {}
+        alternatives = []
+        for index, rule in enumerate(ignore_rules):
+            self.names['i%d' % index] = None
+            alternatives.append('(?P<i%d>%s)' % (index, rule.re.pattern))
+        for index, rule in enumerate(rules):
+            self.names['t%d' % index] = rule.name
+            alternatives.append('(?P<t%d>%s)' % (index, rule.re.pattern))
+        self.regex = re.compile('|'.join(alternatives))
+
+    def lex(self, source):
+        ''' Tokens of a whole source string. '''
+        return self.lexChunks((source,))
+
+    def lexFile(self, file, chunk_size=1 << 16):
+        ''' Tokens of a file object, read chunk_size characters at a time. '''
+        return self.lexChunks(iter(lambda: file.read(chunk_size), ''))
+
+    def lexChunks(self, chunks):
+        ''' Tokens of a source given as an iterable of strings. A token that could
+        still grow or change with the next chunk is held back until it is read, so
+        only the unfinished tail of the source is kept in memory: a token is
+        final as soon as something that can't extend it follows, on the same line
+        or not, except that strings and comments need the rest of their line. '''
+        match = self.regex.match
+        names = self.names
+        buffer = ''
+        base = 0            # source index of buffer[0]
+        i = 0
+        lineno = 1
+        last_newline = -1   # source index of the last line break before i
+        chunks = iter(chunks)
+        done = False
+        while not done:
+            chunk = next(chunks, None)
+            if chunk is None:
+                done = True
+                settled = len(buffer)
+            else:
+                buffer = buffer[i:] + chunk
+                base += i
+                i = 0
+                settled = _settled(buffer)
+            while i < len(buffer):
+                found = match(buffer, i)
+                if found is None:
+                    if done or i < settled or _final(buffer, i, i):
+                        raise LexingError(None, SourcePosition(base + i, lineno,
+                                                               base + i - last_newline))
+                    break
+                start, end = found.span()
+                if end > settled and not _final(buffer, start, end):
+                    break
+                name = names[found.lastgroup]
+                if name is not None:
+                    yield Token(name, found.group(), SourcePosition(base + start, lineno,
+                                                                    base + start - last_newline))
+                lines = buffer.count('\n', start, end)
+                if lines:
+                    lineno += lines
+                    last_newline = base + buffer.rindex('\n', start, end)
+                i = end
 
 class Lexer:
     def __init__(self):
@@ -42,6 +153,12 @@ class Lexer:
         self.lexer.add('READINT', r'readint')
         self.lexer.add('ADD', r'add')
         self.lexer.add('COPY', r'copy')
+        # whole words only, so they don't take the start of identifiers like
+        # multiplier or lessons (the keywords above do)
+        self.lexer.add('MUL', r'mul\b')
+        self.lexer.add('DIVMOD', r'divmod\b')
+        self.lexer.add('LESS', r'less\b')
+        self.lexer.add('EQUAL', r'equal\b')
         
         # debug
         self.lexer.add('TRACE', r'trace')
@@ -61,4 +178,8 @@ class Lexer:
         
     def buildLexer(self):
         self._add_tokens()
-        return self.lexer.build()
\ No newline at end of file
+        return self.lexer.build()
+
+    def buildStreamLexer(self):
+        self._add_tokens()
+        return StreamLexer(self.lexer.rules, self.lexer.ignore_rules)
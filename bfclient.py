@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the client of the bfc compile server (see bfserver). It only imports
+what it needs to talk to the server, so it starts quickly, and when no server is
+running it compiles in its own process instead.
+
+Messages are JSON, each preceded by its length as a 4 byte big endian number. A
+request is
+
+    {"source": "...", "emit": "bf" or "ir",
+     "options": {"optimize": false, "layout": false, "partial": false}}
+
+and its response
+
+    {"code": "..." or null, "error": null or "...", "diagnostics": ["...", ...],
+     "seconds": time spent compiling}
+
+Any number of requests can be sent on one connection, responses come back in
+the same order. They may be sent before the earlier responses have been read,
+the server works on them at the same time.
+
+    python3 bfclient.py [-O] [--layout] [--partial] [--emit ir] [-o dir]
+                        [--socket path] [--no-fallback] sources...
+'''
+
+import argparse
+import collections
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+def socketDirectory():
+    ''' $XDG_RUNTIME_DIR, or else a bfc-<uid> directory in the temp directory that
+    the server creates for this user only. '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return runtime
+    # tempfile.gettempdir() without importing tempfile, which alone doubles the
+    # start up time of this module
+    return os.path.join(os.environ.get('TMPDIR') or '/tmp', 'bfc-%d' % os.getuid())
+
+DEFAULT_SOCKET = os.path.join(socketDirectory(), 'bfc.sock')
+MAX_MESSAGE = 1 << 30
+
+# the output file extensions of the text formats of bfc.FORMATS, without importing
+# bfc
+EXTENSIONS = {'bf': '.bf', 'ir': '.bfir'}
+
+def send(connection, message):
+    data = json.dumps(message).encode()
+    connection.sendall(struct.pack('>I', len(data)) + data)
+
+def _read(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            if chunks:
+                raise ConnectionError("Connection closed in the middle of a message")
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def receive(connection):
+    ''' The next message, or None if the other side closed the connection. '''
+    header = _read(connection, 4)
+    if header is None:
+        return None
+    size, = struct.unpack('>I', header)
+    if size > MAX_MESSAGE:
+        raise ValueError("Message of %d bytes is too big" % size)
+    data = _read(connection, size) if size else b''
+    if data is None:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return json.loads(data)
+
+def checkOwner(path):
+    ''' Raise PermissionError unless path belongs to this user, so a socket someone
+    else put where ours should be is never connected to or removed. '''
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError("%s belongs to another user" % path)
+
+def privateDirectory(path):
+    ''' Create the directory path for this user only, or check that it is. '''
+    os.makedirs(path, 0o700, exist_ok=True)
+    checkOwner(path)
+    if os.stat(path).st_mode & 0o077:
+        raise PermissionError("%s can be used by other users" % path)
+
+def request(source, options={}, emit='bf'):
+    return {'source': source, 'options': dict(options), 'emit': emit}
+
+class Client:
+    ''' A connection to a running server, raises OSError if there is none or if
+    the socket belongs to another user. '''
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        try:
+            checkOwner(path)
+            self.connection.connect(path)
+        except OSError:
+            self.connection.close()
+            raise
+
+    def compile(self, source, options={}, emit='bf'):
+        ''' Compile source on the server and return the response. '''
+        return next(self.compileMany([request(source, options, emit)]))
+
+    def compileMany(self, requests, window=16):
+        ''' Send requests, keeping up to window of them on the server at once, and
+        yield the responses in order. '''
+        waiting = collections.deque()
+        requests = iter(requests)
+        while True:
+            while len(waiting) < window:
+                message = next(requests, None)
+                if message is None:
+                    break
+                send(self.connection, message)
+                waiting.append(message)
+            if not waiting:
+                return
+            response = receive(self.connection)
+            if response is None:
+                raise ConnectionError("The server closed the connection")
+            waiting.popleft()
+            yield response
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def connect(path=DEFAULT_SOCKET):
+    ''' A Client of the server listening on path, or None if none is. '''
+    try:
+        return Client(path)
+    except OSError:
+        return None
+
+def compileLocal(message):
+    ''' Answer a request in this process, the way the server would. '''
+    import bfserver
+    return bfserver.compileRequest(message)
+
+def compileAll(requests, path=DEFAULT_SOCKET, fallback=True, window=16):
+    ''' Yield (response, True if the server answered it) for every request. Without
+    a server, or if it goes away, the rest are compiled in this process unless
+    fallback is False, in which case OSError is raised. '''
+    requests = list(requests)
+    done = 0
+    client = connect(path)
+    if client is not None:
+        with client:
+            try:
+                for response in client.compileMany(requests, window):
+                    done += 1
+                    yield response, True
+            except OSError:
+                if not fallback:
+                    raise
+    elif not fallback:
+        raise ConnectionRefusedError("No compile server is listening on %s" % path)
+    for message in requests[done:]:
+        yield compileLocal(message), False
+
+def writeAtomic(path, data):
+    ''' bfc.writeAtomic, without importing bfc or tempfile. '''
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as file:
+        file.write(data)
+    os.chmod(temporary, mode)
+    os.replace(temporary, path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile bfc sources on the compile server, '
+                                                 'or in this process if none is running.')
+    parser.add_argument('sources', nargs='+', help='.bfcg files')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='write the output here instead of next to the sources')
+    parser.add_argument('-O', dest='optimize', action='store_true')
+    parser.add_argument('--layout', action='store_true')
+    parser.add_argument('--partial', action='store_true')
+    parser.add_argument('--emit', choices=sorted(EXTENSIONS), default='bf')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='where the server listens (default: %(default)s)')
+    parser.add_argument('--no-fallback', action='store_true',
+                        help='fail instead of compiling here when there is no server')
+    args = parser.parse_args(argv)
+    options = {'optimize': args.optimize, 'layout': args.layout, 'partial': args.partial}
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    requests = []
+    sources = []
+    failed = 0
+    for source in args.sources:
+        try:
+            with open(source, 'r') as file:
+                requests.append(request(file.read(), options, args.emit))
+            sources.append(source)
+        except OSError as e:
+            failed += 1
+            print('FAIL  %-40s %s: %s' % (source, type(e).__name__, e))
+    served = 0
+    compiled = 0
+    try:
+        for source, (response, remote) in zip(sources, compileAll(requests, args.socket,
+                                                                  not args.no_fallback)):
+            served += remote
+            for diagnostic in response['diagnostics']:
+                print('%s: %s' % (source, diagnostic), file=sys.stderr)
+            if response['error'] is not None:
+                failed += 1
+                print('FAIL  %-40s %s' % (source, response['error']))
+                continue
+            output = os.path.splitext(source)[0] + EXTENSIONS[args.emit]
+            if args.output_dir is not None:
+                output = os.path.join(args.output_dir, os.path.basename(output))
+            writeAtomic(output, response['code'])
+            compiled += 1
+            print('%-5s %-40s %8d bytes %9.1f ms  -> %s' % ('ok', source, len(response['code']),
+                  response['seconds'] * 1000, output))
+    except OSError as e:
+        print('%s: %s' % (type(e).__name__, e), file=sys.stderr)
+        return 1
+    print('%d compiled (%d by the server), %d failed in %.2f s' % (compiled, served, failed,
+          time.perf_counter() - start))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the constant synthesizer for bfc. It finds short brainfsck code to put a
+known value into a cell.
+
+Cells wrap around at 256, so adding d to a cell is the same as subtracting
+256 - d, and the code that takes a cell from a to b only depends on the delta
+(b - a) % 256. The table therefore has one entry per delta and covers every one
+of the 256 * 256 byte transitions: table()[(b - a) % 256] takes a to b. Each
+entry is either a plain run of + or -, or a multiplication loop using a zero
+scratch cell. Its cost counts the scratch cell as the next one, the code
+generator adds 4 moves for every cell further away:
+
+    >  +*a  [  <  (+ or -)*b  >  -  ]  <  (+ or -)*c
+
+The table is built once and cached on disk.
+'''
+
+import json
+import os
+import tempfile
+
+from appdirs import AppDirs
+
+VERSION = 1
+
+# [ - ] and the four moves between the cell and its scratch cell
+LOOP_OVERHEAD = 7
+
+_table = None
+
+def signed(delta):
+    ''' The shortest run of + (positive) or - (negative) that adds delta. '''
+    delta %= 256
+    return delta if delta <= 128 else delta - 256
+
+def direct(delta):
+    return '+' * delta if delta > 0 else '-' * -delta
+
+def buildTable():
+    ''' For every delta find (cost, a, b, c) where cost is the length of the code,
+    a is the loop count (0 means a plain run of c), b the signed amount added per
+    iteration and c the signed correction after the loop. '''
+    # cheapest loop that lands exactly on each value
+    exact = [None] * 256
+    for a in range(2, 128):
+        for b in range(1, 128):
+            cost = a + b + LOOP_OVERHEAD
+            for sign in (1, -1):
+                value = (a * b * sign) % 256
+                if exact[value] is None or cost < exact[value][0]:
+                    exact[value] = (cost, a, b * sign)
+    table = []
+    for delta in range(256):
+        c = signed(delta)
+        best = (abs(c), 0, 0, c)
+        for value in range(256):
+            if exact[value] is None:
+                continue
+            cost, a, b = exact[value]
+            correction = signed(delta - value)
+            total = cost + abs(correction)
+            if total < best[0]:
+                best = (total, a, b, correction)
+        table.append(best)
+    return table
+
+def _cacheFile():
+    return os.path.join(AppDirs('bfc').user_cache_dir, 'bfconst-%d.json' % VERSION)
+
+def table():
+    ''' The delta table, loaded from the disk cache or built and saved there. '''
+    global _table
+    if _table is not None:
+        return _table
+    path = _cacheFile()
+    try:
+        with open(path) as f:
+            _table = [tuple(entry) for entry in json.load(f)]
+        if len(_table) == 256:
+            return _table
+    except (OSError, ValueError):
+        pass
+    _table = buildTable()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+            json.dump(_table, f)
+        os.replace(f.name, path)
+    except OSError:
+        pass # read only cache, just rebuild next time
+    return _table
+
+def _clusters(values, k):
+    ''' Split values into k groups with a few rounds of 1-D k-means, returning
+    the centre of each group. '''
+    values = sorted(values)
+    centres = [values[(2 * i + 1) * len(values) // (2 * k)] for i in range(k)]
+    for i in range(8):
+        groups = [[] for c in centres]
+        for v in values:
+            groups[min(range(k), key=lambda j: abs(centres[j] - v))].append(v)
+        centres = [sum(g) / len(g) if g else c for g, c in zip(groups, centres)]
+    return centres
+
+def _planCost(values, counter, factors):
+    ''' Cost of printing values from len(factors) cells to the right of a loop
+    counter, which starts the cells at counter * factor each. Returns the cost and
+    the (cell, delta) steps, cells are numbered from 0 for the one next to the
+    counter. '''
+    cells = [(counter * f) % 256 for f in factors]
+    total = 0
+    if counter:
+        total = counter + 3 + sum(factors) + 2 * len(factors)
+    position = -1 # the counter
+    steps = []
+    for v in values:
+        best = None
+        for i, current in enumerate(cells):
+            delta = (v - current) % 256
+            entry = table()[delta]
+            step = abs(i - position) + entry[0] + (4 * i if entry[1] else 0)
+            if best is None or step < best[0]:
+                best = (step, i, delta)
+        step, i, delta = best
+        total += step + 1
+        cells[i] = v
+        position = i
+        steps.append((i, signed(delta)))
+    return total, steps
+
+def planString(string, max_cells=4):
+    ''' Plan how to print string using up to max_cells cells next to a counter
+    cell. Returns (cost, counter, factors, steps): the cells are first set up with
+    one loop running counter times that adds factors[i] to cell i, then each step
+    (i, delta) adds delta to cell i and prints it. '''
+    values = [ord(c) % 256 for c in string]
+    best = None
+    if not values:
+        return (0, 0, [], [])
+    distinct = sorted(set(values))
+    for k in range(1, min(max_cells, len(distinct)) + 1):
+        centres = _clusters(distinct, k)
+        for counter in [0] + list(range(4, 17)):
+            if counter:
+                factors = [max(1, int(round(c / counter))) for c in centres]
+            else:
+                factors = [0] * k
+            total, steps = _planCost(values, counter, factors)
+            if best is None or total < best[0]:
+                best = (total, counter, factors, steps)
+    return best
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the static cost model for bfc. It estimates how many brainfsck steps a
+compiled program takes and how many tape cells it touches, without running it.
+
+The generated code is walked with an abstract tape where every cell is either a
+known value or an unknown one named after the variable it belongs to (input read
+with , is unknown, so is anything computed from it). Code that only depends on
+known values is costed exactly, loops on known values are followed iteration by
+iteration. A loop on an unknown cell is costed once per iteration with the cells
+its body writes treated as unknown, and its iteration count becomes a symbol:
+
+    x       a loop that changes its cell by a constant odd amount each time
+            around, it runs up to 255 times, x stands for the value of the
+            variable x when the loop starts
+    ?x      a loop whose body clears its cell (like the one an if compiles to),
+            it runs 0 or 1 times
+
+so the cost of every statement is a polynomial in those symbols, for example
+12 + 31*x. Loops that can't be bounded like that (the cell doesn't change by a
+known amount) are marked unbounded. Symbols with the same name stand for the
+value of that variable at different points, so bounds are upper bounds.
+
+Costs are attributed to source statements through the source map (see bfprof).
+'''
+
+import bfprof
+
+# symbol -> the largest value it can take
+LOOP = 255
+CONDITION = 1
+
+class Cost:
+    ''' A polynomial: {monomial (sorted tuple of symbols): coefficient}. '''
+    def __init__(self, terms=None):
+        self.terms = dict(terms or {})
+
+    def add(self, monomial, amount):
+        self.terms[monomial] = self.terms.get(monomial, 0) + amount
+
+    def merge(self, other):
+        for monomial, amount in other.terms.items():
+            self.add(monomial, amount)
+
+    def bounds(self, ranges):
+        ''' The smallest and largest value, every symbol between 0 and its range. '''
+        low = self.terms.get((), 0)
+        high = 0
+        for monomial, amount in self.terms.items():
+            value = amount
+            for symbol in monomial:
+                value *= ranges.get(symbol, LOOP)
+            high += value
+        return low, high
+
+    def isExact(self):
+        return all(not monomial for monomial in self.terms)
+
+    def __str__(self):
+        parts = []
+        for monomial, amount in sorted(self.terms.items(), key=lambda t: (len(t[0]), t[0])):
+            if not amount:
+                continue
+            if not monomial:
+                parts.append('%d' % amount)
+            else:
+                parts.append('*'.join(([str(amount)] if amount != 1 else []) + list(monomial)))
+        return ' + '.join(parts) or '0'
+
+class _Unknown:
+    ''' An unknown cell value, named after where it came from, plus a known offset
+    so that the change a loop body makes to its own cell can be found. '''
+    __slots__ = ('name', 'offset')
+    def __init__(self, name, offset=0):
+        self.name = name
+        self.offset = offset % 256
+
+class Analysis:
+    ''' The estimate for one program.
+    statements: (line, kind, Cost, unbounded) for every statement of the source map,
+                in code order.
+    total: the Cost of the whole program.
+    cells: the number of tape cells the program touches.
+    ranges: how far each symbol can go, see Cost.bounds. '''
+    def __init__(self, code, source_map, variables, budget=1000000):
+        self.runs, trailing = bfprof._runs(code, source_map)
+        self.source_map = source_map
+        self.names = {cell: name for name, cell in variables.items()}
+        self.budget = budget
+        self.tape = {}
+        self.pointer = 0
+        self.cells = 1
+        self.costs = {}
+        self.unbounded = set()
+        self.ranges = {}
+        self.writes = None
+        self._block(0, len(self.runs), (), True)
+        self.statements = []
+        self.total = Cost()
+        for index, (start, end, line, kind) in enumerate(source_map.ranges):
+            cost = self.costs.get(index, Cost())
+            self.statements.append((line, kind, cost, index in self.unbounded))
+            self.total.merge(cost)
+        if -1 in self.costs:
+            self.total.merge(self.costs[-1])
+
+    def _name(self, cell):
+        return self.names.get(cell, 'cell%d' % cell)
+
+    def _record(self, owner, weight, count):
+        cost = self.costs.get(owner)
+        if cost is None:
+            cost = self.costs[owner] = Cost()
+        cost.add(weight, count)
+
+    def _write(self, cell, value):
+        self.tape[cell] = value
+        if self.writes is not None:
+            self.writes.add(cell)
+
+    def _block(self, start, end, weight, record):
+        ''' Walk runs[start:end], adding their cost times the monomial weight. '''
+        runs = self.runs
+        i = start
+        while i < end:
+            c, count, jump, owner, traces = runs[i]
+            if record:
+                self._record(owner, weight, count)
+            if c == '+' or c == '-':
+                value = self.tape.get(self.pointer, 0)
+                amount = count if c == '+' else -count
+                if isinstance(value, _Unknown):
+                    self._write(self.pointer, _Unknown(value.name, value.offset + amount))
+                else:
+                    self._write(self.pointer, (value + amount) % 256)
+            elif c == '>':
+                self.pointer += count
+                self.cells = max(self.cells, self.pointer + 1)
+            elif c == '<':
+                self.pointer -= count
+            elif c == ',':
+                self._write(self.pointer, _Unknown(self._name(self.pointer)))
+            elif c == '[':
+                self._loop(i, jump, weight, record)
+                i = jump
+            i += 1
+
+    def _snapshot(self):
+        return dict(self.tape), self.pointer, {k: Cost(v.terms) for k, v in self.costs.items()}, \
+               set(self.unbounded), None if self.writes is None else set(self.writes)
+
+    def _restore(self, snapshot):
+        self.tape, self.pointer, self.costs, self.unbounded, self.writes = snapshot
+        self.tape = dict(self.tape)
+
+    def _loop(self, open, close, weight, record):
+        value = self.tape.get(self.pointer, 0)
+        if value == 0:
+            return
+        close_owner = self.runs[close][3]
+        if not isinstance(value, _Unknown):
+            # known: follow it around while the body can be costed exactly
+            snapshot = self._snapshot()
+            while True:
+                self.budget -= close - open
+                if self.budget < 0:
+                    break
+                self._block(open + 1, close, weight, record)
+                if record:
+                    self._record(close_owner, weight, 1)
+                value = self.tape.get(self.pointer, 0)
+                if value == 0:
+                    return
+                if isinstance(value, _Unknown):
+                    break
+            self._restore(snapshot)
+            value = _Unknown(self._name(self.pointer))
+            self.tape[self.pointer] = value
+        cell = self.pointer
+        entry = dict(self.tape)
+        # first walk: which cells the body writes, and what it does to the loop cell
+        outer_writes = self.writes
+        self.writes = set()
+        self._block(open + 1, close, weight, False)
+        written = self.writes
+        balanced = self.pointer == cell
+        after = self.tape.get(cell, 0)
+        self.tape, self.pointer = dict(entry), cell
+        if after == 0:
+            symbol = '?' + value.name
+            self.ranges[symbol] = CONDITION
+            bounded = True
+        else:
+            symbol = value.name
+            self.ranges.setdefault(symbol, LOOP)
+            bounded = isinstance(after, _Unknown) and after.name == value.name and \
+                      (after.offset - value.offset) % 2 == 1
+        bounded = bounded and balanced
+        if record and not bounded:
+            self.unbounded.add(self.runs[open][3])
+        # second walk: the cost of one iteration from any state the loop can be in
+        for written_cell in written:
+            if written_cell != cell:
+                self.tape[written_cell] = _Unknown(self._name(written_cell))
+        self.tape[cell] = _Unknown(value.name)
+        self.writes = set()
+        inner = tuple(sorted(weight + (symbol,)))
+        self._block(open + 1, close, inner, record)
+        if record:
+            self._record(close_owner, inner, 1)
+        end_state = self.tape
+        self.tape, self.pointer = dict(entry), cell
+        for written_cell in written | self.writes:
+            before, now = entry.get(written_cell, 0), end_state.get(written_cell, 0)
+            if not (isinstance(now, int) and now == before):
+                self.tape[written_cell] = _Unknown(self._name(written_cell))
+        self.tape[cell] = 0
+        self.writes = outer_writes
+        if self.writes is not None:
+            self.writes |= written
+
+    def report(self, source=None):
+        ''' A readable breakdown, most expensive statements first. '''
+        source_lines = source.splitlines() if source is not None else []
+        def text(line):
+            if line is not None and 0 < line <= len(source_lines):
+                return source_lines[line - 1].strip()
+            return ''
+        low, high = self.total.bounds(self.ranges)
+        out = ['%s steps, between %d and %d%s, %d cells' % ('exactly %d' % low
+               if self.total.isExact() else 'estimated', low, high,
+               ' (some loops unbounded)' if self.unbounded else '', self.cells), '',
+               '%6s %-12s %10s %10s  %-30s %s' % ('line', 'kind', 'min', 'max', 'cost', 'source')]
+        rows = []
+        for line, kind, cost, unbounded in self.statements:
+            low, high = cost.bounds(self.ranges)
+            rows.append((high, low, line, kind, str(cost) + (' (unbounded)' if unbounded else '')))
+        rows.sort(key=lambda row: (-row[0], -row[1]))
+        for high, low, line, kind, cost in rows:
+            out.append('%6s %-12s %10d %10d  %-30s %s' % (line, kind, low, high, cost, text(line)))
+        return '\n'.join(out)
+
+def analyze(code, source_map, variables):
+    ''' Estimate the cost of code, compiled with source_map, see Analysis. '''
+    return Analysis(code, source_map, variables)
@@ -4,233 +4,342 @@
 This is the parser for bfc. The source file is tokenized and passed into the
 parser, which will create a parse tree that can be executed to produce
 brainfsck code.
+
+The parse tree is a flat list of statements (loops and ifs are flattened into
+open, body, end), so it is evaluated with a plain loop over the list, and
+expressions are evaluated without recursion. Nodes use __slots__ and statements
+keep identifiers as plain strings, so very large sources stay cheap to hold.
 '''
 
+import hashlib
+import json
+
 from rply import ParserGenerator
-from rply.token import BaseBox
-from numpy.core.fromnumeric import var
 
-class Line(BaseBox):
+class Node:
+    ''' Base of every parse tree node. rply's BaseBox is only needed under
+    RPython, and it has no __slots__. '''
+    __slots__ = ()
+
+def _at(state, node, token):
+    ''' Record the line of token as the source line of the statement node, in the
+    source map of the code generator state if it has one. Nodes don't hold their
+    line, so a parse tree takes no more memory when there is no source map. '''
+    if state.source_map is not None:
+        state.source_map.lines[node] = token.getsourcepos().lineno
+    return node
+
+class Line(Node):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
         
     def eval(self):
         return self.value.eval()
 
-class Number(BaseBox):
+class Number(Node):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
         
     def eval(self):
         return self.value
     
-class Variable(BaseBox):
+class Variable(Node):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
     
     def eval(self):
         return self.value
     
-class String(BaseBox):
+class String(Node):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value[1:-1]
     
     def eval(self):
         return self.value
     
-class Increment(BaseBox):
+class Increment(Node):
+    __slots__ = ('state', 'left', 'right')
     def __init__(self, state, left, right):
         self.state = state
         self.left = left
         self.right = right
     def eval(self):
         # add the right to the left
-        l = self.left.eval()
-        r = self.right.eval()
-        self.state.increment(l, amount=r)
-#         print('Incrementing %s by %d' %(l, r)) # sponge
+        self.state.increment(self.left, amount=self.right.eval())
 
-class Loop(BaseBox):
+class Loop(Node):
+    __slots__ = ('state', 'var')
     def __init__(self, state, var):
         self.state = state
         self.var = var
     def eval(self):
         self.state.loopOpen(self.var.eval())
         
-class LoopEnd(BaseBox):
+class LoopEnd(Node):
+    __slots__ = ('state', 'var')
     def __init__(self, state, var):
         self.state = state
         self.var = var
     def eval(self):
         self.state.loopEnd(self.var.eval())
 
-class IfOpen(BaseBox):
-    def __init__(self, state, var, temp):
+class IfOpen(Node):
+    __slots__ = ('state', 'var')
+    def __init__(self, state, var):
         self.state = state
         self.var = var
-        self.temp = temp
     def eval(self):
-        self.state.ifOpen(self.var.eval(), self.temp.eval())
+        self.state.ifOpen(self.var.eval())
         
-class IfEnd(BaseBox):
-    def __init__(self, state, var, temp):
+class IfEnd(Node):
+    __slots__ = ('state', 'var')
+    def __init__(self, state, var):
         self.state = state
         self.var = var
-        self.temp = temp
     def eval(self):
-        self.state.ifEnd(self.var.eval(), self.temp.eval())
+        self.state.ifEnd(self.var.eval())
     
-class IfElseOpen(BaseBox):
-    def __init__(self, state, var, temp0, temp1):
+class IfElseOpen(Node):
+    __slots__ = ('state', 'var')
+    def __init__(self, state, var):
         self.state = state
         self.var = var
-        self.temp0 = temp0
-        self.temp1 = temp1
     def eval(self):
-        self.state.ifElseOpen(self.var.eval(), self.temp0.eval(), self.temp1.eval())
+        self.state.ifElseOpen(self.var.eval())
         
-class IfElse(BaseBox):
-    def __init__(self, state, var, temp0, temp1):
+class IfElse(Node):
+    __slots__ = ('state', 'var')
+    def __init__(self, state, var):
         self.state = state
         self.var = var
-        self.temp0 = temp0
-        self.temp1 = temp1
     def eval(self):
-        self.state.ifElse(self.var.eval(), self.temp0.eval(), self.temp1.eval())
+        self.state.ifElse(self.var.eval())
 
-class IfElseEnd(BaseBox):
-    def __init__(self, state, var, temp0, temp1):
+class IfElseEnd(Node):
+    __slots__ = ('state', 'var')
+    def __init__(self, state, var):
         self.state = state
         self.var = var
-        self.temp0 = temp0
-        self.temp1 = temp1
     def eval(self):
-        self.state.ifElseEnd(self.var.eval(), self.temp0.eval(), self.temp1.eval())
+        self.state.ifElseEnd(self.var.eval())
             
-class Decrement(BaseBox):
+class Decrement(Node):
+    __slots__ = ('state', 'left', 'right')
     def __init__(self, state, left, right):
         self.state = state
         self.left = left
         self.right = right
     def eval(self):
-        # add the right to the left
-        l = self.left.eval()
-        r = self.right.eval()
-        self.state.decrement(l, amount=r)
-        #print('Decrementing %s by %d' %(l, r))
+        # subtract the right from the left
+        self.state.decrement(self.left, amount=self.right.eval())
 
-class Assignment(BaseBox):
+class Assignment(Node):
+    __slots__ = ('state', 'left', 'right')
     def __init__(self, state, left, right):
         self.state = state
         self.left = left
         self.right = right
     def eval(self):
-        l = self.left.eval()
-        r = self.right.eval()
-        self.state.assign(l, r)
-        # sponge
-#         self.state.variables[l] = len(self.state.variables)
-#         self.state.zero(l)
-#         self.state.increment(l, amount=r)        
-#         print('Assigning %d to %s' % (r, l)) # assign right to left
-
-class Print(BaseBox):
+        self.state.assign(self.left, self.right.eval())
+
+class Print(Node):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
     def eval(self):
         print(self.value.eval())
 
-class PrintI(BaseBox):
+class PrintI(Node):
+    __slots__ = ('state', 'value')
     def __init__(self, state, value):
         self.state = state
         self.value = value
     def eval(self):
         self.state.printascii(self.value)
 
-class PrintNum(BaseBox):
-    def __init__(self, state, value, temp):
+class PrintNum(Node):
+    __slots__ = ('state', 'value')
+    def __init__(self, state, value):
         self.state = state
         self.value = value
-        self.temp = temp
     def eval(self):
-        self.state.printnum(self.value.eval(), self.temp.eval())
+        self.state.printnum(self.value.eval())
 
-class PrintC(BaseBox):
-    def __init__(self, state, value, temp):
+class PrintC(Node):
+    __slots__ = ('state', 'value')
+    def __init__(self, state, value):
         self.state = state
         self.value = value
-        self.temp = temp
     def eval(self):
-        self.state.printchar(self.value.eval(), self.temp.eval())
+        self.state.printchar(self.value.eval())
 
-class PrintS(BaseBox):
-    def __init__(self, state, value, temp):
+class PrintS(Node):
+    __slots__ = ('state', 'value')
+    def __init__(self, state, value):
         self.state = state
         self.value = value
-        self.temp = temp
     def eval(self):
-        self.state.printstr(self.value.eval(), self.temp.eval())
+        self.state.printstr(self.value.eval())
         
-class AddVars(BaseBox):
+class AddVars(Node):
+    __slots__ = ('state', 'left', 'right')
     def __init__(self, state, left, right):
         self.state = state
         self.left = left
         self.right = right
     def eval(self):
-        self.state.add(self.left.eval(), self.right.eval())
+        self.state.add(self.left, self.right)
 
-class Copy(BaseBox):
+class Copy(Node):
+    __slots__ = ('state', 'left', 'others')
     def __init__(self, state, left, others):
         self.state = state
         self.left = left
         self.others = others
     def eval(self):
-        list = []
-        for o in self.others:
-            list.append(o.eval())
-        self.state.copy(self.left.eval(), list)
+        self.state.copy(self.left, list(self.others))
+
+class MulVars(Node):
+    __slots__ = ('state', 'left', 'right', 'result')
+    def __init__(self, state, left, right, result):
+        self.state = state
+        self.left = left
+        self.right = right
+        self.result = result
+    def eval(self):
+        self.state.mul(self.left, self.right, self.result)
+
+class DivMod(Node):
+    __slots__ = ('state', 'left', 'right', 'quotient', 'remainder')
+    def __init__(self, state, left, right, quotient, remainder):
+        self.state = state
+        self.left = left
+        self.right = right
+        self.quotient = quotient
+        self.remainder = remainder
+    def eval(self):
+        self.state.divmod(self.left, self.right, self.quotient, self.remainder)
+
+class Less(Node):
+    __slots__ = ('state', 'left', 'right', 'result')
+    def __init__(self, state, left, right, result):
+        self.state = state
+        self.left = left
+        self.right = right
+        self.result = result
+    def eval(self):
+        self.state.less(self.left, self.right, self.result)
+
+class Equal(Node):
+    __slots__ = ('state', 'left', 'right', 'result')
+    def __init__(self, state, left, right, result):
+        self.state = state
+        self.left = left
+        self.right = right
+        self.result = result
+    def eval(self):
+        self.state.equal(self.left, self.right, self.result)
 
-class Read(BaseBox):
+class Read(Node):
+    __slots__ = ('state', 'var')
     def __init__(self, state, var):
         self.state = state
         self.var = var
     def eval(self):
-        self.state.readascii(self.var.eval())
+        self.state.readascii(self.var)
 
-class Trace(BaseBox):
-    def __init__(self, value):
+class Trace(Node):
+    __slots__ = ('state', 'value')
+    def __init__(self, state, value):
+        self.state = state
         self.value = value
 
     def eval(self):
-        print(self.value.eval())
+        self.state.trace(self.value.eval(), isinstance(self.value, Variable))
         
-class Comment(BaseBox):
+class Comment(Node):
+    __slots__ = ()
     def __init__(self):
         pass
     def eval(self):
         pass
-        
-class BinaryOperation(BaseBox):
+
+def evaluate(expression):
+    ''' The value of an expression tree. Works through an explicit stack so long
+    chains like 1 + 1 + ... + 1 can't overflow Python's. '''
+    values = []
+    stack = [(expression, False)]
+    while stack:
+        node, ready = stack.pop()
+        if not isinstance(node, BinaryOperation):
+            values.append(node.eval())
+        elif ready:
+            right = values.pop()
+            values.append(node.operate(values.pop(), right))
+        else:
+            stack.append((node, True))
+            stack.append((node.right, False))
+            stack.append((node.left, False))
+    return values[0]
+
+class BinaryOperation(Node):
+    __slots__ = ('left', 'right')
     def __init__(self, left, right):
         self.left = left
         self.right = right
+    def eval(self):
+        return evaluate(self)
         
 class Add(BinaryOperation):
-    def eval(self):
-        return self.left.eval() + self.right.eval()
+    __slots__ = ()
+    @staticmethod
+    def operate(left, right):
+        return left + right
 class Sub(BinaryOperation):
-    def eval(self):
-        return self.left.eval() - self.right.eval()
+    __slots__ = ()
+    @staticmethod
+    def operate(left, right):
+        return left - right
 class Mul(BinaryOperation):
-    def eval(self):
-        return self.left.eval() * self.right.eval()
+    __slots__ = ()
+    @staticmethod
+    def operate(left, right):
+        return left * right
 class Div(BinaryOperation):
-    def eval(self):
-        return self.left.eval() / self.right.eval()
+    __slots__ = ()
+    @staticmethod
+    def operate(left, right):
+        return left // right
+
+def run(parsed, code_generator=None):
+    ''' Evaluate a parse tree into the code generator it was parsed with. If that
+    generator is passed in and has a source map, the code every statement emits is
+    recorded against its line and kind. '''
+    source_map = None if code_generator is None else code_generator.source_map
+    if source_map is None:
+        for statement in parsed:
+            statement.eval()
+        return
+    for statement in parsed:
+        start = code_generator.emitted
+        line = source_map.lines.get(statement)
+        source_map.line = line
+        statement.eval()
+        source_map.add(start, code_generator.emitted, line, type(statement).__name__)
 
 class Parser:
-    def __init__(self):
+    def __init__(self, cache_id='bfc', streaming=False):
         ''' Initialize valid tokens
+        cache_id: the LALR tables are cached on disk by rply under this id, keyed on
+                  a hash of the grammar, so they are only built when the productions
+                  change. Pass None to always rebuild them.
+        streaming: evaluate every top level line as soon as it has been parsed and
+                   keep nothing, parse then returns an empty list. Used to compile
+                   sources too big to hold their parse tree.
         todo: dynamic token list'''
         self.pg = ParserGenerator(['NUMBER',
                                    'PLUS', 'MINUS', 'MULTIPLY', 'DIVIDE',
@@ -245,11 +354,14 @@ class Parser:
                                    'PRINT', 'PRINTNUM',
                                    'ADD',
                                    'COPY',
+                                   'MUL', 'DIVMOD', 'LESS', 'EQUAL',
                                    'IDENTIFIER',
                                    'NOP',
                                    'READASCII',
                                    'STRING', 'CHAR',
-                                   'TRACE', 'COMMENT'])
+                                   'TRACE', 'COMMENT'],
+                                  cache_id=cache_id)
+        self.streaming = streaming
         
     def parse(self):
         ''' Parse each line and token of the program into a tree, using the code generator state.
@@ -258,45 +370,58 @@ class Parser:
         @self.pg.production('program : program line')
         @self.pg.production('program : line')
         def p_program(state, p):
-            if len(p) == 1:
-                return [*p[0]]
-            elif len(p) == 2:
-                return [*p[0],*p[1]]
+            if self.streaming:
+                run(p[-1], state)
+                return []
+            # extend the list in place, copying it on every line is quadratic
+            if len(p) == 2:
+                p[0].extend(p[1])
+            return p[0]
 
         @self.pg.production('line : IDENTIFIER EQUALS expression SEMICOLON')
         def p_line(state, p):
-            return Line(p[:-1])
+            return _at(state, Line(p[:-1]), p[0])
         
         @self.pg.production('line : loop COLON loopbody END SEMICOLON')
         def p_line_loop(state, p):
             
-            loop = p[0]
-            loopend = LoopEnd(state, p[0].var)
-            
-            return [loop, *p[2], loopend]
+            body = p[2]
+            body.insert(0, p[0])
+            body.append(_at(state, LoopEnd(state, p[0].var), p[3]))
+            return body
 
         @self.pg.production(' line : if COLON ifbody ELSE ifbody ENDIF SEMICOLON')
         def p_line_if_else(state, p):
-            if_start = IfElseOpen(state, p[0], Variable('temp0'), Variable('temp1'))
-            if_else = IfElse(state, if_start.var, Variable('temp0'), Variable('temp1'))
-            if_end = IfElseEnd(state, if_start.var, Variable('temp0'), Variable('temp1'))
-            return [if_start, *p[2], if_else, *p[4], if_end]
+            if_start = IfElseOpen(state, p[0].var)
+            if state.source_map is not None:
+                lines = state.source_map.lines
+                lines[if_start] = lines.pop(p[0], None)
+            if_else = _at(state, IfElse(state, if_start.var), p[3])
+            if_end = _at(state, IfElseEnd(state, if_start.var), p[5])
+            body = p[2]
+            body.insert(0, if_start)
+            body.append(if_else)
+            body.extend(p[4])
+            body.append(if_end)
+            return body
             #return [Comment()]
 
         @self.pg.production('line : if COLON ifbody ENDIF SEMICOLON')
         def p_line_if(state, p):
-            if_start = IfOpen(state, p[0], Variable('temp0'))
-            if_end = IfEnd(state, if_start.var, Variable('temp0'))
-            return [if_start, *p[2], if_end]
+            if_start = p[0]
+            body = p[2]
+            body.insert(0, if_start)
+            body.append(_at(state, IfEnd(state, if_start.var), p[3]))
+            return body
         
         @self.pg.production('line : COMMENT')
         def p_line_comment(state, p):
-            return [Comment()]
+            return [_at(state, Comment(), p[0])]
         
         @self.pg.production('line : VAR IDENTIFIER SEMICOLON')
         def p_line_var(state, p):
             identifier = p[1].getstr()
-            return [Line(Assignment(state, Variable(identifier), Number(0)))]
+            return [_at(state, Assignment(state, identifier, Number(0)), p[0])]
                 
         @self.pg.production('line : VAR IDENTIFIER PLUSEQUALS expression SEMICOLON')
         @self.pg.production('line : VAR IDENTIFIER MINUSEQUALS expression SEMICOLON')
@@ -305,84 +430,99 @@ class Parser:
             operator = p[2].gettokentype()
             expression = p[3]
             if operator == 'PLUSEQUALS':
-                return [Line(Increment(state, Variable(identifier), expression))]
+                return [_at(state, Increment(state, identifier, expression), p[0])]
             elif operator == 'MINUSEQUALS':
-                return [Line(Decrement(state, Variable(identifier), expression))]
+                return [_at(state, Decrement(state, identifier, expression), p[0])]
         
         @self.pg.production('line : VAR IDENTIFIER EQUALS expression SEMICOLON')
         def p_line_var_equals(state, p):
             identifier = p[1].getstr()
             expression = p[3]
-            return [Line(Assignment(state, Variable(identifier), expression))]
+            return [_at(state, Assignment(state, identifier, expression), p[0])]
         
         @self.pg.production('line : statement SEMICOLON')
         def p_line_statement(state, p):
-            return [Line(p[0])]
+            return [p[0]]
         
         @self.pg.production('statement : ADD IDENTIFIER IDENTIFIER')
         def p_add(state, p):
-            return AddVars(state, Variable(p[1].getstr()), Variable(p[2].getstr()))
+            return _at(state, AddVars(state, p[1].getstr(), p[2].getstr()), p[0])
                 
         @self.pg.production('statement : COPY IDENTIFIER IDENTIFIER IDENTIFIER')
         def p_copy2(state, p):
-            return Copy(state, Variable(p[1].getstr()), (Variable(p[2].getstr()), Variable(p[3].getstr())))
+            return _at(state, Copy(state, p[1].getstr(), (p[2].getstr(), p[3].getstr())), p[0])
         
         @self.pg.production('statement : COPY IDENTIFIER IDENTIFIER')
         def p_copy(state, p):
-            return Copy(state, Variable(p[1].getstr()), (Variable(p[2].getstr()),))
+            return _at(state, Copy(state, p[1].getstr(), (p[2].getstr(),)), p[0])
+
+        @self.pg.production('statement : MUL IDENTIFIER IDENTIFIER IDENTIFIER')
+        def p_mul(state, p):
+            return _at(state, MulVars(state, p[1].getstr(), p[2].getstr(), p[3].getstr()), p[0])
+
+        @self.pg.production('statement : DIVMOD IDENTIFIER IDENTIFIER IDENTIFIER IDENTIFIER')
+        def p_divmod(state, p):
+            return _at(state, DivMod(state, *[token.getstr() for token in p[1:]]), p[0])
+
+        @self.pg.production('statement : LESS IDENTIFIER IDENTIFIER IDENTIFIER')
+        def p_less(state, p):
+            return _at(state, Less(state, p[1].getstr(), p[2].getstr(), p[3].getstr()), p[0])
+
+        @self.pg.production('statement : EQUAL IDENTIFIER IDENTIFIER IDENTIFIER')
+        def p_equal(state, p):
+            return _at(state, Equal(state, p[1].getstr(), p[2].getstr(), p[3].getstr()), p[0])
 
         @self.pg.production('statement : READASCII IDENTIFIER')
         def p_readascii(state, p):
-            return Read(state, Variable(p[1].getstr()))
+            return _at(state, Read(state, p[1].getstr()), p[0])
 
         @self.pg.production('statement : PRINTNUM expression')
         def p_print(state, p):
-            return PrintNum(state, p[1], Variable('temp0'))
+            return _at(state, PrintNum(state, p[1]), p[0])
 
         @self.pg.production('statement : PRINT expression')
         def p_print(state, p):
-            return PrintC(state, p[1], Variable('temp0'))
+            return _at(state, PrintC(state, p[1]), p[0])
         
         @self.pg.production('statement : PRINT string')
         def p_print_s(state, p):
-            return PrintS(state, p[1], Variable('temp0'))
+            return _at(state, PrintS(state, p[1]), p[0])
             
         @self.pg.production('statement : PRINT IDENTIFIER')
         def p_print_v(state, p):
             identifier = p[1].getstr()
-            return PrintI(state, identifier)
+            return _at(state, PrintI(state, identifier), p[0])
             
         @self.pg.production('statement : TRACE IDENTIFIER')
         @self.pg.production('statement : TRACE string')
         @self.pg.production('statement : TRACE expression')
         def p_trace(state, p):
-            #print( p )
-            return Trace(p[1])
-            #return Print(p[1])
+            value = p[1]
+            if not isinstance(value, Node):
+                value = Variable(value.getstr())
+            return _at(state, Trace(state, value), p[0])
             
         @self.pg.production('if : IF expression')
         def p_if(state, p):
-            return p[1]
+            return _at(state, IfOpen(state, p[1]), p[0])
         
         @self.pg.production('ifbody : ifbody line')
         @self.pg.production('ifbody : line')
         def p_ifbody(state, p):
-            if len(p) == 1:
-                return p[0]
-            elif len(p) == 2:
-                return [*p[0],*p[1]]       
+            if len(p) == 2:
+                p[0].extend(p[1])
+            return p[0]       
 
         @self.pg.production('loop : WHILE expression')
         def p__while(state, p):
-            return Loop(state, p[1])
+            return _at(state, Loop(state, p[1]), p[0])
         
         @self.pg.production('loopbody : loopbody line')
         @self.pg.production('loopbody : line')
         def p_loopbody(state, p):
-            if len(p) == 1:
-                return p[0]
-            elif len(p) == 2:
-                return [*p[0],*p[1]]
+            if len(p) == 2:
+                p[0].extend(p[1])
+            return p[0]
         
         @self.pg.production('string : STRING')
         def p_string(state, p):
@@ -400,7 +540,9 @@ class Parser:
                 return Add(left, right)
             if operator.gettokentype() == 'MINUS':
                 return Sub(left, right)
-            return p    
+            if operator.gettokentype() == 'MULTIPLY':
+                return Mul(left, right)
+            return Div(left, right)
 
         @self.pg.production('expression : NUMBER')
         def p_expression_number(state, p):
@@ -418,5 +560,13 @@ class Parser:
         def error_handler(state, token):
             raise ValueError("Ran into a %s where it wasn't expected" % token.gettokentype())
     
+    def grammarHash(self):
+        ''' A hash of the tokens and productions, call after parse(). '''
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps(sorted(self.pg.tokens)).encode())
+        for name, syms, func, precedence in self.pg.productions:
+            hasher.update(json.dumps([name, syms, precedence]).encode())
+        return hasher.hexdigest()
+    
     def buildParser(self):
         return self.pg.build()
\ No newline at end of file
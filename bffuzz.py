@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the differential fuzzer for bfc. It generates random valid programs
+from the grammar of bfcparse.Parser, compiles each with every combination of
+-O, --layout and --partial, and runs the result on every engine. Every run is
+compared against a plain interpreter running the same code one command at a
+time:
+
+    output      everything the program printed
+    tape        the final tape and pointer, for the engines that expose them
+                (the native binaries only report their output)
+    variables   across the optimization levels the tapes differ (--layout moves
+                variables around), so the final value of every variable is
+                compared by name instead
+
+Programs only use declared variables and their whiles count down a counter the
+body never writes, so every program terminates. A case is generated from its
+seed alone, so any failure can be reproduced with --seed. Failures are shrunk
+by removing statements, unwrapping whiles and ifs and simplifying values for as
+long as the same engine still fails.
+
+    python3 bffuzz.py [--count 100000 | --time 28800] [--seed 0] [-j 8]
+                      [--engine vm --engine jit ...] [--save failures/]
+
+Seeds are handed out in chunks to a process pool, a few chunks at a time, so a
+run of millions of cases only holds the chunks in flight.
+'''
+
+import argparse
+import concurrent.futures
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+import bfc
+import bfir
+import bfjit
+import bfnative
+import bfopt
+import bfpe
+import bfvm
+try:
+    import bfbatch
+except ImportError:
+    bfbatch = None
+
+TAPE_SIZE = 4096
+STEP_LIMIT = 2000000
+
+# every combination of the options that change the code, as (optimize, layout, partial)
+LEVELS = list(itertools.product((False, True), repeat=3))
+
+def levelName(optimize, layout, partial):
+    return ' '.join(name for name, on in (('-O', optimize), ('--layout', layout),
+                                          ('--partial', partial)) if on) or 'plain'
+
+NAMES = ['v%d' % i for i in range(8)]
+COUNTERS = ['n%d' % i for i in range(4)]
+# characters for strings, chars and comments, none that would end them early
+TEXT = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,:!?-+*=()'
+
+def interpret(code, input=b'', tape_size=TAPE_SIZE, limit=None):
+    ''' The plain interpreter everything is compared against: one command at a
+    time, nothing merged or fused (bfvm.runPlain). Returns the output, tape and
+    pointer, or None if more than limit commands would be executed. '''
+    result = bfvm.runPlain(code, input, tape_size, limit=limit, merge=False)
+    if result is None:
+        return None
+    output, steps, machine = result
+    return output, bytes(machine.tape), machine.pointer
+
+def _vm(code, input):
+    vm = bfvm.VM(TAPE_SIZE)
+    output = vm.execute(bfvm.lower(code), input)
+    return output, bytes(vm.tape), vm.pointer
+
+def _jit(code, input):
+    program = bfjit.JitProgram(code)
+    output = program.run(input, TAPE_SIZE)
+    bfjit._cache.clear()    # every program is new, don't keep millions of them
+    return output, bytes(program.tape), program.pointer
+
+def _ir(code, input):
+    # through every step of the IR: build, the optimizer passes, JSON and back to text
+    program = bfir.loads(bfir.dumps(bfopt.optimize(bfir.build(code))))
+    vm = bfvm.VM(TAPE_SIZE)
+    output = vm.execute(bfir.ops(bfir.emit(program)), input)
+    return output, bytes(vm.tape), vm.pointer
+
+def _batch(code, input):
+    runner = bfbatch.BatchRunner(code, TAPE_SIZE)
+    output = runner.run([input])[0]
+    return output, runner.tape[0].tobytes(), int(runner.pointer[0])
+
+def _native(code, input):
+    with tempfile.TemporaryDirectory() as directory:
+        output = bfnative.NativeProgram(code, directory, TAPE_SIZE).run(input, timeout=60)
+    return output, None, None
+
+ENGINES = {
+    'vm': _vm,
+    'jit': _jit,
+    'ir': _ir,
+    'batch': _batch,
+    'native': _native,
+}
+
+def availableEngines():
+    ''' The engines that can run here: batch needs NumPy, native a C compiler. '''
+    available = ['vm', 'jit', 'ir']
+    if bfbatch is not None:
+        available.append('batch')
+    if shutil.which(bfnative.compilerCommand()[0]):
+        available.append('native')
+    return available
+
+class Generator:
+    ''' Random programs as lists of statements, tuples that render() turns into
+    source:
+
+        ('var', name, value)        var name = value;
+        ('inc', name, value)        var name += value;
+        ('dec', name, value)        var name -= value;
+        ('clear', name)             var name;
+        ('print', name)             print name;
+        ('printc', value)           print value;
+        ('prints', text)            print "text";
+        ('printnum', name)          printnum name;
+        ('read', name)              read name;
+        ('add', name, other)        add name other;
+        ('copy', name, others)      copy name others...;
+        ('mul', a, b, result)       mul a b result; (likewise less and equal)
+        ('divmod', a, b, q, r)      divmod a b q r;
+        ('comment', text)           // text //
+        ('if', name, body, other)   if name: body [else other] endif;
+        ('while', counter, count, body)
+                                    var counter = count; while counter: body
+                                    var counter -= 1; end;
+
+    values are constant expressions as source text. '''
+    def __init__(self, seed, size=20, depth=3):
+        self.random = random.Random(seed)
+        self.size = size
+        self.depth = depth
+
+    def program(self):
+        ''' (statements, input) '''
+        r = self.random
+        self.declared = []
+        self.counters = []      # counters of the whiles being generated
+        statements = [self._declare() for i in range(r.randint(1, 3))]
+        statements += self._block(r.randint(1, self.size), 0)
+        input = bytes(r.randrange(256) for i in range(r.randint(0, 8)))
+        return statements, input
+
+    def _value(self, depth=0, divide=True):
+        r = self.random
+        roll = r.random()
+        if depth < 2 and roll < 0.3:
+            # the grammar has no precedence, a / in the left operand could take
+            # whatever follows it as part of its divisor and divide by zero
+            operator = r.choice('+-*/' if divide else '+-*')
+            left = self._value(depth + 1, False)
+            right = str(r.randint(1, 9)) if operator == '/' else self._value(depth + 1, divide)
+            return '%s %s %s' % (left, operator, right)
+        if roll < 0.45:
+            return "'%s'" % r.choice(TEXT)
+        return str(r.choice((r.randint(0, 9), r.randint(0, 255))))
+
+    def _declare(self):
+        name = self.random.choice([n for n in NAMES if n not in self.declared] or NAMES)
+        if name not in self.declared:
+            self.declared.append(name)
+        return ('var', name, self._value())
+
+    def _writable(self, count=1):
+        ''' count distinct declared variables, or None if there aren't enough. '''
+        if len(self.declared) < count:
+            return None
+        return self.random.sample(self.declared, count)
+
+    def _block(self, length, depth):
+        statements = []
+        previous = None
+        while len(statements) < length:
+            statement = self._statement(depth)
+            # a comment followed by another runs into it (see bfclex)
+            if statement is None or statement[0] == 'comment' and previous == 'comment':
+                continue
+            statements.append(statement)
+            previous = statement[0]
+        return statements
+
+    def _statement(self, depth):
+        r = self.random
+        kind = r.choice(('var', 'var', 'inc', 'dec', 'clear', 'print', 'printc', 'prints',
+                         'printnum', 'read', 'add', 'copy', 'mul', 'divmod', 'less', 'equal',
+                         'comment', 'if', 'while'))
+        if kind == 'var':
+            return self._declare()
+        if kind in ('inc', 'dec'):
+            names = self._writable()
+            return names and (kind, names[0], self._value())
+        if kind in ('clear', 'print', 'printnum', 'read'):
+            names = self._writable()
+            return names and (kind, names[0])
+        if kind == 'printc':
+            return (kind, self._value())
+        if kind == 'prints':
+            return (kind, ''.join(r.choice(TEXT) for i in range(r.randint(1, 20))))
+        if kind == 'add':
+            names = self._writable(2)
+            return names and (kind, names[0], names[1])
+        if kind == 'copy':
+            names = self._writable(r.randint(2, 3))
+            return names and (kind, names[0], tuple(names[1:]))
+        if kind in ('mul', 'less', 'equal'):
+            # any of them may be the same variable
+            names = self._writable()
+            return names and (kind,) + tuple(r.choice(self.declared) for i in range(3))
+        if kind == 'divmod':
+            names = self._writable(2)
+            return names and (kind, r.choice(self.declared), r.choice(self.declared),
+                              names[0], names[1])
+        if kind == 'comment':
+            text = ''.join(r.choice(TEXT) for i in range(r.randint(1, 20))).strip()
+            return (kind, text or 'x')
+        if depth >= self.depth:
+            return None
+        length = r.randint(1, max(1, self.size // 3))
+        if kind == 'if':
+            names = self._writable()
+            if names is None:
+                return None
+            body = self._block(length, depth + 1)
+            other = self._block(length, depth + 1) if r.random() < 0.4 else None
+            return (kind, names[0], body, other)
+        free = [c for c in COUNTERS if c not in self.counters]
+        if not free:
+            return None
+        counter = r.choice(free)
+        self.counters.append(counter)
+        body = self._block(length, depth + 1)
+        self.counters.pop()
+        return (kind, counter, r.randint(0, 4), body)
+
+def render(statements):
+    ''' The source of a program. '''
+    lines = []
+    def block(statements, indent):
+        tab = '\t' * indent
+        for statement in statements:
+            kind = statement[0]
+            if kind == 'var':
+                lines.append('%svar %s = %s;' % (tab, statement[1], statement[2]))
+            elif kind == 'inc':
+                lines.append('%svar %s += %s;' % (tab, statement[1], statement[2]))
+            elif kind == 'dec':
+                lines.append('%svar %s -= %s;' % (tab, statement[1], statement[2]))
+            elif kind == 'clear':
+                lines.append('%svar %s;' % (tab, statement[1]))
+            elif kind in ('print', 'printc'):
+                lines.append('%sprint %s;' % (tab, statement[1]))
+            elif kind == 'prints':
+                lines.append('%sprint "%s";' % (tab, statement[1]))
+            elif kind == 'printnum':
+                lines.append('%sprintnum %s;' % (tab, statement[1]))
+            elif kind == 'read':
+                lines.append('%sread %s;' % (tab, statement[1]))
+            elif kind == 'add':
+                lines.append('%sadd %s %s;' % (tab, statement[1], statement[2]))
+            elif kind == 'copy':
+                lines.append('%scopy %s %s;' % (tab, statement[1], ' '.join(statement[2])))
+            elif kind in ('mul', 'divmod', 'less', 'equal'):
+                lines.append('%s%s %s;' % (tab, kind, ' '.join(statement[1:])))
+            elif kind == 'comment':
+                lines.append('%s// %s //' % (tab, statement[1]))
+            elif kind == 'if':
+                lines.append('%sif %s:' % (tab, statement[1]))
+                block(statement[2], indent + 1)
+                if statement[3] is not None:
+                    lines.append('%selse' % tab)
+                    block(statement[3], indent + 1)
+                lines.append('%sendif;' % tab)
+            elif kind == 'while':
+                counter = statement[1]
+                lines.append('%svar %s = %d;' % (tab, counter, statement[2]))
+                lines.append('%swhile %s:' % (tab, counter))
+                block(statement[3], indent + 1)
+                lines.append('%s\tvar %s -= 1;' % (tab, counter))
+                lines.append('%send;' % tab)
+    block(statements, 0)
+    return '\n'.join(lines) + '\n'
+
+def check(source, input, engines):
+    ''' Compile source at every level and run it on every engine. Returns None
+    when everything agrees (or the program runs too long to check), otherwise
+    ((level, engine), description) of the first difference. '''
+    expected = None
+    compiled = {}
+    checked = {}        # code -> reference result, levels often give the same code
+    for optimize, layout, partial in LEVELS:
+        level = levelName(optimize, layout, partial)
+        # -O and --partial only rewrite the generated code, so each layout is
+        # compiled once and they are applied the way compileSource does
+        try:
+            if layout not in compiled:
+                compiled[layout] = bfc.compileSource(source, layout=layout)
+            code_generator = compiled[layout]
+            if (layout, partial) not in compiled:
+                compiled[layout, partial] = bfpe.partialEvaluate(code_generator.code)[0] \
+                                            if partial else code_generator.code
+            code = compiled[layout, partial]
+            if optimize:
+                code = bfopt.optimize(code)
+        except Exception as e:
+            return (level, 'compile'), '%s: %s' % (type(e).__name__, e)
+        seen = code in checked
+        if not seen:
+            try:
+                checked[code] = interpret(code, input, limit=STEP_LIMIT)
+            except IndexError as e:
+                return (level, 'reference'), str(e)
+        reference = checked[code]
+        if reference is None:
+            return None
+        output, tape, pointer = reference
+        values = {name: tape[cell] for name, cell in code_generator.variables.items()}
+        if expected is None:
+            expected = output, values
+        elif output != expected[0]:
+            return (level, 'reference'), 'output %r, plain gives %r' % (output, expected[0])
+        elif values != expected[1]:
+            changed = sorted(name for name in values if values[name] != expected[1].get(name))
+            return (level, 'reference'), 'variables %s are %s, plain gives %s' % (
+                ' '.join(changed), [values[n] for n in changed],
+                [expected[1].get(n) for n in changed])
+        for engine in engines if not seen else ():
+            try:
+                result = ENGINES[engine](code, input)
+            except Exception as e:
+                return (level, engine), '%s: %s' % (type(e).__name__, e)
+            if result[0] != output:
+                return (level, engine), 'output %r, reference gives %r' % (result[0], output)
+            if result[1] is not None and result[1] != tape:
+                cells = [i for i in range(TAPE_SIZE) if result[1][i] != tape[i]]
+                return (level, engine), 'tape differs at cells %s' % cells[:10]
+            if result[2] is not None and result[2] != pointer:
+                return (level, engine), 'pointer %d, reference gives %d' % (result[2], pointer)
+    return None
+
+def _variants(statements):
+    ''' Smaller versions of a list of statements: runs of them removed, biggest
+    first, then each one simplified. Blocks are never left empty. '''
+    n = len(statements)
+    size = n // 2
+    while size >= 1:
+        for start in range(0, n - size + 1, size):
+            candidate = statements[:start] + statements[start + size:]
+            if candidate:
+                yield candidate
+        size //= 2
+    for i, statement in enumerate(statements):
+        for replacement in _simpler(statement):
+            yield statements[:i] + replacement + statements[i + 1:]
+
+def _simpler(statement):
+    ''' Replacements (lists of statements) for one statement. '''
+    kind = statement[0]
+    if kind == 'if':
+        kind, name, body, other = statement
+        yield body
+        if other is not None:
+            yield other
+            yield [(kind, name, body, None)]
+            for smaller in _variants(other):
+                yield [(kind, name, body, smaller)]
+        for smaller in _variants(body):
+            yield [(kind, name, smaller, other)]
+    elif kind == 'while':
+        kind, counter, count, body = statement
+        yield body
+        if count > 1:
+            yield [(kind, counter, 1, body)]
+        for smaller in _variants(body):
+            yield [(kind, counter, count, smaller)]
+    elif kind in ('var', 'inc', 'dec') and statement[2] != '1':
+        yield [(kind, statement[1], '1')]
+    elif kind == 'printc' and statement[1] != '1':
+        yield [(kind, '1')]
+    elif kind in ('prints', 'comment') and len(statement[1]) > 1:
+        yield [(kind, statement[1][:len(statement[1]) // 2])]
+    elif kind == 'copy' and len(statement[2]) > 1:
+        yield [(kind, statement[1], statement[2][:1])]
+
+def shrink(statements, input, engines, engine, attempts=5000):
+    ''' The smallest program and input found that still fail on engine (at any
+    level, a failure often moves to another one as the program gets smaller). '''
+    def fails(statements, input):
+        result = check(render(statements), input, engines)
+        return result is not None and result[0][1] == engine
+    if input and fails(statements, b''):
+        input = b''
+    improved = True
+    while improved and attempts > 0:
+        improved = False
+        for candidate in _variants(statements):
+            attempts -= 1
+            if attempts < 0:
+                break
+            if fails(candidate, input):
+                statements = candidate
+                improved = True
+                break
+    return statements, input
+
+def fuzzCase(seed, engines, size=20, shrinking=True):
+    ''' Generate and check the case of one seed. Returns None if it passes,
+    otherwise a dict with the failure and the shrunk source and input. '''
+    statements, input = Generator(seed, size).program()
+    result = check(render(statements), input, engines)
+    if result is None:
+        return None
+    (level, engine), description = result
+    if shrinking:
+        statements, input = shrink(statements, input, engines, engine)
+        shrunk = check(render(statements), input, engines)
+        if shrunk is not None:
+            (level, engine), description = shrunk
+    return {'seed': seed, 'level': level, 'engine': engine, 'description': description,
+            'source': render(statements), 'input': input}
+
+def _initWorker():
+    warnings.simplefilter('ignore')
+    bfc.buildToolchain()
+
+def _fuzzChunk(start, stop, engines, size, shrinking, deadline):
+    # the monotonic clock is shared by the processes of a machine, so the worker
+    # checks the deadline of the run itself between cases
+    failures = []
+    for seed in range(start, stop):
+        if deadline is not None and time.monotonic() >= deadline:
+            return seed - start, failures
+        failure = fuzzCase(seed, engines, size, shrinking)
+        if failure:
+            failures.append(failure)
+    return stop - start, failures
+
+def fuzz(count=None, seconds=None, seed=0, jobs=None, engines=None, size=20, shrinking=True,
+         chunk=50):
+    ''' Check cases seed, seed + 1, ... until count are done or seconds have passed
+    (None for no limit on either), yielding (cases checked so far, failures) after
+    every chunk. A chunk stops early once seconds have passed. '''
+    engines = availableEngines() if engines is None else engines
+    jobs = jobs or os.cpu_count() or 1
+    deadline = None if seconds is None else time.monotonic() + seconds
+    stop = None if count is None else seed + count
+    next_seed = seed
+    done = 0
+    def more():
+        return (stop is None or next_seed < stop) and \
+               (deadline is None or time.monotonic() < deadline)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker) as pool:
+        pending = set()
+        while pending or more():
+            while more() and len(pending) < jobs * 2:
+                end = next_seed + chunk if stop is None else min(next_seed + chunk, stop)
+                pending.add(pool.submit(_fuzzChunk, next_seed, end, engines, size, shrinking,
+                                        deadline))
+                next_seed = end
+            finished, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                checked, failures = future.result()
+                done += checked
+                yield done, failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Differential fuzzing of the optimization '
+                                                 'levels and engines of bfc.')
+    parser.add_argument('--count', type=int, default=None,
+                        help='number of cases (default: 1000 unless --time is given)')
+    parser.add_argument('--time', type=float, default=None,
+                        help='run for this many seconds')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first case')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES), default=None,
+                        help='only run this engine, can be given more than once '
+                             '(default: every available one)')
+    parser.add_argument('--size', type=int, default=20,
+                        help='statements at the top of a generated program (default: %(default)s)')
+    parser.add_argument('--no-shrink', action='store_true', help='report failures as generated')
+    parser.add_argument('--save', default=None, help='write the failing sources to this directory')
+    parser.add_argument('--show', action='store_true',
+                        help='print the source of the first case and exit')
+    args = parser.parse_args(argv)
+    if args.show:
+        statements, input = Generator(args.seed, args.size).program()
+        print(render(statements), end='')
+        print('// input %r //' % input)
+        return 0
+    count = args.count if args.count is not None or args.time is not None else 1000
+    engines = args.engine or availableEngines()
+    print('engines %s, levels %s' % (' '.join(engines),
+                                     ', '.join(levelName(*level) for level in LEVELS)))
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+    start = time.monotonic()
+    failed = 0
+    last = start
+    done = 0
+    for done, failures in fuzz(count, args.time, args.seed, args.jobs, engines, args.size,
+                               not args.no_shrink):
+        for failure in failures:
+            failed += 1
+            print('FAIL  seed %d  %s on %s: %s' % (failure['seed'], failure['level'],
+                  failure['engine'], failure['description']))
+            print('      input %r' % failure['input'])
+            print('      ' + failure['source'].rstrip('\n').replace('\n', '\n      '))
+            if args.save:
+                path = os.path.join(args.save, 'seed-%d.bfcg' % failure['seed'])
+                with open(path, 'w') as file:
+                    file.write(failure['source'])
+        if time.monotonic() - last > 10:
+            last = time.monotonic()
+            print('%d cases, %d failures, %.0f cases/s' % (done, failed, done / (last - start)))
+    elapsed = time.monotonic() - start
+    print('%d cases, %d failures in %.1f s' % (done, failed, elapsed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the I/O runtime for bfc. It runs programs that talk to something, like
+code/echo.bfcg, which read and print one byte at a time, without a system call
+per byte and without blocking anything but the program that waits.
+
+A Machine (bfvm.Machine, the interpreter bfvm.VM runs on too) keeps its tape,
+pointer and position between calls: when the program reads and no input has been
+fed it stops and says it is WAITING, and carries on from the same , when more
+arrives. It never does any I/O itself, the drivers do:
+
+    run         blocking, with an input and an output stream
+    runAsync    on an asyncio event loop, with a StreamReader and StreamWriter,
+                it only awaits when the program needs input, so any number of
+                instances can share one loop (serve starts one per connection)
+
+Streams are pluggable, an input stream is anything with read() returning the
+next bytes available (b'' at the end of the input), an output stream anything
+with write(data), waiting() (the program is about to wait for input) and
+flush(). BufferedInput and BufferedOutput wrap files and sockets, LineInput text
+files, BufferedOutput flushes by policy:
+
+    full        when buffer_size bytes are waiting
+    line        after every line break
+    always      after every write
+
+and, unless flush_on_input is False, before the program waits for input so a
+prompt is seen before the answer is expected. Everything is flushed at the end.
+
+    python3 bfio.py program.bf [--flush line] [--listen host:port | --unix path]
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+
+import bfir
+import bfpack
+from bfvm import Machine, RUNNING, WAITING, DONE
+
+POLICIES = ('full', 'line', 'always')
+
+# loops an instance run by serve goes around before the next one gets a turn,
+# a few milliseconds
+SERVE_LIMIT = 10000
+
+class Program:
+    ''' Brainfsck code (text or bfir nodes) lowered once, every instance of it is
+    a new Machine. '''
+    def __init__(self, code, tape_size=30000, eof=None):
+        self.ops = bfir.ops(code)
+        self.tape_size = tape_size
+        self.eof = eof
+
+    def machine(self):
+        return Machine(self.ops, self.tape_size, self.eof)
+
+class BytesInput:
+    ''' Input from bytes already in memory. '''
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def read(self):
+        data, self.data = self.data, b''
+        return data
+
+class BufferedInput:
+    ''' Input from a binary file, socket or file descriptor, read buffer_size
+    bytes at a time. On pipes, terminals and sockets a read returns whatever is
+    there instead of waiting for a full buffer. '''
+    def __init__(self, file, buffer_size=1 << 16):
+        self.file = file
+        self.buffer_size = buffer_size
+
+    def read(self):
+        file = self.file
+        if isinstance(file, int):
+            return os.read(file, self.buffer_size)
+        if hasattr(file, 'recv'):
+            return file.recv(self.buffer_size)
+        if hasattr(file, 'read1'):
+            return file.read1(self.buffer_size)
+        return file.read(self.buffer_size)
+
+class LineInput:
+    ''' Input from a text file a line at a time, for sys.stdin once input() has
+    been used on it and may hold more than it returned. '''
+    def __init__(self, file, encoding='utf-8'):
+        self.file = file
+        self.encoding = encoding
+
+    def read(self):
+        return self.file.readline().encode(self.encoding)
+
+class BufferedOutput:
+    ''' Output to anything with a write method (a binary file, a socket through
+    makefile, an asyncio StreamWriter), flushed by policy, see POLICIES. '''
+    def __init__(self, file, policy='full', buffer_size=1 << 16, flush_on_input=True):
+        if policy not in POLICIES:
+            raise ValueError("Unknown flush policy %r" % policy)
+        self.file = file
+        self.policy = policy
+        self.buffer_size = buffer_size
+        self.flush_on_input = flush_on_input
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if not data:
+            return
+        self.buffer += data
+        if self.policy == 'always' or len(self.buffer) >= self.buffer_size or \
+                self.policy == 'line' and b'\n' in data:
+            self.flush()
+
+    def waiting(self):
+        if self.flush_on_input:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(bytes(self.buffer))
+            self.buffer = bytearray()
+        if hasattr(self.file, 'flush'):
+            self.file.flush()
+
+def run(program, input, output, limit=None):
+    ''' Run a Program to the end, reading input from and writing output to the
+    streams. Returns the Machine. '''
+    machine = program.machine()
+    while True:
+        output.write(machine.advance(limit))
+        if machine.state == DONE:
+            break
+        if machine.state == WAITING:
+            output.waiting()
+            machine.feed(input.read())
+    output.flush()
+    return machine
+
+async def runAsync(program, reader, writer, policy='full', buffer_size=1 << 16,
+                   flush_on_input=True, limit=None):
+    ''' Run a Program with an asyncio StreamReader and StreamWriter. The program
+    gives other tasks a turn when it waits for input, when it has output_size
+    bytes of output (see Machine) and, with a limit, every limit loops, so one
+    that computes for a long time without printing or reading should be given
+    one. Whenever it stops it waits for the writer to drain, so a client that
+    doesn't read holds up only its own instance. Returns the Machine. '''
+    machine = program.machine()
+    output = BufferedOutput(writer, policy, buffer_size, flush_on_input)
+    while True:
+        output.write(machine.advance(limit))
+        if machine.state == DONE:
+            break
+        if machine.state == WAITING:
+            output.waiting()
+            await writer.drain()
+            machine.feed(await reader.read(buffer_size))
+        else:
+            await writer.drain()
+            # drain returns at once while the transport has room
+            await asyncio.sleep(0)
+    output.flush()
+    await writer.drain()
+    return machine
+
+async def serve(program, host='127.0.0.1', port=0, path=None, backlog=1024, **options):
+    ''' Start a server running a new instance of program for every connection,
+    on a Unix socket at path or TCP on host and port. options go to runAsync,
+    limit defaults to SERVE_LIMIT so no instance keeps the others waiting.
+    backlog is how many connections may wait to be accepted, more are refused
+    (asyncio's default of 100 is too few for a burst of clients). Returns the
+    asyncio server. '''
+    options.setdefault('limit', SERVE_LIMIT)
+    async def connection(reader, writer):
+        try:
+            await runAsync(program, reader, writer, **options)
+        except (IndexError, ConnectionError) as e:
+            print('instance stopped, %s: %s' % (type(e).__name__, e), file=sys.stderr)
+        finally:
+            writer.close()
+    if path is not None:
+        return await asyncio.start_unix_server(connection, path, backlog=backlog)
+    return await asyncio.start_server(connection, host, port, backlog=backlog)
+
+def load(path):
+    ''' A compiled program from a .bf file, a .bfir file (see bfc --emit ir) or a
+    .bfpk file (see bfpack). '''
+    if path.endswith('.bfpk'):
+        with bfpack.load(path) as packed:
+            return bfir.fromOps(packed.ops())
+    with open(path, 'r') as file:
+        text = file.read()
+    return bfir.loads(text) if path.endswith('.bfir') else text
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a compiled program on stdin and stdout, '
+                                                 'or once for every connection to a server.')
+    parser.add_argument('program', help='a .bf, .bfir or .bfpk file')
+    parser.add_argument('--flush', choices=POLICIES, default=None,
+                        help='when output is written (default: line on a terminal, else full)')
+    parser.add_argument('--buffer-size', type=int, default=1 << 16)
+    parser.add_argument('--eof', type=int, default=None,
+                        help='the value , reads at the end of the input (default: unchanged)')
+    parser.add_argument('--tape-size', type=int, default=30000)
+    parser.add_argument('--listen', default=None, metavar='HOST:PORT',
+                        help='serve the program over TCP, one instance per connection')
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help='serve the program on a Unix socket, one instance per connection')
+    args = parser.parse_args(argv)
+    program = Program(load(args.program), args.tape_size, args.eof)
+    if args.listen is None and args.unix is None:
+        policy = args.flush or ('line' if sys.stdout.isatty() else 'full')
+        run(program, BufferedInput(sys.stdin.fileno(), args.buffer_size),
+            BufferedOutput(sys.stdout.buffer, policy, args.buffer_size))
+        return 0
+    async def listen():
+        options = {'policy': args.flush or 'full', 'buffer_size': args.buffer_size}
+        if args.unix is not None:
+            server = await serve(program, path=args.unix, **options)
+        else:
+            host, port = args.listen.rsplit(':', 1)
+            server = await serve(program, host, int(port), **options)
+        for sock in server.sockets:
+            print('serving on %s' % (sock.getsockname(),), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    try:
+        asyncio.run(listen())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
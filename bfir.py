@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the structured IR for bfc. It sits between the generated brainfsck text
+and everything that consumes it: a program is a list of nodes, and loops hold
+their body as a nested list, so passes (see bfopt) can see the structure of the
+program instead of a flat string.
+
+    Move(amount)                    move the pointer
+    Add(amount)                     add to the current cell (mod 256)
+    Set(value)                      set the current cell
+    Transfer(multiplier, targets)   a fused balanced loop, see bfvm.MULADD
+    Loop(body)                      [ body ]
+    Out(), In()                     . and ,
+
+The nodes are built from bfvm.lower, so runs are merged and clear/transfer
+loops fused the same way for every backend. lower turns them back into the flat
+bfvm ops the engines execute, emit (or emitOps from flat ops) back into
+brainfsck text, and dumps/loads into JSON for caching.
+'''
+
+import json
+
+import bfvm
+
+class Node:
+    __slots__ = ()
+
+    def _fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._fields() == other._fields()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(repr(f) for f in self._fields()))
+
+class Move(Node):
+    __slots__ = ('amount',)
+    def __init__(self, amount):
+        self.amount = amount
+
+class Add(Node):
+    __slots__ = ('amount',)
+    def __init__(self, amount):
+        self.amount = amount % 256
+
+class Set(Node):
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value % 256
+
+class Transfer(Node):
+    ''' Adds cell * multiplier * factor to the cell at every (offset, factor) in
+    targets, then clears the current cell. '''
+    __slots__ = ('multiplier', 'targets')
+    def __init__(self, multiplier, targets):
+        self.multiplier = multiplier
+        self.targets = tuple(tuple(target) for target in targets)
+
+class Loop(Node):
+    __slots__ = ('body',)
+    def __init__(self, body):
+        self.body = body
+
+class Out(Node):
+    __slots__ = ()
+
+class In(Node):
+    __slots__ = ()
+
+def fromOps(ops):
+    ''' Build the node tree from flat bfvm ops. '''
+    program = []
+    stack = []
+    for op, arg in ops:
+        if op == bfvm.ADD:
+            program.append(Add(arg))
+        elif op == bfvm.MOVE:
+            program.append(Move(arg))
+        elif op == bfvm.SET:
+            program.append(Set(arg))
+        elif op == bfvm.MULADD:
+            program.append(Transfer(*arg))
+        elif op == bfvm.OPEN:
+            stack.append(program)
+            program = []
+        elif op == bfvm.CLOSE:
+            loop = Loop(program)
+            program = stack.pop()
+            program.append(loop)
+        elif op == bfvm.OUT:
+            program.append(Out())
+        elif op == bfvm.IN:
+            program.append(In())
+    return program
+
+def build(code):
+    ''' Build the IR for brainfsck code. Raises ValueError on unbalanced brackets. '''
+    return fromOps(bfvm.lower(code))
+
+def lower(program):
+    ''' Flatten the IR into bfvm ops, with the jump targets filled in. '''
+    ops = []
+    # (node list, index of the next node, index of the OPEN op), iterative so deep
+    # nesting doesn't hit the recursion limit
+    stack = [(program, 0, None)]
+    while stack:
+        nodes, i, open = stack.pop()
+        while i < len(nodes):
+            node = nodes[i]
+            i += 1
+            kind = type(node)
+            if kind is Add:
+                ops.append((bfvm.ADD, node.amount))
+            elif kind is Move:
+                ops.append((bfvm.MOVE, node.amount))
+            elif kind is Set:
+                ops.append((bfvm.SET, node.value))
+            elif kind is Transfer:
+                ops.append((bfvm.MULADD, (node.multiplier, node.targets)))
+            elif kind is Loop:
+                stack.append((nodes, i, open))
+                nodes, i, open = node.body, 0, len(ops)
+                ops.append((bfvm.OPEN, None))
+            elif kind is Out:
+                ops.append((bfvm.OUT, None))
+            elif kind is In:
+                ops.append((bfvm.IN, None))
+        if open is not None:
+            ops[open] = (bfvm.OPEN, len(ops))
+            ops.append((bfvm.CLOSE, open))
+    return ops
+
+def ops(code):
+    ''' bfvm ops for brainfsck text or an IR program, so backends accept either. '''
+    if isinstance(code, str):
+        return bfvm.lower(code)
+    return lower(code)
+
+def _add(amount):
+    amount %= 256
+    return '+' * amount if amount <= 128 else '-' * (256 - amount)
+
+def _move(amount):
+    return '>' * amount if amount > 0 else '<' * -amount
+
+_COMMANDS = {bfvm.OPEN: '[', bfvm.CLOSE: ']', bfvm.OUT: '.', bfvm.IN: ','}
+
+def emit(program):
+    ''' Brainfsck text for the IR. '''
+    return emitOps(lower(program))
+
+def emitOps(ops, offsets=None):
+    ''' Brainfsck text for flat bfvm ops, lowering it gives the same ops back.
+    offsets: a list to fill with the position in the text of every op. '''
+    out = []
+    length = 0
+    for op, arg in ops:
+        if op == bfvm.ADD:
+            piece = _add(arg)
+        elif op == bfvm.MOVE:
+            piece = _move(arg)
+        elif op == bfvm.SET:
+            piece = '[-]' + _add(arg)
+        elif op == bfvm.MULADD:
+            multiplier, targets = arg
+            pieces = ['[' + _add(-pow(multiplier, -1, 256))]
+            position = 0
+            for offset, factor in targets:
+                pieces.append(_move(offset - position) + _add(factor))
+                position = offset
+            pieces.append(_move(-position) + ']')
+            piece = ''.join(pieces)
+        else:
+            piece = _COMMANDS[op]
+        if offsets is not None:
+            offsets.append(length)
+            length += len(piece)
+        out.append(piece)
+    return ''.join(out)
+
+def _encode(program):
+    encoded = []
+    for node in program:
+        kind = type(node)
+        if kind is Loop:
+            encoded.append(['loop', _encode(node.body)])
+        elif kind is Transfer:
+            encoded.append(['transfer', node.multiplier, [list(t) for t in node.targets]])
+        else:
+            encoded.append([kind.__name__.lower(), *node._fields()])
+    return encoded
+
+_KINDS = {'move': Move, 'add': Add, 'set': Set, 'out': Out, 'in': In}
+
+def _decode(encoded):
+    program = []
+    for name, *fields in encoded:
+        if name == 'loop':
+            program.append(Loop(_decode(fields[0])))
+        elif name == 'transfer':
+            program.append(Transfer(*fields))
+        elif name in _KINDS:
+            program.append(_KINDS[name](*fields))
+        else:
+            raise ValueError("Unknown IR node %r" % name)
+    return program
+
+def dumps(program):
+    ''' Serialize the IR to JSON. '''
+    return json.dumps(_encode(program), separators=(',', ':'))
+
+def loads(data):
+    ''' Read IR serialized with dumps. '''
+    return _decode(json.loads(data))
+
+def dump(program, indent=0):
+    ''' Human readable listing of the IR, one node per line. '''
+    lines = []
+    for node in program:
+        if type(node) is Loop:
+            lines.append('    ' * indent + 'Loop:')
+            lines.append(dump(node.body, indent + 1))
+        else:
+            lines.append('    ' * indent + repr(node))
+    return '\n'.join(line for line in lines if line)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the Python JIT for bfc. It turns brainfsck into a Python function, with
+one statement per op of the bfvm IR and native while loops for brackets, then
+compiles it once with compile() and caches the code object.
+
+Moves between loops and I/O are not executed, they are folded into the offsets
+of the following tape accesses (tape[p + 3]) and applied once before the next
+bracket. Clear and transfer loops (like the ones BFCodeGenerator.copy and add
+emit) are fused by the IR and become closed form arithmetic.
+
+The pointer is checked like bfvm does: moving off either end of the tape raises
+IndexError. Every run of code between two brackets starts with one check of the
+lowest and highest cell its moves reach, so folded moves stay cheap.
+
+Python only allows 20 statically nested blocks, programs with deeper loops are
+run with bfvm instead.
+'''
+
+import collections
+import hashlib
+
+import bfir
+import bfvm
+
+MAX_DEPTH = 18
+# compiled functions kept, least recently used first
+CACHE_SIZE = 64
+
+_cache = collections.OrderedDict()
+
+class TooDeep(Exception):
+    ''' The program nests loops deeper than Python can compile. '''
+
+def _at(offset):
+    if offset == 0:
+        return 'tape[p]'
+    return 'tape[p + %d]' % offset if offset > 0 else 'tape[p - %d]' % -offset
+
+def _offTape(condition, cell):
+    return 'if %s: raise IndexError("Pointer moved off the tape to cell %%d" %% (%s))' % (
+        condition, cell)
+
+def source(code):
+    ''' The Python source of the function code (brainfsck text or bfir nodes) is
+    compiled into. '''
+    lines = ['def program(tape, p, data, output, eof):',
+             '    read = 0',
+             '    length = len(data)',
+             '    size = len(tape)']
+    depth = 1
+    offset = 0
+    # the run of code since the last bracket: where it starts, the lowest and
+    # highest offsets its moves reach, the highest offset it always reads or
+    # writes (a bracket has just read offset 0) and the conditional checks of
+    # transfer loops, (line, offset), that the check of the run may cover
+    start = len(lines)
+    low = high = reached = 0
+    transfers = []
+    def emit(line):
+        lines.append('    ' * depth + line)
+    def access(at):
+        nonlocal reached
+        reached = max(reached, at)
+        return _at(at)
+    def flush(tested=True):
+        ''' Apply the folded moves and check the run. Negative indexes wrap
+        around in Python, so the lowest offset is always checked. Past the end
+        tape[p + n] raises by itself, the highest only needs a check if nothing at
+        or after it is read, tested: a bracket reads the cell the run ends on. '''
+        nonlocal offset, start, low, high, reached, transfers
+        if tested:
+            reached = max(reached, offset)
+        for line, lowest in reversed(transfers):
+            if lowest >= low:
+                del lines[line]
+        checks = []
+        if low < 0:
+            checks.append(_offTape('p < %d' % -low, 'p - %d' % -low))
+        if high > reached:
+            checks.append(_offTape('p + %d >= size' % high, 'p + %d' % high))
+        lines[start:start] = ['    ' * depth + check for check in checks]
+        if offset:
+            emit('p += %d' % offset)
+            offset = 0
+        low = high = reached = 0
+        transfers = []
+    for op, arg in bfir.ops(code):
+        if op == bfvm.ADD:
+            target = access(offset)
+            emit('%s = (%s + %d) & 255' % (target, target, arg))
+        elif op == bfvm.MOVE:
+            offset += arg
+            low = min(low, offset)
+            high = max(high, offset)
+        elif op == bfvm.SET:
+            emit('%s = %d' % (access(offset), arg))
+        elif op == bfvm.MULADD:
+            multiplier, others = arg
+            emit('v = %s' % access(offset))
+            emit('if v:')
+            depth += 1
+            # like bfvm, only checked when the loop would have run
+            lowest = offset + min(o for o, factor in others)
+            if lowest < 0:
+                transfers.append((len(lines), lowest))
+                emit(_offTape('p < %d' % -lowest, 'p - %d' % -lowest))
+            emit('v = (v * %d) & 255' % multiplier)
+            for o, factor in others:
+                target = _at(offset + o)
+                emit('%s = (%s + v * %d) & 255' % (target, target, factor))
+            emit('%s = 0' % _at(offset))
+            depth -= 1
+        elif op == bfvm.OPEN:
+            flush()
+            emit('while tape[p]:')
+            depth += 1
+            start = len(lines)
+            if depth > MAX_DEPTH:
+                raise TooDeep("Loops nested more than %d deep" % (MAX_DEPTH - 1))
+        elif op == bfvm.CLOSE:
+            flush()
+            if lines[-1].endswith('while tape[p]:'):
+                emit('pass')
+            depth -= 1
+            start = len(lines)
+        elif op == bfvm.OUT:
+            emit('output.append(%s)' % access(offset))
+        elif op == bfvm.IN:
+            emit('if read < length:')
+            emit('    %s = data[read]' % _at(offset))
+            emit('    read += 1')
+            emit('elif eof is not None:')
+            emit('    %s = eof & 255' % _at(offset))
+    flush(False)
+    emit('return p')
+    return '\n'.join(lines) + '\n'
+
+def compileCode(code):
+    ''' The compiled function for code, from the cache if it was compiled recently
+    (the last CACHE_SIZE programs are kept). Raises TooDeep if the loops are nested too deep for Python. '''
+    text = code if isinstance(code, str) else bfir.dumps(code)
+    key = hashlib.sha256(text.encode()).hexdigest()
+    function = _cache.get(key)
+    if function is not None:
+        _cache.move_to_end(key)
+        return function
+    namespace = {}
+    exec(compile(source(code), '<bfjit %s>' % key[:12], 'exec'), namespace)
+    function = _cache[key] = namespace['program']
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return function
+
+class JitProgram:
+    ''' Brainfsck code compiled to Python once, ready to be run any number of
+    times. Falls back to bfvm when the code can't be compiled.
+    After a run the tape and pointer hold the final machine state, like bfvm.VM. '''
+    def __init__(self, code):
+        try:
+            self.function = compileCode(code)
+            self.ops = None
+        except (TooDeep, SyntaxError, RecursionError):
+            self.function = None
+            self.ops = bfir.ops(code)
+
+    def run(self, input=b'', tape_size=30000, eof=None):
+        if self.function is None:
+            vm = bfvm.VM(tape_size, eof)
+            output = vm.execute(self.ops, input)
+            self.tape, self.pointer = vm.tape, vm.pointer
+            return output
+        output = bytearray()
+        self.tape = bytearray(tape_size)
+        self.pointer = self.function(self.tape, 0, bytes(input), output, eof)
+        return bytes(output)
+
+def run(code, input=b'', tape_size=30000, eof=None):
+    ''' Compile (or reuse) and run brainfsck code, returning its output as bytes. '''
+    return JitProgram(code).run(input, tape_size, eof)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the compile metrics API for bfc. It shows where the time, memory and
+generated code of a compile go.
+
+Pass a Metrics to compileSource (or --metrics to bfc.py) and every phase it runs
+is recorded: tokenize, parse, eval (or layout, see bfalloc), partial (bfpe) and
+every optimizer pass (optimize.<pass>, see bfopt.Optimizer), with its wall time,
+the number of times it ran, and with memory=True the memory it allocated and its
+peak (measured with tracemalloc, only imported then, which slows everything down
+while it runs). The lexer and parser are built once per process (see
+bfc.buildToolchain), what that took is reported with every compile under
+toolchain.
+
+The code generator is watched by wrapping its methods on the instance: every
+method records its calls, the commands it emitted itself (not counting those of
+the methods it called, so they add up to the size of the generated code) and the
+pointer moves of the moveTo calls it made. Without a Metrics nothing is wrapped
+or timed, the compile runs exactly the same code as before.
+
+finish gives everything as a dict that json can write, and calls the callback
+the Metrics was made with, if any:
+
+    metrics = bfmetrics.Metrics(callback=dashboard.send)
+    bfc.compileSource(code, optimize=True, metrics=metrics)
+    metrics.finish()
+'''
+
+import collections
+import contextlib
+import json
+import time
+import types
+
+import bfcparse
+
+# emit is where every other method's commands go, counting it would take the
+# whole size from its callers
+UNWATCHED = ('emit', 'flush', 'reset')
+
+def countNodes(parsed):
+    ''' (statements, nodes by class name) of a parse tree, expressions included. '''
+    counts = collections.Counter()
+    stack = list(parsed)
+    while stack:
+        node = stack.pop()
+        counts[type(node).__name__] += 1
+        for klass in type(node).__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                value = getattr(node, name, None)
+                if isinstance(value, bfcparse.Node):
+                    stack.append(value)
+    return len(parsed), counts
+
+class Metrics:
+    ''' What one compile cost.
+    memory: also measure the memory every phase allocates and its peak.
+    callback: called with the dict from finish.
+    phases: {name: {'seconds', 'calls'[, 'allocated', 'peak']}} in the order
+            they first ran, memory in bytes.
+    toolchain: the phases of building the lexer and parser in this process.
+    tokens, statements, nodes: Counters by token name and node class.
+    methods: {method: [calls, commands emitted, pointer moves]}.
+    optimizer: the report of bfopt.Optimizer, one entry per pass that changed
+               the code.
+    size: {'generated': commands emitted, 'output': length of the final code}. '''
+    def __init__(self, memory=False, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self.phases = {}
+        self.toolchain = {}
+        self.tokens = collections.Counter()
+        self.statements = 0
+        self.nodes = collections.Counter()
+        self.methods = {}
+        self.optimizer = []
+        self.size = {}
+        self._watched = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        ''' Time the body (and measure its memory) as phase name, phases that run
+        more than once add up. '''
+        entry = self.phases.get(name)
+        if entry is None:
+            entry = self.phases[name] = {'seconds': 0.0, 'calls': 0}
+            if self.memory:
+                entry['allocated'] = 0
+                entry['peak'] = 0
+        if self.memory:
+            import tracemalloc
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] += time.perf_counter() - start
+            entry['calls'] += 1
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                entry['allocated'] += current - base
+                entry['peak'] = max(entry['peak'], peak - base)
+            if tracing:
+                tracemalloc.stop()
+
+    def countTokens(self, tokens):
+        for token in tokens:
+            self.tokens[token.gettokentype()] += 1
+
+    def countParsed(self, parsed):
+        self.statements, self.nodes = countNodes(parsed)
+
+    def watch(self, code_generator):
+        ''' Record what every method of code_generator emits until finish. Calling
+        its reset clears what was recorded, so the counts describe the code it
+        holds (bfalloc evaluates more than once). '''
+        methods = self.methods
+        # [name, emitted when called, emitted by the methods it called]
+        stack = []
+
+        def wrap(name, method):
+            def watched(*args, **kwargs):
+                entry = methods.get(name)
+                if entry is None:
+                    entry = methods[name] = [0, 0, 0]
+                entry[0] += 1
+                frame = [name, code_generator.emitted, 0]
+                stack.append(frame)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    stack.pop()
+                    total = code_generator.emitted - frame[1]
+                    entry[1] += total - frame[2]
+                    if stack:
+                        stack[-1][2] += total
+            return watched
+
+        move = code_generator.moveTo
+        def moveTo(var):
+            index = code_generator.cell_index
+            move(var)
+            # the moves go to the method that called moveTo, below its own frame
+            caller = stack[-2][0] if len(stack) > 1 else 'moveTo'
+            methods[caller][2] += abs(code_generator.cell_index - index)
+
+        reset = code_generator.reset
+        def clear(*args, **kwargs):
+            methods.clear()
+            return reset(*args, **kwargs)
+
+        for name, value in vars(type(code_generator)).items():
+            if isinstance(value, types.FunctionType) and not name.startswith('__') \
+                    and name not in UNWATCHED and name != 'moveTo':
+                setattr(code_generator, name, wrap(name, getattr(code_generator, name)))
+        code_generator.moveTo = wrap('moveTo', moveTo)
+        code_generator.reset = clear
+        self._watched.append(code_generator)
+
+    def _unwatch(self):
+        for code_generator in self._watched:
+            for name, value in vars(type(code_generator)).items():
+                if name in vars(code_generator) and isinstance(value, types.FunctionType):
+                    delattr(code_generator, name)
+            self.size = {'generated': code_generator.emitted,
+                         'output': len(code_generator.code)}
+        self._watched = []
+
+    def asDict(self):
+        methods = {name: {'calls': calls, 'emitted': emitted, 'moves': moves}
+                   for name, (calls, emitted, moves) in self.methods.items()}
+        return {'phases': self.phases,
+                'toolchain': self.toolchain,
+                'seconds': sum(entry['seconds'] for entry in self.phases.values()),
+                'tokens': sum(self.tokens.values()),
+                'token_types': dict(self.tokens),
+                'statements': self.statements,
+                'nodes': sum(self.nodes.values()),
+                'node_types': dict(self.nodes),
+                'methods': methods,
+                'pointer_moves': sum(entry['moves'] for entry in methods.values()),
+                'optimizer': self.optimizer,
+                'size': self.size}
+
+    def finish(self):
+        ''' Stop watching the code generator and return the metrics as a dict,
+        passing it to the callback. '''
+        self._unwatch()
+        result = self.asDict()
+        if self.callback is not None:
+            self.callback(result)
+        return result
+
+    def dumps(self):
+        return json.dumps(self.asDict(), indent=1)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the native backend for bfc. It translates brainfsck into C, using the
+same lowered IR as bfvm (so runs are merged and clear/transfer loops are fused),
+builds it with the system C compiler and runs the binary.
+
+Binaries are cached on disk by a hash of the C source and the compiler command,
+so a program is only built once per machine.
+'''
+
+import hashlib
+import os
+import shlex
+import subprocess
+import tempfile
+
+from appdirs import AppDirs
+
+import bfir
+import bfvm
+
+DEFAULT_DIRECTORY = os.path.join(AppDirs('bfc').user_cache_dir, 'native')
+
+# exit status of a binary whose pointer left the tape, the cell is written to stderr
+OFF_TAPE = 3
+
+class BuildError(Exception):
+    ''' The C compiler is missing or failed. '''
+
+HEADER = '''#include <stdio.h>
+#include <stdlib.h>
+
+#define SIZE %d
+
+static unsigned char tape[SIZE];
+
+static void offTape(long cell)
+{
+    fflush(stdout);
+    fprintf(stderr, "%%ld\\n", cell);
+    exit(%d);
+}
+
+int main(void)
+{
+    long p = 0;
+    int c;
+'''
+
+FOOTER = '''    fflush(stdout);
+    return 0;
+}
+'''
+
+def translate(code, tape_size=30000):
+    ''' C source for brainfsck code (text or bfir nodes). End of input leaves the cell unchanged, like
+    bfvm by default. The pointer is checked against the tape wherever it moves,
+    and the binary exits with OFF_TAPE if it leaves. '''
+    lines = [HEADER % (tape_size, OFF_TAPE)]
+    depth = 1
+    for op, arg in bfir.ops(code):
+        indent = '    ' * depth
+        if op == bfvm.ADD:
+            lines.append('%stape[p] += %d;\n' % (indent, arg))
+        elif op == bfvm.MOVE:
+            lines.append('%sp += %d;\n' % (indent, arg))
+            lines.append('%sif (p %s) offTape(p);\n' % (indent, '< 0' if arg < 0 else '>= SIZE'))
+        elif op == bfvm.SET:
+            lines.append('%stape[p] = %d;\n' % (indent, arg))
+        elif op == bfvm.MULADD:
+            multiplier, others = arg
+            low = min(offset for offset, factor in others)
+            high = max(offset for offset, factor in others)
+            lines.append('%sif (tape[p]) {\n' % indent)
+            if low < 0:
+                lines.append('%s    if (p + %d < 0) offTape(p + %d);\n' % (indent, low, low))
+            if high > 0:
+                lines.append('%s    if (p + %d >= SIZE) offTape(p + %d);\n' % (indent, high, high))
+            lines.append('%s    unsigned char n = (unsigned char)(tape[p] * %d);\n' % (indent, multiplier))
+            for offset, factor in others:
+                lines.append('%s    tape[p + %d] += (unsigned char)(n * %d);\n' % (indent, offset, factor))
+            lines.append('%s    tape[p] = 0;\n' % indent)
+            lines.append('%s}\n' % indent)
+        elif op == bfvm.OPEN:
+            lines.append('%swhile (tape[p]) {\n' % indent)
+            depth += 1
+        elif op == bfvm.CLOSE:
+            depth -= 1
+            lines.append('%s}\n' % ('    ' * depth))
+        elif op == bfvm.OUT:
+            lines.append('%sputchar(tape[p]);\n' % indent)
+        elif op == bfvm.IN:
+            lines.append('%sif ((c = getchar()) != EOF) tape[p] = (unsigned char)c;\n' % indent)
+    lines.append(FOOTER)
+    return ''.join(lines)
+
+def compilerCommand():
+    ''' The C compiler to use, $CC or cc, with optimization on. '''
+    return shlex.split(os.environ.get('CC', 'cc')) + ['-O2']
+
+def build(code, directory=DEFAULT_DIRECTORY, tape_size=30000):
+    ''' Build code into a native binary, or find it in the cache. Returns the path
+    of the binary. '''
+    source = translate(code, tape_size)
+    command = compilerCommand()
+    key = hashlib.sha256((' '.join(command) + '\0' + source).encode()).hexdigest()
+    binary = os.path.join(directory, key)
+    if os.path.exists(binary):
+        return binary
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as work:
+        path = os.path.join(work, 'program.c')
+        with open(path, 'w') as f:
+            f.write(source)
+        output = os.path.join(work, 'program')
+        try:
+            result = subprocess.run(command + ['-o', output, path],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise BuildError("Can't run the C compiler %r: %s" % (command[0], e))
+        if result.returncode:
+            raise BuildError(result.stdout.decode(errors='replace'))
+        os.replace(output, binary)
+    return binary
+
+class NativeProgram:
+    ''' Brainfsck code built into a native binary, ready to be run on any number
+    of inputs. '''
+    def __init__(self, code, directory=DEFAULT_DIRECTORY, tape_size=30000):
+        self.binary = build(code, directory, tape_size)
+
+    def run(self, input=b'', timeout=None):
+        ''' Run the program on input and return its output as bytes. Raises
+        IndexError if the pointer leaves the tape, like bfvm. '''
+        result = subprocess.run([self.binary], input=input, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode == OFF_TAPE:
+            raise IndexError("Pointer moved off the tape to cell %s" %
+                             result.stderr.decode(errors='replace').strip())
+        if result.returncode:
+            raise RuntimeError("%s exited with status %d" % (self.binary, result.returncode))
+        return result.stdout
+
+    def runMany(self, inputs, timeout=None):
+        ''' Run the program once for every input, returning a list of outputs. '''
+        return [self.run(input, timeout) for input in inputs]
+
+def run(code, input=b''):
+    ''' Build (or reuse) and run brainfsck code, returning its output as bytes. '''
+    return NativeProgram(code).run(input)
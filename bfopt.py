@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the peephole optimizer for bfc. It runs after code generation and
+rewrites the program into shorter code that behaves the same.
+
+The passes run on the structured IR (see bfir): the code is built into nodes
+once, a pass is any function that takes a program (a list of nodes) and returns
+a new one, and the result is emitted back to brainfsck at the end. Building the
+IR already merges runs of +- and <>, fuses clear and transfer loops and drops
+anything that is not one of the eight commands. The built in passes are listed
+in PASSES.
+'''
+
+import bfir
+import bfvm
+
+def _transform(program, flat):
+    ''' Apply flat(nodes, top) to the program and to the body of every loop in it,
+    innermost first, and return the new program. top is True for the program
+    itself. Iterative, so deep nesting doesn't hit the recursion limit. '''
+    lists = [program]
+    for nodes in lists:
+        lists.extend(node.body for node in nodes if type(node) is bfir.Loop)
+    done = {}
+    for nodes in reversed(lists):
+        rebuilt = [bfir.Loop(done[id(node.body)]) if type(node) is bfir.Loop else node
+                   for node in nodes]
+        done[id(nodes)] = flat(rebuilt, nodes is program)
+    return done[id(program)]
+
+def _merge(nodes, top):
+    out = []
+    for node in nodes:
+        kind = type(node)
+        last = type(out[-1]) if out else None
+        if kind is bfir.Add:
+            if last is bfir.Add:
+                node = bfir.Add(out.pop().amount + node.amount)
+                if not node.amount:
+                    continue
+            elif last is bfir.Set:
+                node = bfir.Set(out.pop().value + node.amount)
+        elif kind is bfir.Move and last is bfir.Move:
+            node = bfir.Move(out.pop().amount + node.amount)
+            if not node.amount:
+                continue
+        elif kind is bfir.Set and (last is bfir.Add or last is bfir.Set):
+            out.pop()
+        out.append(node)
+    return out
+
+def cancel(program):
+    ''' Merge the adds and moves that other passes leave next to each other, so
+    the ones that undo each other (like +- or ><) go, and fold adds into a set
+    before them. The generator emits these when one moveTo goes right and the
+    next goes straight back left. '''
+    return _transform(program, _merge)
+
+def _length(amount):
+    ''' The number of + or - bfir.emit writes to add amount. '''
+    amount %= 256
+    return min(amount, 256 - amount)
+
+def _dropKnownZero(program, clears, loops):
+    ''' Walk the program tracking which cells are known to be zero, and drop the
+    sets (clears=True) and other loops (loops=True) that start on one. A set on a
+    cell of another known value becomes an add. Every cell is zero when the
+    program starts, and the cell a loop ends on is zero after it. Anything else
+    is forgotten when entering or leaving a loop. '''
+    def flat(nodes, top):
+        out = []
+        known = {}                      # offset -> value
+        default = 0 if top else None    # value of the cells not in known
+        pos = 0
+        for node in nodes:
+            kind = type(node)
+            value = known.get(pos, default)
+            if kind is bfir.Loop or kind is bfir.Transfer:
+                if value == 0 and loops:
+                    continue
+                if kind is bfir.Loop:
+                    known, default, pos = {0: 0}, None, 0
+                else:
+                    for offset, factor in node.targets:
+                        known[pos + offset] = None
+                    known[pos] = 0
+            elif kind is bfir.Set:
+                # a set is a [-] loop, either pass can drop it on a zero cell
+                known[pos] = node.value
+                if value == node.value and (clears or loops and value == 0):
+                    continue
+                if value == 0 and (clears or loops) or value is not None and clears \
+                        and _length(node.value - value) < 3 + _length(node.value):
+                    node = bfir.Add(node.value - value)
+            elif kind is bfir.Add:
+                if value is not None:
+                    known[pos] = (value + node.amount) & 255
+            elif kind is bfir.Move:
+                pos += node.amount
+            elif kind is bfir.In:
+                known[pos] = None
+            out.append(node)
+        return out
+    return _transform(program, flat)
+
+def redundantClears(program):
+    ''' Remove [-] on cells that are already zero, e.g. the zero() that ifOpen
+    and ifElseOpen do on a temp that has never been used. '''
+    return _dropKnownZero(program, clears=True, loops=False)
+
+def deadLoops(program):
+    ''' Remove loops that can never run because their cell is zero when they
+    are reached, e.g. any loop at the start of the program. '''
+    return _dropKnownZero(program, clears=False, loops=True)
+
+PASSES = {
+    'cancel': cancel,
+    'clears': redundantClears,
+    'deadloops': deadLoops,
+}
+
+DEFAULT_PASSES = ('cancel', 'deadloops', 'clears')
+
+class Optimizer:
+    ''' Runs a list of passes over the code until none of them changes it.
+    passes: names from PASSES or functions taking and returning a bfir program.
+    input: the input used to count the steps of the program before and after each
+           pass, steps are reported as None if they go over step_limit or if
+           step_limit is 0.
+    report: one dict per pass that changed the code, with the pass name and the
+            size and steps before and after. Building the IR from text comes
+            first, as the pass build.
+    phase: called with optimize.<pass> for a context to run every pass in, like
+           bfmetrics.Metrics.phase. '''
+    def __init__(self, passes=DEFAULT_PASSES, input=b'', step_limit=10000000, rounds=4,
+                 phase=None):
+        self.passes = [PASSES[p] if isinstance(p, str) else p for p in passes]
+        self.input = input
+        self.step_limit = step_limit
+        self.rounds = rounds
+        self.report = []
+        self.phase = phase
+
+    def _steps(self, code):
+        if not self.step_limit:
+            return None
+        if not isinstance(code, str):
+            code = bfir.emit(code)
+        return bfvm.countSteps(code, self.input, self.step_limit)
+
+    def optimize(self, code):
+        ''' Optimize brainfsck text, or a bfir program, and return the same. '''
+        text = isinstance(code, str)
+        program = bfir.build(code) if text else code
+        size = len(bfir.emit(program))
+        steps = self._steps(program)
+        if text and size != len(code):
+            self.report.append({'pass': 'build',
+                                'size': (len(code), size),
+                                'steps': (self._steps(code), steps)})
+        for i in range(self.rounds):
+            changed = False
+            for optimization in self.passes:
+                if self.phase is None:
+                    new = optimization(program)
+                else:
+                    with self.phase('optimize.' + optimization.__name__):
+                        new = optimization(program)
+                if new == program:
+                    continue
+                changed = True
+                new_size = len(bfir.emit(new))
+                new_steps = self._steps(new)
+                self.report.append({'pass': optimization.__name__,
+                                    'size': (size, new_size),
+                                    'steps': (steps, new_steps)})
+                program, size, steps = new, new_size, new_steps
+            if not changed:
+                break
+        return bfir.emit(program) if text else program
+
+    def summary(self):
+        ''' The report as a printable table. '''
+        lines = []
+        for entry in self.report:
+            lines.append('%-16s size %8d -> %-8d steps %10s -> %s' % (entry['pass'],
+                         entry['size'][0], entry['size'][1], entry['steps'][0], entry['steps'][1]))
+        return '\n'.join(lines)
+
+def optimize(code, passes=DEFAULT_PASSES, metrics=None):
+    ''' Optimize code without counting steps.
+    metrics: a bfmetrics.Metrics to time the passes in and give the report to. '''
+    optimizer = Optimizer(passes, step_limit=0,
+                          phase=None if metrics is None else metrics.phase)
+    code = optimizer.optimize(code)
+    if metrics is not None:
+        metrics.optimizer = optimizer.report
+    return code
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the packed bytecode format for bfc. Running brainfsck text means
+lowering it first (bfvm.lower), matching every bracket and merging every run
+again each time a program is loaded. A .bfpk file stores the lowered ops
+instead: load maps it with mmap and reads the words through a memoryview, and
+running it only decodes every word into a bfvm op, nothing is parsed or
+matched.
+
+    header     b'BFPK', the format version, the word size and the number of
+               sections (<4sHBB)
+    sections   a table of (tag, offset, size) (<4sII), then the sections, each
+               starting on a 4 byte boundary:
+
+    CODE       the ops, one little endian word each, the opcode (bfvm.ADD, ...)
+               in the low 3 bits and the argument in the rest: the amount of an
+               ADD, MOVE or SET, the distance to the matching bracket for OPEN
+               and CLOSE (the jump table), and for MULADD where it is in MULS
+    MULS       words, multiplier, number of targets, then offset and factor of
+               every target, once for every different MULADD
+
+Words are 2 bytes when every argument fits in 13 bits, which with relative jumps
+and shared MULADDs is nearly every program, and 4 bytes otherwise.
+    VARS       optional, the variable map (BFCodeGenerator.variables) as JSON
+    SMAP       optional, a bfprof.SourceMap as JSON, with positions that are
+               indices of ops instead of positions in the text
+
+Readers skip sections they don't know, a different version is refused. Only
+the header and the section table are checked when loading, the ops are trusted
+the way a .bf file's brackets would be after lowering.
+
+pack and Packed.text convert to and from plain brainfsck. The text is not the
+text that was packed, runs are merged and clear and transfer loops are written
+the way bfir.emit writes them, but lowering it gives the same ops, so packing it
+again gives the same bytes.
+'''
+
+import array
+import bisect
+import json
+import mmap
+import struct
+import sys
+
+import bfir
+import bfprof
+import bfvm
+from bfvm import MULADD, OPEN, CLOSE, OUT, IN
+
+MAGIC = b'BFPK'
+VERSION = 1
+HEADER = struct.Struct('<4sHBB')
+SECTION = struct.Struct('<4sII')
+
+# array and memoryview formats of the word sizes, and the largest argument (the
+# rest are the opcode and the sign)
+WORDS = {2: 'h', 4: 'i'}
+_LIMITS = {2: 1 << 12, 4: 1 << 28}
+
+def _words(values, size):
+    words = array.array(WORDS[size], values)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
+
+def _encode(ops):
+    ''' The word size, CODE and MULS sections for bfvm ops. '''
+    code = []
+    muls = []
+    shared = {}
+    for index, (op, arg) in enumerate(ops):
+        if op == MULADD:
+            value = shared.get(arg)
+            if value is None:
+                multiplier, targets = arg
+                value = shared[arg] = len(muls)
+                muls += [multiplier, len(targets)]
+                for offset, factor in targets:
+                    muls += [offset, factor]
+        elif op == OPEN or op == CLOSE:
+            value = arg - index
+        else:
+            value = arg or 0
+        code.append(value << 3 | op)
+    largest = max([abs(word >> 3) for word in code] + [abs(value) for value in muls],
+                  default=0)
+    for size in sorted(WORDS):
+        if largest < _LIMITS[size]:
+            return size, _words(code, size), _words(muls, size)
+    raise ValueError("An argument of %d doesn't fit in a packed op" % largest)
+
+def pack(code, variables=None, source_map=None):
+    ''' Pack brainfsck text or an IR program into bytes. variables and a
+    source_map (a bfprof.SourceMap recorded for code, which must be text) are
+    stored in their sections when given. A statement's range keeps the ops that
+    start in it, an op merged across statements belongs to the first. '''
+    positions = None
+    if source_map is not None:
+        if not isinstance(code, str):
+            raise ValueError("A source map needs the code as text")
+        positions = []
+        ops = bfvm.lower(code, positions)
+    else:
+        ops = bfir.ops(code)
+    size, code_section, muls_section = _encode(ops)
+    sections = [(b'CODE', code_section), (b'MULS', muls_section)]
+    if variables is not None:
+        sections.append((b'VARS', json.dumps(variables).encode()))
+    if source_map is not None:
+        ranges = []
+        for start, end, line, kind in source_map.ranges:
+            # the ops that start in the range, the first op at or after each end
+            start, end = bisect.bisect_left(positions, start), bisect.bisect_left(positions, end)
+            if end > start:
+                ranges.append((start, end, line, kind))
+        traces = [(bisect.bisect_left(positions, position), cell, label, line)
+                  for position, cell, label, line in source_map.traces]
+        sections.append((b'SMAP', json.dumps({'ranges': ranges, 'traces': traces}).encode()))
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    body = []
+    for tag, data in sections:
+        padding = -offset % 4
+        body.append(b'\0' * padding)
+        offset += padding
+        table.append(SECTION.pack(tag, offset, len(data)))
+        body.append(data)
+        offset += len(data)
+    return b''.join([HEADER.pack(MAGIC, VERSION, size, len(sections))] + table + body)
+
+class Packed:
+    ''' A packed program over a buffer (bytes, a memoryview or an mmap), read in
+    place. Close it, or use it as a context manager, before closing the buffer.
+    words: the CODE section as a sequence of ints.
+    variables: the variable map, or None.
+    version: the format version of the file.
+    word_size: 2 or 4 bytes. '''
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        if len(self._view) < HEADER.size:
+            raise ValueError("Not a packed program, it is too short")
+        magic, self.version, self.word_size, count = HEADER.unpack_from(self._view)
+        if magic != MAGIC:
+            raise ValueError("Not a packed program, it starts with %r" % bytes(magic))
+        if self.version != VERSION:
+            raise ValueError("Packed program version %d, only version %d can be read" % (
+                             self.version, VERSION))
+        if self.word_size not in WORDS:
+            raise ValueError("Packed program with %d byte words" % self.word_size)
+        self.sections = {}
+        for index in range(count):
+            tag, offset, size = SECTION.unpack_from(self._view, HEADER.size + index * SECTION.size)
+            if offset + size > len(self._view):
+                raise ValueError("Section %r runs past the end of the file" % tag.decode())
+            self.sections[tag] = self._view[offset:offset + size]
+        for tag in (b'CODE', b'MULS'):
+            if tag not in self.sections:
+                raise ValueError("Packed program without a %s section" % tag.decode())
+            if len(self.sections[tag]) % self.word_size:
+                raise ValueError("The %s section isn't a whole number of words" % tag.decode())
+        self.words = self._ints(self.sections[b'CODE'])
+        self._muls = self._ints(self.sections[b'MULS'])
+        self._muladds = None
+        self._ops = None
+        self.variables = None
+        if b'VARS' in self.sections:
+            self.variables = json.loads(bytes(self.sections[b'VARS']))
+
+    def _ints(self, section):
+        if sys.byteorder == 'little':
+            return section.cast(WORDS[self.word_size])
+        words = array.array(WORDS[self.word_size], bytes(section))
+        words.byteswap()
+        return words
+
+    def muladds(self):
+        ''' {position in MULS: (multiplier, targets)}, decoded once. '''
+        if self._muladds is None:
+            muls = self._muls
+            self._muladds = {}
+            index = 0
+            while index < len(muls):
+                count = muls[index + 1]
+                targets = muls[index + 2:index + 2 + 2 * count]
+                self._muladds[index] = (muls[index], tuple(zip(targets[::2], targets[1::2])))
+                index += 2 + 2 * count
+        return self._muladds
+
+    def ops(self):
+        ''' The program as bfvm ops, for the other engines, decoded once. '''
+        if self._ops is not None:
+            return self._ops
+        muladds = self.muladds()
+        ops = self._ops = []
+        for index, word in enumerate(self.words):
+            op = word & 7
+            if op == MULADD:
+                ops.append((op, muladds[word >> 3]))
+            elif op == OPEN or op == CLOSE:
+                ops.append((op, index + (word >> 3)))
+            elif op == OUT or op == IN:
+                ops.append((op, None))
+            else:
+                ops.append((op, word >> 3))
+        return ops
+
+    def text(self, offsets=None):
+        ''' The program as brainfsck text. offsets: see bfir.emitOps. '''
+        return bfir.emitOps(self.ops(), offsets)
+
+    def sourceMap(self):
+        ''' The program as text and a bfprof.SourceMap for that text, or None as
+        the map if none was packed. '''
+        offsets = []
+        text = self.text(offsets)
+        if b'SMAP' not in self.sections:
+            return text, None
+        offsets.append(len(text))
+        loaded = json.loads(bytes(self.sections[b'SMAP']))
+        source_map = bfprof.SourceMap()
+        source_map.ranges = [(offsets[start], offsets[end], line, kind)
+                             for start, end, line, kind in loaded['ranges']]
+        source_map.traces = [(offsets[position], cell, label, line)
+                             for position, cell, label, line in loaded['traces']]
+        return text, source_map
+
+    def run(self, input=b'', tape_size=30000, eof=None, limit=None):
+        ''' Run the program on a bfvm.VM and return its output as bytes. '''
+        return bfvm.VM(tape_size, eof).execute(self.ops(), input, limit)
+
+    def close(self):
+        ''' Release the views of the buffer, so an mmap under it can be closed. '''
+        for words in (self.words, self._muls):
+            if isinstance(words, memoryview):
+                words.release()
+        self.words = self._muls = None
+        for section in self.sections.values():
+            section.release()
+        self.sections = {}
+        self._view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def loads(data):
+    ''' A Packed over bytes in memory, without copying them. '''
+    return Packed(data)
+
+def load(path):
+    ''' A Packed over a .bfpk file mapped into memory, close it when done. '''
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return Packed(buffer)
+    except ValueError:
+        buffer.close()
+        raise
+
+def unpack(data):
+    ''' Brainfsck text for a packed program. '''
+    with Packed(data) as packed:
+        return packed.text()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the partial evaluator for bfc. Everything a program does before it first
+reads input is the same on every run, so it can be done at compile time.
+
+The generated code is split into top level pieces (straight runs of commands and
+whole loops). The pieces are run in bfvm one by one until the next one would
+read input, runs too long or leaves the tape. That prefix is then replaced by
+code that prints the same output and leaves the same tape and pointer behind,
+generated with BFCodeGenerator so it gets the same constant synthesis.
+'''
+
+import bfvm
+from bfcg import BFCodeGenerator, Cell
+
+def _pieces(code):
+    ''' Split code into top level pieces, a piece is a run of commands outside
+    any loop or one whole loop. Input commands are always pieces of their own. '''
+    pieces = []
+    start = 0
+    depth = 0
+    for i, c in enumerate(code):
+        if c == '[':
+            if depth == 0 and start < i:
+                pieces.append(code[start:i])
+                start = i
+            depth += 1
+        elif c == ']':
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unmatched ']' at position %d" % i)
+            if depth == 0:
+                pieces.append(code[start:i+1])
+                start = i + 1
+        elif c == ',' and depth == 0:
+            if start < i:
+                pieces.append(code[start:i])
+            pieces.append(c)
+            start = i + 1
+    if depth:
+        raise ValueError("Unmatched '['")
+    if start < len(code):
+        pieces.append(code[start:])
+    return pieces
+
+def residual(output, tape, pointer):
+    ''' Straight line code that prints output and then leaves tape (a sequence of
+    cell values, all others zero) with the pointer on cell pointer. '''
+    code_generator = BFCodeGenerator()
+    top = max([i for i, v in enumerate(tape) if v] + [pointer])
+    values = {Cell(i): v for i, v in enumerate(tape[:top + 1]) if v}
+    # cells that end up zero are free scratch space until the end
+    code_generator.taken = set(values)
+    code_generator.scratch = {Cell(i) for i in range(top + 1) if i not in values}
+    code_generator.free = set(code_generator.scratch)
+    code_generator.clean = set(code_generator.scratch)
+    code_generator.next_cell = top + 1
+    if output:
+        code_generator.printstr(output.decode('latin-1'))
+    for cell, value in sorted(values.items()):
+        code_generator.addConstant(cell, value)
+    for cell in sorted(code_generator.free - code_generator.clean):
+        code_generator.zero(cell)
+    code_generator.moveTo(Cell(pointer))
+    return code_generator.code
+
+def partialEvaluate(code, limit=1000000, tape_size=30000):
+    ''' Run the input independent prefix of code at compile time and replace it.
+    limit: the loop iterations allowed for each top level piece, the rest of a
+           program that loops longer than that before reading input is left as it
+           is.
+    The prefix is only replaced if that executes fewer steps. Returns the new code
+    and a report with the size and steps of the prefix before and after, and the
+    number of bytes of output that were folded. '''
+    code = ''.join(c for c in code if c in bfvm.COMMANDS)
+    vm = bfvm.VM(tape_size)
+    output = bytearray()
+    done = 0
+    for piece in _pieces(code):
+        if ',' in piece:
+            break
+        tape, pointer = bytes(vm.tape), vm.pointer
+        try:
+            output += vm.execute(bfvm.lower(piece), limit=limit)
+        except (bfvm.StepLimitExceeded, IndexError):
+            vm.tape, vm.pointer = bytearray(tape), pointer
+            break
+        done += len(piece)
+    prefix, rest = code[:done], code[done:]
+    replacement = residual(bytes(output), vm.tape, vm.pointer)
+    before = bfvm.countSteps(prefix)
+    after = bfvm.countSteps(replacement)
+    report = {'size': (len(prefix), len(replacement)), 'steps': (before, after),
+              'output': len(output)}
+    if (after, len(replacement)) >= (before, len(prefix)):
+        report['size'] = (len(prefix), len(prefix))
+        report['steps'] = (before, before)
+        return code, report
+    return replacement + rest, report
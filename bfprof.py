@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the profiler for bfc. It ties the brainfsck a program runs back to the
+source lines that generated it.
+
+While compiling, BFCodeGenerator fills a SourceMap (set code_generator.source_map
+before evaluating, see bfcparse.run) with the range of code every statement
+emitted, its line and its kind (PrintS, Copy, Loop, ...). trace statements become
+trace points in the map instead of printing while compiling.
+
+profile then runs the code on a bfvm.Machine, with nothing fused and a hook at
+the start of every stretch of commands that run together, and counts the commands
+and pointer moves executed for every source line, how many times every loop went
+around, and samples the traced variables each time a trace point is passed.
+
+Source maps only describe the code as generated, so they are lost by partial
+evaluation (bfpe) and the optimizer (bfopt).
+'''
+
+import bisect
+import json
+
+import bfvm
+
+class SourceMap:
+    ''' Ranges of generated code and the statement that emitted each.
+    ranges: (start, end, line, kind) in code order.
+    traces: (position, cell, label, line), cell is None when the trace is not of a
+            variable.
+    line: the line of the statement being evaluated, set by bfcparse.run.
+    lines: {statement node: source line}, filled by the parser when the map is
+           set on the code generator before parsing. clear keeps them, they
+           belong to the parse tree rather than to the code. '''
+    def __init__(self):
+        self.ranges = []
+        self.traces = []
+        self.line = None
+        self.lines = {}
+
+    def clear(self):
+        self.ranges = []
+        self.traces = []
+        self.line = None
+
+    def add(self, start, end, line, kind):
+        if end > start:
+            self.ranges.append((start, end, line, kind))
+
+    def trace(self, position, cell, label):
+        self.traces.append((position, cell, label, self.line))
+
+    def find(self, position):
+        ''' The range the command at position belongs to, or None. '''
+        index = bisect.bisect_right(self.ranges, (position, float('inf'))) - 1
+        if index >= 0 and self.ranges[index][0] <= position < self.ranges[index][1]:
+            return self.ranges[index]
+        return None
+
+    def dumps(self):
+        return json.dumps({'ranges': self.ranges, 'traces': self.traces})
+
+    @classmethod
+    def loads(cls, data):
+        loaded = json.loads(data)
+        source_map = cls()
+        source_map.ranges = [tuple(r) for r in loaded['ranges']]
+        source_map.traces = [tuple(t) for t in loaded['traces']]
+        return source_map
+
+class Profile:
+    ''' The counts of one profiled run.
+    lines: {line: {'commands': n, 'moves': n, 'io': n, 'kinds': set of kinds}}
+    loops: (iterations, commands executed inside, line, kind, position of the [)
+           for every loop that ran, hottest first.
+    traces: (line, label, hits, [(step, value), ...]) for every trace point. '''
+    def __init__(self, output, steps, lines, loops, traces):
+        self.output = output
+        self.steps = steps
+        self.lines = lines
+        self.loops = loops
+        self.traces = traces
+
+    def report(self, source=None, top=10):
+        ''' A readable report, source is the program's source text to quote lines. '''
+        source_lines = source.splitlines() if source is not None else []
+        def text(line):
+            if line is not None and 0 < line <= len(source_lines):
+                return source_lines[line - 1].strip()
+            return ''
+        out = ['%d steps' % self.steps, '',
+               '%6s %12s %6s %10s %8s  %-12s %s' % ('line', 'commands', '%', 'moves', 'io',
+                                                    'kind', 'source')]
+        for line, counts in sorted(self.lines.items(), key=lambda item: -item[1]['commands']):
+            share = 100.0 * counts['commands'] / self.steps if self.steps else 0
+            out.append('%6s %12d %6.1f %10d %8d  %-12s %s' % (line, counts['commands'], share,
+                       counts['moves'], counts['io'], ','.join(sorted(counts['kinds'])),
+                       text(line)))
+        if self.loops:
+            out += ['', 'hot loops', '%6s %12s %12s  %-12s %s' % ('line', 'iterations',
+                                                                   'commands', 'kind', 'source')]
+            for iterations, commands, line, kind, position in self.loops[:top]:
+                out.append('%6s %12d %12d  %-12s %s' % (line, iterations, commands, kind,
+                                                        text(line)))
+        if self.traces:
+            out += ['', 'traces']
+            for line, label, hits, samples in self.traces:
+                values = ' '.join(str(value) for step, value in samples[:20] if value is not None)
+                out.append('%6s %-12s %8d hits  %s' % (line, label, hits, values))
+        return '\n'.join(out)
+
+def _runs(code, source_map):
+    ''' Group code into runs of the same command that don't cross a statement or a
+    trace point (code is generated code, so it has nothing but commands). Returns
+    the runs as [command, count, jump, range index, traces] and the trace points
+    that come after the last command. '''
+    ranges = source_map.ranges
+    traces = {}
+    for index, (position, cell, label, line) in enumerate(source_map.traces):
+        traces.setdefault(position, []).append(index)
+    runs = []
+    opens = []
+    owner = -1
+    next_range = 0
+    for position, c in enumerate(code):
+        while next_range < len(ranges) and ranges[next_range][0] <= position:
+            next_range += 1
+        index = next_range - 1
+        if index >= 0 and position >= ranges[index][1]:
+            index = -1
+        here = traces.get(position)
+        if c in '+-<>' and runs and runs[-1][0] == c and index == owner and here is None:
+            runs[-1][1] += 1
+            continue
+        owner = index
+        if c == '[':
+            opens.append(len(runs))
+            runs.append([c, 1, None, index, here])
+        elif c == ']':
+            if not opens:
+                raise ValueError("Unmatched ']' at position %d" % position)
+            start = opens.pop()
+            runs[start][2] = len(runs)
+            runs.append([c, 1, start, index, here])
+        else:
+            runs.append([c, 1, None, index, here])
+    if opens:
+        raise ValueError("Unmatched '['")
+    return runs, traces.get(len(code), [])
+
+def profile(code, source_map, input=b'', tape_size=30000, eof=None, limit=None,
+            max_samples=1000):
+    ''' Run code, which must be exactly the code source_map was recorded for, and
+    count what every source line executes. Raises IndexError if the pointer leaves
+    the tape, and returns None if more than limit commands would be executed. '''
+    runs, final_traces = _runs(code, source_map)
+    hits = [0] * len(runs)
+    samples = [[] for trace in source_map.traces]
+    trace_hits = [0] * len(source_map.traces)
+    trace_cells = [cell for position, cell, label, line in source_map.traces]
+    steps = 0
+    stretches = []
+    def sample(indices, tape):
+        for index in indices:
+            trace_hits[index] += 1
+            if len(samples[index]) < max_samples:
+                cell = trace_cells[index]
+                samples[index].append((steps, None if cell is None else tape[cell]))
+    def hook(first, end):
+        # a stretch is counted on its first run, and starts at every trace point
+        stretches.append((first, end))
+        commands = sum(run[1] for run in runs[first:end])
+        traces = runs[first][4]
+        def count(tape, pointer):
+            nonlocal steps
+            if traces is not None:
+                sample(traces, tape)
+            hits[first] += 1
+            steps += commands
+            if limit is not None and steps > limit:
+                raise bfvm.StepLimitExceeded("More than %d commands" % limit)
+        return count
+    cuts = {index for index, run in enumerate(runs) if run[4] is not None}
+    machine = bfvm.Machine(bfvm.plainOps([run[:2] for run in runs], hook, cuts),
+                           tape_size, eof, output_size=None)
+    machine.feed(input)
+    machine.feed(b'')
+    try:
+        output = machine.advance()
+    except bfvm.StepLimitExceeded:
+        return None
+    sample(final_traces, machine.tape)
+    for first, end in stretches:
+        hits[first + 1:end] = [hits[first]] * (end - first - 1)
+    return _summarize(runs, hits, source_map, output, steps, samples, trace_hits)
+
+def _summarize(runs, hits, source_map, output, steps, samples, trace_hits):
+    ranges = source_map.ranges
+    lines = {}
+    executed = [0] * (len(runs) + 1)    # prefix sums of commands executed per run
+    for index, (c, count, jump, owner, traces) in enumerate(runs):
+        commands = hits[index] * count
+        executed[index + 1] = executed[index] + commands
+        if not hits[index]:
+            continue
+        line, kind = (ranges[owner][2], ranges[owner][3]) if owner >= 0 else (None, None)
+        counts = lines.setdefault(line, {'commands': 0, 'moves': 0, 'io': 0, 'kinds': set()})
+        counts['commands'] += commands
+        if c in '<>':
+            counts['moves'] += commands
+        elif c in '.,':
+            counts['io'] += commands
+        if kind is not None:
+            counts['kinds'].add(kind)
+    loops = []
+    for index, (c, count, jump, owner, traces) in enumerate(runs):
+        if c != '[' or not hits[index + 1]:
+            continue
+        line, kind = (ranges[owner][2], ranges[owner][3]) if owner >= 0 else (None, None)
+        # the body starts once on entry and again on every jump back from the ]
+        loops.append((hits[index + 1], executed[jump] - executed[index + 1], line, kind, index))
+    loops.sort(key=lambda loop: (-loop[1], -loop[0]))
+    traces = [(line, label, trace_hits[index], samples[index])
+              for index, (position, cell, label, line) in enumerate(source_map.traces)]
+    return Profile(output, steps, lines, loops, traces)
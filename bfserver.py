@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the compile server for bfc. Starting Python and loading the compiler
+costs more than compiling most sources, so the server does it once: it keeps a
+pool of worker processes with the lexer, parser and constant tables loaded and
+answers compile requests from bfclient over a Unix socket.
+
+Every connection is served by its own thread, which hands each request to the
+pool as soon as it is read and writes the responses back in order, so one
+client sending many requests keeps every worker busy. Every request is compiled
+with a fresh BFCodeGenerator (see bfc.compileSource), nothing is kept between
+requests but the toolchain.
+
+    python3 bfc.py --serve [--socket path] [-j jobs]
+'''
+
+import concurrent.futures
+import contextlib
+import io
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+import warnings
+
+from rply.errors import LexingError
+
+import bfc
+import bfclient
+import bfconst
+
+OPTIONS = ('optimize', 'layout', 'partial')
+
+def _initWorker():
+    bfc._initWorker()
+    bfconst.table()
+
+def _warm():
+    return os.getpid()
+
+def _describe(e):
+    if isinstance(e, LexingError):
+        position = e.getsourcepos()
+        return 'LexingError: unexpected character at line %d, column %d' % (position.lineno,
+                                                                             position.colno)
+    return '%s: %s' % (type(e).__name__, e)
+
+def compileRequest(request):
+    ''' Compile one request (see bfclient) and return the response. Never raises,
+    errors are returned in the response. Whatever the program prints while it is
+    compiled (trace statements) and any warnings are its diagnostics. '''
+    start = time.perf_counter()
+    response = {'code': None, 'error': None, 'diagnostics': []}
+    printed = io.StringIO()
+    try:
+        options = dict(request.get('options') or {})
+        unknown = sorted(set(options) - set(OPTIONS))
+        if unknown:
+            raise ValueError("Unknown options %s" % ', '.join(unknown))
+        emit = request.get('emit', 'bf')
+        # responses are JSON, so only the text formats
+        if emit not in bfclient.EXTENSIONS:
+            raise ValueError("Can't emit %r" % emit)
+        # the grammar's own warnings aren't about this source
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            bfc.buildToolchain()
+        with warnings.catch_warnings(record=True) as caught, contextlib.redirect_stdout(printed):
+            warnings.simplefilter('always')
+            try:
+                code_generator = bfc.compileSource(request['source'], **options)
+                response['code'] = bfc.FORMATS[emit][1](code_generator.code,
+                                                        code_generator.variables)
+            finally:
+                response['diagnostics'] += ['warning: %s' % w.message for w in caught]
+    except Exception as e:
+        response['error'] = _describe(e)
+    response['diagnostics'] += ['trace: %s' % line for line in printed.getvalue().splitlines()]
+    response['seconds'] = time.perf_counter() - start
+    return response
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        responses = queue.Queue(maxsize=64)
+        writer = threading.Thread(target=self._write, args=(responses,), daemon=True)
+        writer.start()
+        try:
+            while True:
+                try:
+                    request = bfclient.receive(self.request)
+                except (ValueError, OSError) as e:
+                    # a broken message, answer it and hang up
+                    failed = concurrent.futures.Future()
+                    failed.set_result({'code': None, 'error': _describe(e), 'diagnostics': [],
+                                       'seconds': 0.0})
+                    responses.put(failed)
+                    break
+                if request is None:
+                    break
+                responses.put(self.server.pool.submit(compileRequest, request))
+        finally:
+            responses.put(None)
+            writer.join()
+
+    def _write(self, responses):
+        while True:
+            future = responses.get()
+            if future is None:
+                return
+            try:
+                bfclient.send(self.request, future.result())
+                self.server.count()
+            except OSError:
+                # the client went away, drain what is left
+                while responses.get() is not None:
+                    pass
+                return
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' The compile server on a Unix socket at path, with jobs worker processes
+    (default: one per CPU). A socket file left behind by a server that is gone is
+    replaced, OSError is raised if a server is listening on it or it belongs to
+    another user. The directory of the default path, or one that doesn't exist
+    yet, is created for this user only. '''
+    daemon_threads = True
+
+    def __init__(self, path=bfclient.DEFAULT_SOCKET, jobs=None):
+        directory = os.path.dirname(os.path.abspath(path))
+        if path == bfclient.DEFAULT_SOCKET or not os.path.isdir(directory):
+            bfclient.privateDirectory(directory)
+        if os.path.exists(path):
+            bfclient.checkOwner(path)
+            client = bfclient.connect(path)
+            if client is not None:
+                client.close()
+                raise OSError("A server is already listening on %s" % path)
+            os.unlink(path)
+        self.path = path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.requests = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                           initializer=_initWorker)
+        # start every worker now so the first requests don't wait for them
+        for future in [self.pool.submit(_warm) for i in range(self.jobs)]:
+            future.result()
+        # only this user can connect, from the moment the socket exists
+        mask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(mask)
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.shutdown()
+        if os.path.exists(self.path) and os.stat(self.path).st_uid == os.getuid():
+            os.unlink(self.path)
+
+def serve(path=bfclient.DEFAULT_SOCKET, jobs=None):
+    ''' Run a Server until it is interrupted or terminated. '''
+    try:
+        server = Server(path, jobs)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    # SIGTERM shuts down cleanly too, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('serving on %s with %d workers' % (server.path, server.jobs))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('%d requests in %.0f s' % (server.requests, time.monotonic() - server.started))
+    return 0
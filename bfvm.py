@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+''' bfc
+This is the brainfsck virtual machine for bfc. It runs the code produced by the
+code generator without needing an external interpreter.
+
+The code is first lowered into a compact IR, a flat list of (opcode, argument)
+tuples:
+    ADD n        add n to the current cell (runs of +/- are merged)
+    MOVE n       move the pointer n cells (runs of >/< are merged)
+    SET n        set the current cell to n ([-] and [+], plus any following +/-)
+    MULADD m     a balanced loop such as the ones BFCodeGenerator.add/copy emit,
+                 m is (multiplier, ((offset, factor), ...)), the loop runs
+                 cell * multiplier times (mod 256), adding factor per iteration to
+                 each offset, and leaves the current cell zero
+    OPEN j       [ with the index of its matching CLOSE
+    CLOSE j      ] with the index of its matching OPEN
+    OUT, IN      . and ,
+    HOOK f       never made by lower: calls f(tape, pointer), see plainOps
+
+Everything that runs ops runs them on a Machine: VM.execute runs one to the end,
+bfio drives one through its input and output, and runPlain counts the commands
+a plain interpreter would execute with the HOOKs of plainOps.
+'''
+
+ADD = 0
+MOVE = 1
+SET = 2
+MULADD = 3
+OPEN = 4
+CLOSE = 5
+OUT = 6
+IN = 7
+HOOK = 8
+
+OPNAMES = ('ADD', 'MOVE', 'SET', 'MULADD', 'OPEN', 'CLOSE', 'OUT', 'IN', 'HOOK')
+
+# Machine states
+RUNNING = 'running'     # stopped to hand over output, or after limit loops
+WAITING = 'waiting'     # needs input
+DONE = 'done'
+
+COMMANDS = frozenset('+-<>[].,')
+
+class StepLimitExceeded(Exception):
+    ''' Raised when a program runs more loop iterations than it was allowed. '''
+
+def _fuseLoop(body):
+    ''' Try to turn the body of a loop into a single SET or MULADD op.
+    Only loops made of ADD and MOVE that return to the cell they started on can be
+    fused, and the loop cell has to change by an odd amount each time around so
+    the number of iterations is known (every odd number has an inverse mod 256). '''
+    offset = 0
+    deltas = {}
+    for op, arg in body:
+        if op == ADD:
+            deltas[offset] = deltas.get(offset, 0) + arg
+        elif op == MOVE:
+            offset += arg
+        else:
+            return None
+    if offset != 0:
+        return None
+    step = deltas.pop(0, 0) % 256
+    if step % 2 == 0:
+        return None
+    others = tuple((o, f % 256) for o, f in sorted(deltas.items()) if f % 256)
+    if not others:
+        return (SET, 0)
+    # iterations n solve cell + n*step = 0 (mod 256)
+    return (MULADD, ((-pow(step, -1, 256)) % 256, others))
+
+def lower(code, positions=None):
+    ''' Lower brainfsck code into the IR. Raises ValueError on unbalanced brackets.
+    positions: a list to fill with the position in code of the command every op
+               starts at. '''
+    ops = []
+    opens = []
+    i = 0
+    length = len(code)
+    while i < length:
+        c = code[i]
+        start = i
+        i += 1
+        if c == '+' or c == '-':
+            amount = 1 if c == '+' else -1
+            while i < length and (code[i] in '+-' or code[i] not in COMMANDS):
+                if code[i] == '+':
+                    amount += 1
+                elif code[i] == '-':
+                    amount -= 1
+                i += 1
+            amount %= 256
+            if not amount:
+                continue
+            if ops and ops[-1][0] == SET:
+                ops[-1] = (SET, (ops[-1][1] + amount) % 256)
+            elif ops and ops[-1][0] == ADD:
+                total = (ops[-1][1] + amount) % 256
+                if total:
+                    ops[-1] = (ADD, total)
+                else:
+                    ops.pop()
+            else:
+                ops.append((ADD, amount))
+        elif c == '>' or c == '<':
+            amount = 1 if c == '>' else -1
+            while i < length and (code[i] in '<>' or code[i] not in COMMANDS):
+                if code[i] == '>':
+                    amount += 1
+                elif code[i] == '<':
+                    amount -= 1
+                i += 1
+            if not amount:
+                continue
+            if ops and ops[-1][0] == MOVE:
+                total = ops[-1][1] + amount
+                if total:
+                    ops[-1] = (MOVE, total)
+                else:
+                    ops.pop()
+            else:
+                ops.append((MOVE, amount))
+        elif c == '[':
+            opens.append(len(ops))
+            ops.append((OPEN, None))
+        elif c == ']':
+            if not opens:
+                raise ValueError("Unmatched ']' at position %d" % (i - 1))
+            open = opens.pop()
+            fused = _fuseLoop(ops[open + 1:])
+            if fused is not None:
+                del ops[open:]
+                ops.append(fused)
+            else:
+                ops[open] = (OPEN, len(ops))
+                ops.append((CLOSE, open))
+        elif c == '.':
+            ops.append((OUT, None))
+        elif c == ',':
+            ops.append((IN, None))
+        if positions is not None and len(positions) != len(ops):
+            # every command adds one op, or removes some by merging or fusing
+            if len(positions) < len(ops):
+                positions.append(start)
+            else:
+                del positions[len(ops):]
+    if opens:
+        raise ValueError("Unmatched '[' at position %d" % opens[-1])
+    return ops
+
+class Machine:
+    ''' One running instance of lowered code, which keeps its tape, pointer and
+    position between calls to advance: when the program reads and no input has
+    been fed it stops and says it is WAITING, and carries on from the same ,
+    when more arrives.
+    eof: the value stored by , at the end of the input, None leaves the cell
+         unchanged.
+    output_size: advance returns once this much output is waiting, None to
+                 never stop for output.
+    tape: a bytearray to run on instead of a new one of tape_size cells. '''
+    def __init__(self, ops, tape_size=30000, eof=None, output_size=1 << 16, tape=None):
+        self.ops = ops
+        self.tape = bytearray(tape_size) if tape is None else tape
+        self.pointer = 0
+        self.pc = 0
+        self.eof = eof
+        self.output_size = output_size
+        self.data = b''
+        self.read = 0
+        self.closed = False
+        self.state = RUNNING if ops else DONE
+
+    def feed(self, data):
+        ''' Give the program more input, b'' for the end of it. '''
+        if not data:
+            self.closed = True
+            return
+        self.data = self.data[self.read:] + bytes(data)
+        self.read = 0
+
+    def advance(self, limit=None):
+        ''' Run until the program ends (DONE), reads input it hasn't been fed
+        (WAITING), has output_size bytes of output or, with a limit, has gone
+        around limit loops (RUNNING). Returns the output since the last call and
+        sets state. Raises IndexError if the pointer leaves the tape. '''
+        ops = self.ops
+        tape = self.tape
+        p = self.pointer
+        size = len(tape)
+        output = bytearray()
+        output_size = self.output_size
+        data = self.data
+        read = self.read
+        pc = self.pc
+        end = len(ops)
+        budget = -1 if limit is None else limit
+        state = DONE
+        try:
+            while pc < end:
+                op, arg = ops[pc]
+                if op == ADD:
+                    tape[p] = (tape[p] + arg) & 255
+                elif op == MOVE:
+                    p += arg
+                    if p < 0 or p >= size:
+                        raise IndexError("Pointer moved off the tape to cell %d" % p)
+                elif op == OPEN:
+                    if not tape[p]:
+                        pc = arg
+                elif op == CLOSE:
+                    if tape[p]:
+                        pc = arg
+                        if budget >= 0:
+                            budget -= 1
+                            if budget < 0:
+                                pc += 1
+                                state = RUNNING
+                                break
+                elif op == SET:
+                    tape[p] = arg
+                elif op == MULADD:
+                    value = tape[p]
+                    if value:
+                        multiplier, others = arg
+                        n = (value * multiplier) & 255
+                        if p + others[0][0] < 0:
+                            raise IndexError("Pointer moved off the tape to cell %d" %
+                                             (p + others[0][0]))
+                        for offset, factor in others:
+                            tape[p + offset] = (tape[p + offset] + n * factor) & 255
+                        tape[p] = 0
+                elif op == OUT:
+                    output.append(tape[p])
+                    if output_size is not None and len(output) >= output_size:
+                        pc += 1
+                        state = RUNNING
+                        break
+                elif op == IN:
+                    if read < len(data):
+                        tape[p] = data[read]
+                        read += 1
+                    elif not self.closed:
+                        # stop on the , itself, it runs again once there is input
+                        state = WAITING
+                        break
+                    elif self.eof is not None:
+                        tape[p] = self.eof & 255
+                elif op == HOOK:
+                    arg(tape, p)
+                pc += 1
+        finally:
+            self.pointer = p
+            self.pc = pc
+            self.read = read
+        self.state = state
+        return bytes(output)
+
+class VM:
+    ''' Executes lowered code over a preallocated tape.
+    tape_size: number of cells, moving off either end raises IndexError.
+    eof: the value stored by , when the input is exhausted, None leaves the cell
+         unchanged.
+    After a run the tape and pointer hold the final machine state. '''
+    def __init__(self, tape_size=30000, eof=None):
+        self.tape_size = tape_size
+        self.eof = eof
+        self.tape = bytearray(tape_size)
+        self.pointer = 0
+
+    def reset(self):
+        self.tape = bytearray(self.tape_size)
+        self.pointer = 0
+
+    def execute(self, ops, input=b'', limit=None):
+        ''' Run the IR on a Machine, from the current pointer, with all of input
+        and then its end, and return everything it printed as bytes.
+        limit: the number of loop iterations allowed before StepLimitExceeded is
+               raised, None for no limit. '''
+        machine = Machine(ops, eof=self.eof, output_size=None, tape=self.tape)
+        machine.pointer = self.pointer
+        machine.feed(input)
+        machine.feed(b'')
+        try:
+            output = machine.advance(limit)
+        finally:
+            self.pointer = machine.pointer
+        if machine.state != DONE:
+            raise StepLimitExceeded("More than %d loop iterations" % limit)
+        return output
+
+class Program:
+    ''' Brainfsck code lowered once, ready to be run any number of times. '''
+    def __init__(self, code):
+        self.ops = lower(code)
+
+    def run(self, input=b'', tape_size=30000, eof=None):
+        return VM(tape_size, eof).execute(self.ops, input)
+
+def run(code, input=b'', tape_size=30000, eof=None):
+    ''' Lower and run brainfsck code, returning its output as bytes. '''
+    return Program(code).run(input, tape_size, eof)
+
+def dump(ops):
+    ''' Human readable listing of the IR. '''
+    lines = []
+    for index, (op, arg) in enumerate(ops):
+        lines.append('%5d %-6s %s' % (index, OPNAMES[op], '' if arg is None else arg))
+    return '\n'.join(lines)
+
+def plainOps(runs, hook, cuts=()):
+    ''' Ops that run runs of commands [(command, count), ...] as written, nothing
+    fused, for the interpreters that count commands. A HOOK starts every stretch
+    of runs that always run together: at the start, after every bracket and
+    before every run whose index is in cuts. Its function is hook(first, end),
+    called here for the runs of its stretch. Raises ValueError on unbalanced
+    brackets. '''
+    ops = []
+    opens = []
+    stretches = []      # (index of the HOOK, first run)
+    for index, (c, count) in enumerate(runs):
+        if not index or index in cuts or runs[index - 1][0] in '[]':
+            stretches.append((len(ops), index))
+            ops.append(None)
+        if c == '+' or c == '-':
+            ops.append((ADD, (count if c == '+' else -count) & 255))
+        elif c == '>' or c == '<':
+            ops.append((MOVE, count if c == '>' else -count))
+        elif c == '[':
+            opens.append(len(ops))
+            ops.append((OPEN, None))
+        elif c == ']':
+            if not opens:
+                raise ValueError("Unmatched ']'")
+            start = opens.pop()
+            ops[start] = (OPEN, len(ops))
+            ops.append((CLOSE, start))
+        else:
+            ops.append((OUT if c == '.' else IN, None))
+    if opens:
+        raise ValueError("Unmatched '['")
+    for (position, first), end in zip(stretches, [first for position, first in stretches[1:]] +
+                                      [len(runs)]):
+        ops[position] = (HOOK, hook(first, end))
+    return ops
+
+def runPlain(code, input=b'', tape_size=30000, eof=None, limit=None, merge=True):
+    ''' Run code the way a plain interpreter does, one command at a time (with
+    merge, runs of the same command in one go), counting the commands executed.
+    Returns (output, steps, machine), or None if more than limit commands would
+    be executed. Raises IndexError if the pointer leaves the tape. '''
+    runs = []
+    for c in code:
+        if c not in COMMANDS:
+            continue
+        if merge and c in '+-<>' and runs and runs[-1][0] == c:
+            runs[-1][1] += 1
+        else:
+            runs.append([c, 1])
+    steps = 0
+    def hook(first, end):
+        commands = sum(count for c, count in runs[first:end])
+        def count(tape, pointer):
+            nonlocal steps
+            # the whole stretch runs once it is entered
+            steps += commands
+            if limit is not None and steps > limit:
+                raise StepLimitExceeded("More than %d commands" % limit)
+        return count
+    machine = Machine(plainOps(runs, hook), tape_size, eof, output_size=None)
+    machine.feed(input)
+    machine.feed(b'')
+    try:
+        output = machine.advance()
+    except StepLimitExceeded:
+        return None
+    return output, steps, machine
+
+def countSteps(code, input=b'', limit=None, eof=None):
+    ''' Count how many brainfsck commands the code executes, which is the cost a
+    plain interpreter pays (see runPlain). Runs of the same command are counted in
+    one go, but loops are not fused so this is much slower than VM.execute.
+    Returns None if more than limit steps would be executed. '''
+    result = runPlain(code, input, eof=eof, limit=limit)
+    return None if result is None else result[1]
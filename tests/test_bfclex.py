@@ -0,0 +1,49 @@
+import warnings
+
+import pytest
+
+import bfclex
+
+@pytest.fixture(scope='module')
+def lexers():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return bfclex.Lexer().buildLexer(), bfclex.Lexer().buildStreamLexer()
+
+def tokens(lexed):
+    return [(token.gettokentype(), token.getstr(), token.getsourcepos().idx,
+             token.getsourcepos().lineno, token.getsourcepos().colno) for token in lexed]
+
+def chunked(source, size):
+    return [source[i:i + size] for i in range(0, len(source), size)]
+
+@pytest.mark.parametrize('source', [
+    'var a = 1;\nvar a += 2; printnum a;\n',
+    'endif end endi\nvariable multiplier mul a b c;',
+    '// a comment //\nvar a;\n//\n\n note\n\n //\nprint a;',
+    'print "a"; print "b";\nprint \';\';',
+    'var a -= 3;var b+=a;  \n\n\n',
+])
+def test_stream_tokens_match_rply(lexers, source):
+    rply, stream = lexers
+    for size in (1, 2, 3, 7, len(source)):
+        assert tokens(stream.lexChunks(chunked(source, size))) == tokens(rply.lex(source))
+
+def test_single_line_tail_is_bounded(lexers):
+    ''' A source with no line breaks is not held back whole: every token comes
+    out soon after the text that follows it is read. '''
+    stream = lexers[1]
+    statement = 'var counter += 7; printnum counter; '
+    read = 0
+    def chunks():
+        nonlocal read
+        for i in range(5000):
+            read += len(statement)
+            yield statement
+    held = 0
+    count = 0
+    for token in stream.lexChunks(chunks()):
+        held = max(held, read - token.getsourcepos().idx)
+        count += 1
+    assert count == 5000 * 8
+    assert held < 3 * len(statement)